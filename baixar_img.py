@@ -2,60 +2,2950 @@ import os
 import requests
 from requests.adapters import HTTPAdapter # Importa para usar Retry
 from urllib3.util.retry import Retry # Importa Retry
-from bs4 import BeautifulSoup
+from urllib3.exceptions import ConnectTimeoutError, NewConnectionError
 import time
 import logging
-import tkinter as tk
-from tkinter import ttk, messagebox, font
-from concurrent.futures import ThreadPoolExecutor, as_completed
-from threading import Thread, Lock, Condition
+from concurrent.futures import ThreadPoolExecutor, Future, InvalidStateError, wait, FIRST_COMPLETED
+from threading import Thread, Lock, Event, Condition, Semaphore, local, current_thread, enumerate as enumerate_threads
 import re
 import json
-from datetime import datetime
-from urllib.parse import urljoin, urlparse
-from queue import Queue
+import hashlib
+import bisect
+import heapq
+import fnmatch
+import codecs
+import random
+import socket
+import ssl
+import struct
+import ipaddress
+import weakref
+import io
+import shutil
+import importlib
+import importlib.util
+import signal
+import socketserver
+from http.server import ThreadingHTTPServer, BaseHTTPRequestHandler
+from datetime import datetime, timezone, timedelta
+from email.utils import parsedate_to_datetime
+from urllib.parse import urljoin, urlparse, unquote_plus
+from queue import Queue, Empty, Full
+from collections import deque
+from itertools import combinations
 import sys # Para verificar lxml (removido do código original, mas bom ter)
 
 
+class _LazyModule:
+    """
+    Módulo importado só no primeiro acesso a um atributo. Execuções sem interface nunca
+    carregam o Tk, e o que só alguns recursos usam (parser HTML, HTTP/2, shards,
+    pós-processamento, modo serviço) não pesa na inicialização.
+    """
+
+    def __init__(self, name):
+        self._name = name
+        self._module = None
+
+    def __getattr__(self, attr):
+        module = self._module
+        if module is None:
+            module = self._module = importlib.import_module(self._name)
+        return getattr(module, attr)
+
+
+tk = _LazyModule('tkinter')
+ttk = _LazyModule('tkinter.ttk')
+messagebox = _LazyModule('tkinter.messagebox')
+font = _LazyModule('tkinter.font')
+bs4 = _LazyModule('bs4')
+asyncio = _LazyModule('asyncio')
+tarfile = _LazyModule('tarfile')
+zipfile = _LazyModule('zipfile')
+uuid = _LazyModule('uuid')
+multiprocessing = _LazyModule('multiprocessing')
+argparse = _LazyModule('argparse')
+csv = _LazyModule('csv')
+cProfile = _LazyModule('cProfile')
+pstats = _LazyModule('pstats')
+tracemalloc = _LazyModule('tracemalloc')
+
+
 # --- Constantes ---
 APP_VERSION = "v 1.0" # Versão atualizada
 LOG_FILE = 'image_downloader.log'
 CONFIG_FILE = 'config.json'
 DOWNLOAD_FOLDER = 'donwload imgs' # <-- Nome da pasta alterado aqui
-MAX_WORKERS = 10 # Ajustável - número de threads para download/crawl
+MAX_WORKERS = 10 # Ajustável - número de threads para download/crawl (o scan usa metade)
+MIN_WORKERS = 2 # Limite inferior do autotune de concorrência
+MAX_WORKERS_LIMIT = 64 # Teto da concorrência (autotune e config.json); também o tamanho do pool de conexões
 REQUEST_TIMEOUT = (10, 30) # (connect_timeout, read_timeout) - Aumentado um pouco
+DNS_CACHE = True # Cache de DNS em processo, compartilhado por todos os workers
+DNS_SERVERS = () # Servidores DNS ("ip" ou "ip:porta") consultados direto, com TTL real; vazio = resolvedor do sistema
+DNS_DEFAULT_TTL = 300 # TTL (s) das resoluções do sistema (getaddrinfo não informa o TTL)
+DNS_MIN_TTL = 1 # Limites aplicados ao TTL das respostas
+DNS_MAX_TTL = 3600
+DNS_NEGATIVE_TTL = 10 # Falhas de resolução ficam em cache por este tempo (s)
+DNS_QUERY_TIMEOUT = 2.0 # Timeout (s) de cada consulta UDP a um servidor de DNS_SERVERS
+PREWARM_CONNECTIONS = True # Abre DNS+TCP/TLS em segundo plano para hosts recém-descobertos
+PREWARM_WORKERS = 4 # Threads de pré-aquecimento
+HTTP2 = False # Transporte HTTP/2 (multiplexado) para hosts https que o suportam; requer httpx[http2]
+HTTP2_PREFETCH_BYTES = 1024 * 1024 # Respostas HTTP/2 até este Content-Length chegam inteiras junto com os headers (uma ida ao loop)
+HTTP2_BATCH_BYTES = 256 * 1024 # Corpos maiores: bytes lidos do loop HTTP/2 por ida, em vez de um chunk por vez
+TRANSPORT_MODE = 'live' # 'live', 'record' (grava todas as respostas) ou 'replay' (responde só da gravação, sem rede)
+RECORDING_FOLDER = 'recording' # Pasta da gravação usada pelos modos record/replay
+REPLAY_LATENCY_MS = None # Latência simulada no replay; None = a gravada de cada resposta
+REPLAY_BANDWIDTH_KBPS = 0 # Banda simulada por resposta no replay; 0 = sem limite
+SERVICE_HOST = '127.0.0.1' # Endereço da API do modo serviço (--serve); só local por padrão
+SERVICE_PORT = 8765
+SERVICE_SCHEDULES_FILE = 'schedules.json' # Agendamentos de recrawl do modo serviço
+SERVICE_JOB_HISTORY = 100 # Jobs terminados mantidos em memória para consulta pela API
+STOP_GRACE_PERIOD = 0.5 # Tempo máximo (s) que o stop espera as tarefas interrompidas terminarem
+HISTORY_FOLDER = 'run_history' # Histórico por domínio usado pelo modo incremental
+MANIFEST = True # Manifesto JSONL da execução: um registro por página/imagem (status, bytes, duração, hash)
+MANIFEST_FOLDER = 'run_manifests' # Pasta dos manifestos (<domínio>_<timestamp>.jsonl)
+MANIFEST_ROLLUPS = () # Rollups gravados ao final a partir do JSONL: 'csv' e/ou 'parquet' (requer pyarrow)
+MANIFEST_FLUSH_INTERVAL = 1.0 # Segundos entre descargas do buffer (leitores acompanham o arquivo)
+PROFILE_MODES = ('sample', 'tracemalloc') # Perfilamento (Profile na UI, --profile): 'sample', 'cprofile' (mais caro) e/ou 'tracemalloc'
+PROFILE_FOLDER = 'profiles' # Relatórios em <pasta>/<domínio>_<timestamp>/
+PROFILE_SAMPLE_INTERVAL = 0.005 # Segundos entre amostras de pilha
+PROFILE_SNAPSHOT_INTERVAL = 30 # Segundos entre verificações do pico do tracemalloc
+PROFILE_TRACEMALLOC_FRAMES = 10 # Profundidade das pilhas guardadas pelo tracemalloc
+PROFILE_TOP = 30 # Linhas dos relatórios de texto
+PAGE_REVISIT_BASE = 6 * 3600 # Intervalo base (s) para revisitar páginas que não trouxeram novidades
+PAGE_REVISIT_MAX = 7 * 24 * 3600 # Intervalo máximo (s) entre revisitas de páginas sem novidades
+URL_HASH_LENGTH = 10 # Nº de caracteres hex do hash da URL usado como sufixo dos nomes de arquivo
+PARTIAL_FOLDER = '.partial' # Subpasta (dentro da pasta do domínio) com downloads parciais retomáveis
+DOWNLOAD_CHUNK_SIZE = 0 # Tamanho do chunk de leitura do corpo; 0 = adaptativo pelo Content-Length
+CHUNK_SIZE_MIN = 64 * 1024 # Limites do chunk adaptativo
+CHUNK_SIZE_MAX = 1024 * 1024
+WRITE_BUFFER_SIZE = 1024 * 1024 # Buffer do arquivo em disco (menos syscalls de write)
+PREALLOCATE_MIN_SIZE = 1024 * 1024 # Pré-aloca no disco arquivos a partir deste tamanho
+SHARD_LEVELS = 0 # Níveis de subpastas (2 hex do hash da URL cada) dentro da pasta do domínio; 0 = plano
+PROGRESS_REFRESH_MS = 250 # Intervalo em que a UI amostra os contadores de progresso
+GUI_LOG_FLUSH_MS = 100 # Linhas de log da GUI acumuladas e inseridas juntas (um callback do Tk por lote, não por linha)
+GUI_LOG_BUFFER = 2000 # Linhas pendentes para a GUI; num pico, as mais antigas ficam só no arquivo de log
+PROGRESS_RATE_WINDOW = 10 # Janela deslizante (s) para taxa (imagens/s, MB/s) e ETA
+METRICS_INTERVAL = 5 # Intervalo (s) de exportação das métricas; 0 = só o resumo final
+METRICS_FILE = 'metrics.json' # Snapshot JSON das métricas (reescrito a cada intervalo)
+METRICS_PROM_FILE = 'metrics.prom' # Mesmas métricas no formato texto do Prometheus
+AUTOTUNE_WINDOW = 2.0 # Janela (s) de medição do autotune de concorrência
+AUTOTUNE_GAIN = 0.05 # Variação mínima de vazão considerada ganho/perda (5%)
+AUTOTUNE_ERROR_RATE = 0.05 # Fração de tarefas com congestionamento que força redução
+AUTOTUNE_LATENCY_FACTOR = 1.5 # Latência acima de N x a base, sem ganho de vazão, reduz o limite
+AUTOTUNE_DECREASE = 0.7 # Fator da redução multiplicativa
+CONGESTION_STATUS = (429, 502, 503, 504) # Respostas que indicam servidor sobrecarregado
+DOWNLOAD_RETRIES = 3 # Retentativas adiadas por imagem após falha transitória (timeout, conexão, 5xx, 429)
+RETRY_BACKOFF_BASE = 2.0 # Atraso (s) da primeira retentativa adiada; dobra a cada tentativa
+RETRY_BACKOFF_MAX = 60.0 # Teto do atraso entre retentativas (inclui Retry-After)
+BREAKER_FAILURE_THRESHOLD = 5 # Falhas transitórias seguidas que abrem o disjuntor do host
+BREAKER_COOLDOWN = 10.0 # Tempo (s) com o host bloqueado antes da requisição de teste; dobra a cada reabertura
+BREAKER_MAX_TRIPS = 3 # Aberturas seguidas até o host ser dado como fora do ar na execução
+BREAKER_PROBE_WAIT = 0.5 # Intervalo para reavaliar URLs estacionadas enquanto o teste do host está em andamento
+BREAKER_MAX_PARKS = 200 # Vezes que uma URL pode ser estacionada por disjuntor aberto antes de virar falha
+FAILURE_SUMMARY_LIMIT = 20 # Falhas listadas na UI no resumo final (todas vão para o arquivo de log)
+# Parâmetros de rastreamento/sessão removidos das URLs de página (padrões fnmatch; config: strip_params)
+TRACKING_PARAMS = ('utm_*', 'fbclid', 'gclid', 'dclid', 'gbraid', 'wbraid', 'msclkid', 'yclid', 'igshid',
+                   'mc_cid', 'mc_eid', '_ga', '_gl', '_hsenc', '_hsmi', 'phpsessid', 'jsessionid',
+                   'sessionid', 'session_id', 'sid', 'aspsessionid*', 'cfid', 'cftoken')
+CANONICAL_SORT_PARAMS = True # Ordena os parâmetros da query (?b=2&a=1 == ?a=1&b=2)
+SESSION_PATH_PARAM_RE = re.compile(r';(?:jsessionid|phpsessid|sid)=[^/?#]*', re.IGNORECASE)
+# Escopo do crawl: páginas só do host da URL inicial e seus subdomínios, comparados por rótulo
+# (img.example.com entra, evilexample.com não). Listas de padrões fnmatch de host, sem a porta
+SCOPE_ALLOW_HOSTS = () # Hosts extras cujas páginas também são visitadas, ex. '*.example.com' (config: scope_allow_hosts)
+SCOPE_DENY_HOSTS = () # Hosts nunca buscados, nem páginas nem imagens; vence o allow (config: scope_deny_hosts)
+# Public Suffix List (https://publicsuffix.org/list/public_suffix_list.dat) para o domínio registrável do escopo:
+# a cópia ao lado do script, senão a do sistema; sem nenhuma, o escopo é o host inicial e seus subdomínios
+PUBLIC_SUFFIX_LIST_PATHS = (os.path.join(os.path.dirname(os.path.abspath(__file__)), 'public_suffix_list.dat'),
+                            '/usr/share/publicsuffix/public_suffix_list.dat')
+ORIGIN_IMAGE_CONNECTIONS = 4 # Downloads simultâneos por host de páginas (origem HTML) antes de os workers livres irem para outros hosts
+CDN_IMAGE_CONNECTIONS = 16 # Idem por host só de imagens (CDN); 0 = sem teto
+TRAP_MAX_PATH_DEPTH = 20 # Paths mais fundos que isso são tratados como armadilha
+TRAP_MAX_SEGMENT_REPEATS = 3 # Mesmo segmento mais vezes que isso no path (/a/b/a/b/a/b/a)
+TRAP_MAX_QUERY_PARAMS = 15 # Query com mais parâmetros que isso (parâmetros acumulando a cada link)
+TRAP_MAX_PER_TEMPLATE = 200 # Fetches improdutivos por molde de URL (calendários/paginação sem fim); 0 = sem limite. Páginas que trazem imagens ou links novos ganham fetches extras
+TRAP_NUMBER_RE = re.compile(r'\d+')
+TRAP_ID_SEGMENT_RE = re.compile(r'^[0-9a-fA-F-]{16,}$') # Segmentos que parecem hash/UUID
+TUNING_FILE = os.path.join(HISTORY_FOLDER, 'concurrency.json') # Limites aprendidos por domínio
+OUTPUT_MODE = 'files' # Saída: 'files' (um arquivo por imagem) ou shards 'tar', 'zip', 'warc'
+ARCHIVE_SHARD_BYTES = 1024 * 1024 * 1024 # Tamanho a partir do qual o shard atual é fechado e outro começa
+ARCHIVE_MEMORY_MAX = 1024 * 1024 # No modo shard, imagens até este tamanho nem passam pelo disco (parcial)
+ARCHIVE_QUEUE_SIZE = 256 # Registros aguardando a thread de escrita (backpressure nos workers)
+ARCHIVE_INDEX_SUFFIX = '.idx.jsonl' # Índice lateral de cada shard
+ARCHIVE_SHARD_RE = re.compile(r'^images-(\d{5})\.(?:tar|zip|warc)$')
+POSTPROCESS_STEPS = () # Etapas após o download: 'validate', 'thumbnail', 'webp' ou plugins "modulo:funcao"; vazio = desligado
+POSTPROCESS_WORKERS = max((os.cpu_count() or 2) // 2, 1) # Processos do pool de pós-processamento
+POSTPROCESS_QUEUE_SIZE = 10000 # Arquivos aguardando o pool; além disso o arquivo fica sem pós-processamento
+DERIVED_FOLDER = 'derived' # Subpasta (na pasta do domínio) com miniaturas/conversões
+THUMBNAIL_SIZE = 256 # Lado maior das miniaturas, em pixels
+WEBP_QUALITY = 80
+NEAR_DUPLICATES = False # Descarta variantes da mesma imagem (reencodadas/redimensionadas); requer Pillow e output_mode 'files'
+PHASH_THRESHOLD = 6 # Distância de Hamming máxima (em 64 bits) entre hashes perceptuais de variantes da mesma imagem
+PHASH_BANDS = 4 # Faixas de bits do índice multi-hash (64 / PHASH_BANDS bits cada)
+NEAR_DUPLICATE_MANIFEST = 'near_duplicates.jsonl' # Na pasta do domínio: variantes descartadas e a imagem mantida
+BANDWIDTH_LIMIT_KBPS = 0 # Limite global de banda (KB/s) somando todos os workers; 0 = sem limite
+BANDWIDTH_BURST = 0.25 # Rajada máxima do token bucket, em segundos de banda
+BANDWIDTH_SLICE = 0.05 # Com limite ativo, cada leitura pega ~N segundos de banda (vazão lisa)
+BANDWIDTH_MIN_CHUNK = 8 * 1024 # Menor chunk de leitura com limite ativo
+MAX_PAGE_BYTES = 10 * 1024 * 1024 # Máximo lido de uma página HTML (o resto é descartado); 0 = sem limite
+PAGE_CHUNK_SIZE = 64 * 1024 # Chunk de leitura do corpo das páginas
+CHARSET_SNIFF_BYTES = 4096 # Início do HTML onde procurar <meta charset>
+META_CHARSET_RE = re.compile(rb'<meta[^>]+charset\s*=\s*["\']?\s*([A-Za-z0-9_.:-]+)', re.IGNORECASE)
+BOM_ENCODINGS = ((codecs.BOM_UTF8, 'utf-8-sig'), (codecs.BOM_UTF16_LE, 'utf-16'), (codecs.BOM_UTF16_BE, 'utf-16'))
+SAVED_NAME_HASH_RE = re.compile(r'_([0-9a-f]{%d})\.[A-Za-z0-9]+$' % URL_HASH_LENGTH) # Hash no nome salvo
+
+
+def setup_logging():
+    """
+    Configuração aprimorada de logging para o arquivo (inclui o nome do nível de log).
+    Chamada ao criar o ImageDownloader e não no import: os processos do pool de
+    pós-processamento (spawn) importam este módulo e não podem truncar o log.
+    """
+    logging.basicConfig(
+        filename=LOG_FILE,
+        level=logging.DEBUG, # Define o nível mínimo para DEBUG para capturar tudo no arquivo
+        format='%(asctime)s - %(levelname)s - %(message)s', # Adicionado levelname
+        filemode='w' # 'w' para sobrescrever a cada execução, 'a' para append
+    )
+
+
+def url_hash(url):
+    """Hash curto e determinístico da URL, usado para nomes de arquivo sem colisão"""
+    return hashlib.sha1(url.encode('utf-8')).hexdigest()[:URL_HASH_LENGTH]
+
+
+def adaptive_chunk_size(total_size):
+    """Escolhe o chunk de leitura pelo tamanho esperado: ~16 iterações por arquivo, dentro dos limites"""
+    if not total_size:
+        return CHUNK_SIZE_MIN
+    return max(CHUNK_SIZE_MIN, min(CHUNK_SIZE_MAX, total_size // 16))
+
+
+def sniff_html_encoding(content_type, body):
+    """
+    Encoding de uma página sem rodar detecção estatística sobre o corpo inteiro:
+    BOM, depois o charset do Content-Type, depois <meta charset> no início do HTML.
+    Sem nada declarado: UTF-8 se o corpo for UTF-8 válido, senão windows-1252 (padrão do HTML).
+    Um caractere multibyte incompleto no fim não conta como inválido: o corpo pode ter sido
+    cortado em max_page_bytes no meio dele.
+    """
+    for bom, encoding in BOM_ENCODINGS:
+        if body.startswith(bom):
+            return encoding
+    declared = []
+    for param in content_type.split(';')[1:]:
+        name, _, value = param.partition('=')
+        if name.strip().lower() == 'charset':
+            declared.append(value.strip().strip('"\''))
+    match = META_CHARSET_RE.search(body, 0, CHARSET_SNIFF_BYTES)
+    if match:
+        declared.append(match.group(1).decode('ascii'))
+    for encoding in declared:
+        try:
+            return codecs.lookup(encoding).name
+        except LookupError:
+            continue # Charset desconhecido/inválido: tenta o próximo
+    try:
+        codecs.getincrementaldecoder('utf-8')().decode(body, final=False)
+        return 'utf-8'
+    except UnicodeDecodeError:
+        return 'windows-1252'
+
+
+class HeadlessVar:
+    """Substituto simples de tk.Variable (get/set) para uso sem janela"""
+
+    def __init__(self, value=None):
+        self._value = value
+
+    def get(self):
+        return self._value
+
+    def set(self, value):
+        self._value = value
+
+
+def _is_ip_address(host):
+    try:
+        ipaddress.ip_address(host.strip('[]'))
+        return True
+    except ValueError:
+        return False
+
+
+class RequestCancelled(Exception):
+    """
+    Requisição abortada por um stop. Não herda de OSError de propósito: o urllib3 trata
+    OSError como falha de rede e tentaria de novo (Retry), reabrindo a conexão.
+    """
+
+
+def _skip_dns_name(data, offset):
+    """Pula um nome (labels ou ponteiro de compressão) de uma mensagem DNS; retorna o offset seguinte"""
+    while True:
+        length = data[offset]
+        if length >= 0xC0:
+            return offset + 2
+        offset += 1 + length
+        if length == 0:
+            return offset
+
+
+def query_dns(server, host, qtype=1, timeout=DNS_QUERY_TIMEOUT):
+    """
+    Consulta registros A (qtype=1) ou AAAA (qtype=28) de host direto a um servidor DNS, via UDP.
+    O mínimo para ter o TTL real das respostas (getaddrinfo não o informa) e poder testar a
+    resolução contra um servidor stub local.
+    :param server: "ip", "ip:porta" ou "[ipv6]:porta"
+    :return: (lista de IPs, menor TTL das respostas ou None)
+    """
+    if server.startswith('['):
+        address, _, port = server[1:].partition(']')
+        port = port.lstrip(':')
+    elif server.count(':') == 1:
+        address, port = server.split(':')
+    else:
+        address, port = server, ''
+    query_id = random.getrandbits(16)
+    qname = b''.join(bytes([len(label)]) + label for label in host.encode('idna').split(b'.')) + b'\0'
+    packet = struct.pack('>HHHHHH', query_id, 0x0100, 1, 0, 0, 0) + qname + struct.pack('>HH', qtype, 1)
+    family = socket.AF_INET6 if ':' in address else socket.AF_INET
+    with socket.socket(family, socket.SOCK_DGRAM) as sock:
+        sock.settimeout(timeout)
+        sock.sendto(packet, (address, int(port or 53)))
+        while True:
+            data = sock.recv(4096)
+            if len(data) >= 12 and struct.unpack('>H', data[:2])[0] == query_id:
+                break # Ignora respostas atrasadas de outras consultas
+
+    _, flags, qdcount, ancount, _, _ = struct.unpack('>HHHHHH', data[:12])
+    if flags & 0xF == 3:
+        raise socket.gaierror(socket.EAI_NONAME, f"{host}: name does not exist")
+    if flags & 0xF:
+        raise socket.gaierror(socket.EAI_AGAIN, f"{host}: DNS server error (rcode {flags & 0xF})")
+    if flags & 0x0200:
+        raise socket.gaierror(socket.EAI_AGAIN, f"{host}: truncated DNS response")
+    offset = 12
+    for _ in range(qdcount):
+        offset = _skip_dns_name(data, offset) + 4
+    ips, ttls = [], []
+    for _ in range(ancount):
+        offset = _skip_dns_name(data, offset)
+        rtype, _, ttl, length = struct.unpack('>HHIH', data[offset:offset + 10])
+        offset += 10
+        rdata = data[offset:offset + length]
+        offset += length
+        ttls.append(ttl) # Inclui os CNAMEs da cadeia
+        if rtype == qtype == 1 and length == 4:
+            ips.append(socket.inet_ntop(socket.AF_INET, rdata))
+        elif rtype == qtype == 28 and length == 16:
+            ips.append(socket.inet_ntop(socket.AF_INET6, rdata))
+    return ips, (min(ttls) if ttls else None)
+
+
+class DnsCache:
+    """
+    Cache de resolução de nomes em processo, compartilhado por todos os workers e execuções.
+    Sem servidores configurados usa o resolvedor do sistema (getaddrinfo), cujo TTL não é
+    conhecido: vale default_ttl. Com servers, consulta-os direto (query_dns) e respeita o TTL
+    de cada resposta. Resoluções simultâneas do mesmo host esperam uma única consulta, e
+    falhas ficam em cache por DNS_NEGATIVE_TTL.
+    """
+
+    def __init__(self, servers=(), default_ttl=DNS_DEFAULT_TTL, enabled=True):
+        self.servers = list(servers)
+        self.default_ttl = default_ttl
+        self.enabled = enabled
+        self.lock = Lock()
+        self.entries = {} # host -> (expira em (monotonic), ips, erro (errno, mensagem) ou None)
+        self.pending = {} # host -> Event da resolução em andamento
+        self.hits = 0
+        self.lookups = 0
+        self.lookup_seconds = 0.0
+
+    def clear(self):
+        with self.lock:
+            self.entries.clear()
+
+    def resolve(self, host):
+        """Lista de IPs de host (do cache, se ainda válido); levanta socket.gaierror se não resolver"""
+        host = host.lower().rstrip('.')
+        while True:
+            with self.lock:
+                entry = self.entries.get(host)
+                if entry is not None and entry[0] > time.monotonic():
+                    self.hits += 1
+                    if entry[2] is not None:
+                        raise socket.gaierror(*entry[2])
+                    return entry[1]
+                pending = self.pending.get(host)
+                if pending is None:
+                    pending = self.pending[host] = Event()
+                    break
+            pending.wait() # Outra thread está resolvendo este host: usa o resultado dela
+
+        start = time.monotonic()
+        try:
+            ips, ttl = self._lookup(host)
+            ttl = self.default_ttl if ttl is None else min(max(ttl, DNS_MIN_TTL), DNS_MAX_TTL)
+            entry = (time.monotonic() + ttl, ips, None)
+        except OSError as e: # gaierror, timeout, servidor inacessível
+            entry = (time.monotonic() + DNS_NEGATIVE_TTL, None, (e.errno or socket.EAI_NONAME, e.strerror or str(e)))
+        with self.lock:
+            self.lookups += 1
+            self.lookup_seconds += time.monotonic() - start
+            self.entries[host] = entry
+            del self.pending[host]
+        pending.set()
+        if entry[2] is not None:
+            raise socket.gaierror(*entry[2])
+        return entry[1]
+
+    def _lookup(self, host):
+        if not self.servers:
+            infos = socket.getaddrinfo(host, None, type=socket.SOCK_STREAM)
+            return list(dict.fromkeys(info[4][0] for info in infos)), None
+        error = None
+        for server in self.servers:
+            try:
+                for qtype in (1, 28): # A; se não houver, AAAA
+                    ips, ttl = query_dns(server, host, qtype)
+                    if ips:
+                        return ips, ttl
+                raise socket.gaierror(socket.EAI_NONAME, f"{host}: no A/AAAA records")
+            except socket.gaierror:
+                raise # Resposta definitiva do servidor
+            except OSError as e: # Timeout/servidor fora: tenta o próximo
+                error = e
+        raise socket.gaierror(socket.EAI_AGAIN, f"{host}: no DNS server answered ({error})")
+
+
+class CancellableHTTPAdapter(HTTPAdapter):
+    """
+    HTTPAdapter que registra as conexões que abre, para que um stop possa interrompê-las
+    na hora (shutdown do socket) em vez de esperar o REQUEST_TIMEOUT de um recv bloqueado.
+    abort_check (opcional) é consultado antes de cada connect(): se retornar True, a
+    requisição falha com RequestCancelled em vez de abrir (ou reabrir, num retry) a conexão.
+    Com dns_cache, os nomes são resolvidos pelo DnsCache (cada IP é tentado em ordem);
+    o host original continua sendo usado no TLS (SNI/certificado) e no header Host.
+    """
+
+    def __init__(self, *args, abort_check=None, dns_cache=None, **kwargs):
+        self._connections = weakref.WeakSet() # Conexões vivas (em uso ou ociosas no pool)
+        self._connections_lock = Lock()
+        self.abort_check = abort_check
+        self.dns_cache = dns_cache
+        super().__init__(*args, **kwargs)
+
+    def init_poolmanager(self, *args, **kwargs):
+        super().init_poolmanager(*args, **kwargs)
+        # Pools/conexões derivados das classes padrão do urllib3, com registro no connect()
+        self.poolmanager.pool_classes_by_scheme = {
+            scheme: self._tracked_pool_class(pool_cls)
+            for scheme, pool_cls in self.poolmanager.pool_classes_by_scheme.items()
+        }
+
+    def _tracked_pool_class(self, pool_cls):
+        adapter = self
+        base_conn_cls = pool_cls.ConnectionCls
+
+        class TrackedConnection(base_conn_cls):
+            def connect(self):
+                if adapter.abort_check is not None and adapter.abort_check():
+                    raise RequestCancelled(f"Connection to {self.host} cancelled by stop")
+                cache = adapter.dns_cache
+                if cache is None or not cache.enabled or _is_ip_address(self.host):
+                    super().connect()
+                else:
+                    try:
+                        addresses = cache.resolve(self.host)
+                    except socket.gaierror as e:
+                        raise NewConnectionError(self, f"Failed to resolve '{self.host}': {e}") from e
+                    for attempt, address in enumerate(addresses, 1):
+                        self._dns_host = address # Só o endereço do connect(); TLS segue com self.host
+                        try:
+                            super().connect()
+                            break
+                        except (NewConnectionError, ConnectTimeoutError):
+                            if attempt == len(addresses):
+                                raise
+                adapter._register(self)
+
+        return type(f"Tracked{pool_cls.__name__}", (pool_cls,), {'ConnectionCls': TrackedConnection})
+
+    def prewarm(self, url, verify=True):
+        """
+        Abre uma conexão (TCP e, em https, TLS) com o host de url e a deixa ociosa no mesmo pool
+        que as requisições usam: a primeira requisição ao host a reaproveita.
+        """
+        request = requests.Request('GET', url).prepare()
+        if hasattr(self, 'get_connection_with_tls_context'):
+            pool = self.get_connection_with_tls_context(request, verify)
+        else: # requests < 2.32
+            pool = self.get_connection(url)
+        conn = pool._get_conn() # Conexão ociosa do pool ou uma nova, ainda sem socket
+        try:
+            if conn.sock is None:
+                conn.connect()
+        finally:
+            pool._put_conn(conn)
+
+    def _register(self, conn):
+        with self._connections_lock:
+            self._connections.add(conn)
+
+    def interrupt(self):
+        """Derruba todas as conexões abertas: leituras bloqueadas falham imediatamente"""
+        with self._connections_lock:
+            connections = list(self._connections)
+            self._connections.clear()
+        for conn in connections:
+            sock = getattr(conn, 'sock', None)
+            if sock is None:
+                continue
+            try:
+                sock.shutdown(socket.SHUT_RDWR)
+            except OSError:
+                pass # Já fechado
+        return len(connections)
+
+
+def _tls_context(verify):
+    """Contexto TLS equivalente ao verify do requests (True, False ou caminho de CA bundle)"""
+    if verify is False:
+        context = ssl.create_default_context()
+        context.check_hostname = False
+        context.verify_mode = ssl.CERT_NONE
+    elif isinstance(verify, str):
+        context = ssl.create_default_context(**({'capath': verify} if os.path.isdir(verify) else {'cafile': verify}))
+    else:
+        context = ssl.create_default_context(cafile=requests.certs.where()) # Mesmo bundle (certifi) do requests
+    return context
+
+
+class _Http2Body:
+    """
+    Corpo de uma resposta HTTP/2 (httpx) com a interface de response.raw usada pelo requests
+    (stream/read/close). Corpos pequenos já vêm lidos (prefetched) junto com os headers; os
+    maiores são lidos no loop de eventos do Http2Adapter em lotes de HTTP2_BATCH_BYTES por ida,
+    o que também devolve logo a janela de controle de fluxo da conexão aos outros streams.
+    """
+
+    def __init__(self, response, adapter, prefetched=None):
+        self.response = response
+        self.adapter = adapter
+        self.prefetched = prefetched # Corpo inteiro (bytes) se já foi lido no loop
+        self.consumed = False
+
+    def stream(self, amt=64 * 1024, decode_content=True):
+        try:
+            if self.prefetched is not None:
+                body, self.prefetched = self.prefetched, b''
+                for start in range(0, len(body), amt):
+                    yield body[start:start + amt]
+                return
+            httpx = self.adapter.httpx
+            chunks = self.response.aiter_bytes(amt) # Já descomprimido (gzip/br), como no urllib3
+            try:
+                while True:
+                    batch = self.adapter.run(_next_batch(chunks, max(amt, HTTP2_BATCH_BYTES)))
+                    yield from batch
+                    if not batch:
+                        break
+            except (httpx.TransportError, httpx.StreamClosed) as e:
+                raise requests.exceptions.ConnectionError(e) from e
+        finally:
+            self.consumed = True
+
+    def read(self, amt=None, decode_content=True, **kwargs):
+        if self.consumed:
+            return b''
+        return b''.join(self.stream())
+
+    def close(self):
+        if self.response.is_closed:
+            return # Prefetched: o stream já foi fechado no loop
+        try:
+            self.adapter.run(self.response.aclose())
+        except Exception:
+            pass # Cliente já fechado (stop)
+
+    release_conn = close
+
+
+async def _next_batch(chunks, size):
+    """Chunks seguintes do corpo até somar size bytes; lista vazia no fim do corpo"""
+    batch, total = [], 0
+    async for chunk in chunks:
+        batch.append(chunk)
+        total += len(chunk)
+        if total >= size:
+            break
+    return batch
+
+
+async def _send_and_prefetch(client, request, retry_status):
+    """
+    Envia a requisição HTTP/2 e, se o corpo é pequeno (Content-Length até HTTP2_PREFETCH_BYTES)
+    e o status não vai ser retentado, já o lê: headers e corpo numa única ida ao loop.
+    :return: (resposta httpx, corpo ou None se o corpo segue em streaming)
+    """
+    response = await client.send(request, stream=True)
+    length = response.headers.get('content-length', '')
+    if response.status_code in retry_status or not length.isdigit() or int(length) > HTTP2_PREFETCH_BYTES:
+        return response, None
+    try:
+        return response, await response.aread()
+    except BaseException:
+        await response.aclose()
+        raise
+
+
+class Http2Adapter(CancellableHTTPAdapter):
+    """
+    Transporte HTTP/2 opcional (httpx + h2): requisições concorrentes a um host são
+    multiplexadas em poucas conexões, em vez de uma conexão TCP+TLS por worker.
+    A escolha é por host: na primeira requisição um handshake de teste oferece ALPN
+    "h2"/"http/1.1"; hosts sem h2, http:// e requisições via proxy seguem pelo
+    CancellableHTTPAdapter (HTTP/1.1). Mantém a semântica de timeout (connect, read), da
+    política Retry (total, status_forcelist, backoff) e do stop do adaptador HTTP/1.1.
+
+    O estado HTTP/2 de uma conexão (HPACK, streams) não pode ser tocado por várias threads
+    ao mesmo tempo, então todo o I/O HTTP/2 roda num loop asyncio próprio (uma thread) com
+    httpx.AsyncClient; os workers só esperam o resultado de cada etapa. Cada ida ao loop custa
+    uma troca de thread, então uma imagem típica faz uma só (headers + corpo) e corpos grandes
+    são lidos em lotes.
+    """
+
+    def __init__(self, *args, **kwargs):
+        import httpx # Opcional: só é importado com http2 ligado
+        self.httpx = httpx
+        super().__init__(*args, **kwargs)
+        for name in ('hpack', 'h2', 'httpcore'):
+            logging.getLogger(name).setLevel(logging.WARNING) # DEBUG delas é uma linha por header/frame
+        self.protocols = {} # (host, porta) -> protocolo negociado via ALPN
+        self.probe_locks = {}
+        self.clients = {} # verify -> httpx.AsyncClient
+        self.bodies = weakref.WeakSet() # Respostas HTTP/2 abertas (fechadas pelo stop)
+        self.h2_lock = Lock()
+        self.loop = None # Loop asyncio do I/O HTTP/2, criado na primeira requisição h2
+
+    def run(self, coroutine):
+        """Executa uma corrotina no loop HTTP/2 e espera o resultado (chamado pelos workers)"""
+        with self.h2_lock:
+            if self.loop is None:
+                self.loop = asyncio.new_event_loop()
+                Thread(target=self.loop.run_forever, name='http2-loop', daemon=True).start()
+            loop = self.loop
+        return asyncio.run_coroutine_threadsafe(coroutine, loop).result()
+
+    def protocol(self, host, port, verify=True):
+        """'h2' ou 'http/1.1' para o host (negociado uma vez; cada host testado por uma única thread)"""
+        key = (host, port)
+        with self.h2_lock:
+            protocol = self.protocols.get(key)
+            if protocol is not None:
+                return protocol
+            probe_lock = self.probe_locks.setdefault(key, Lock())
+        with probe_lock:
+            protocol = self.protocols.get(key)
+            if protocol is None:
+                protocol = self._probe(host, port, verify)
+                with self.h2_lock:
+                    self.protocols[key] = protocol
+                logging.debug(f"ALPN for {host}:{port}: {protocol}")
+        return protocol
+
+    def _probe(self, host, port, verify):
+        context = _tls_context(verify)
+        context.set_alpn_protocols(['h2', 'http/1.1'])
+        try:
+            address = host
+            if self.dns_cache is not None and self.dns_cache.enabled and not _is_ip_address(host):
+                address = self.dns_cache.resolve(host)[0]
+            with socket.create_connection((address, port), timeout=REQUEST_TIMEOUT[0]) as sock:
+                with context.wrap_socket(sock, server_hostname=host) as tls:
+                    return tls.selected_alpn_protocol() or 'http/1.1'
+        except OSError: # Inclui erros de TLS/DNS: o HTTP/1.1 tenta e reporta o erro de verdade
+            return 'http/1.1'
+
+    def _client(self, verify):
+        key = verify if isinstance(verify, (bool, str)) else True
+        with self.h2_lock:
+            client = self.clients.get(key)
+            if client is None:
+                client = self.clients[key] = self.httpx.AsyncClient(
+                    http2=True, verify=_tls_context(verify), trust_env=False, follow_redirects=False,
+                    limits=self.httpx.Limits(max_connections=None, max_keepalive_connections=MAX_WORKERS_LIMIT))
+            return client
+
+    def send(self, request, stream=False, timeout=None, verify=True, cert=None, proxies=None):
+        parsed = urlparse(request.url)
+        if (parsed.scheme != 'https' or cert or requests.utils.select_proxy(request.url, proxies)
+                or self.protocol(parsed.hostname, parsed.port or 443, verify) != 'h2'):
+            return super().send(request, stream=stream, timeout=timeout, verify=verify, cert=cert, proxies=proxies)
+        return self._send_h2(request, timeout, verify)
+
+    def _send_h2(self, request, timeout, verify):
+        httpx = self.httpx
+        connect_timeout, read_timeout = timeout if isinstance(timeout, tuple) else (timeout, timeout)
+        h2_timeout = httpx.Timeout(connect=connect_timeout, read=read_timeout, write=read_timeout, pool=read_timeout)
+        retry = self.max_retries
+        retries = retry.total if isinstance(retry.total, int) else 0
+        retry_status = retry.status_forcelist or ()
+        retry_method = retry.allowed_methods is None or request.method in retry.allowed_methods
+        for attempt in range(retries + 1):
+            if self.abort_check is not None and self.abort_check():
+                raise RequestCancelled(f"Request to {request.url} cancelled by stop")
+            client = self._client(verify) # Um stop fecha os clientes; depois dele vem um novo
+            try:
+                h2_request = client.build_request(request.method, request.url, headers=dict(request.headers),
+                                                  content=request.body, timeout=h2_timeout)
+                h2_response, body = self.run(_send_and_prefetch(client, h2_request, retry_status if retry_method else ()))
+            except httpx.ConnectTimeout as e:
+                error = requests.exceptions.ConnectTimeout(e, request=request)
+            except httpx.TimeoutException as e:
+                error = requests.exceptions.ReadTimeout(e, request=request)
+            except (httpx.TransportError, RuntimeError) as e: # RuntimeError: cliente fechado por um stop
+                error = requests.exceptions.ConnectionError(e, request=request)
+            else:
+                if (h2_response.status_code not in retry_status or not retry_method
+                        or (attempt == retries and not retry.raise_on_status)):
+                    return self._build_response_h2(request, h2_response, body)
+                self.run(h2_response.aclose())
+                error = requests.exceptions.RetryError(
+                    f"Max retries exceeded with url: {request.url} (too many {h2_response.status_code} error responses)",
+                    request=request)
+            if attempt == retries or not retry_method:
+                raise error
+            self._backoff(retry, attempt + 1, request.url)
+
+    def _backoff(self, retry, errors, url):
+        """Espera do urllib3 (Retry.get_backoff_time) após errors falhas seguidas: nenhuma antes da primeira retentativa; interrompida pelo stop"""
+        delay = 0 if errors <= 1 else min(retry.backoff_factor * 2 ** (errors - 1), getattr(retry, 'backoff_max', getattr(Retry, 'DEFAULT_BACKOFF_MAX', 120)))
+        deadline = time.monotonic() + delay
+        while True:
+            if self.abort_check is not None and self.abort_check():
+                raise RequestCancelled(f"Request to {url} cancelled by stop")
+            remaining = deadline - time.monotonic()
+            if remaining <= 0:
+                return
+            time.sleep(min(remaining, 0.05))
+
+    def _build_response_h2(self, request, h2_response, body=None):
+        """Converte a resposta httpx (ainda em streaming) num requests.Response"""
+        response = requests.Response()
+        response.status_code = h2_response.status_code
+        response.headers = requests.structures.CaseInsensitiveDict(h2_response.headers.items())
+        response.encoding = requests.utils.get_encoding_from_headers(response.headers)
+        response.reason = h2_response.reason_phrase
+        response.raw = _Http2Body(h2_response, self, body)
+        response.url = request.url
+        response.request = request
+        response.connection = self
+        if body is None: # Só respostas ainda em streaming precisam ser fechadas pelo stop
+            with self.h2_lock:
+                self.bodies.add(response.raw)
+        return response
+
+    def prewarm(self, url, verify=True):
+        """Negocia o protocolo do host; hosts HTTP/1.1 ainda ganham a conexão ociosa no pool"""
+        parsed = urlparse(url)
+        if parsed.scheme == 'https' and self.protocol(parsed.hostname, parsed.port or 443, verify) == 'h2':
+            return
+        super().prewarm(url, verify)
+
+    def interrupt(self):
+        """Stop: além das conexões HTTP/1.1, fecha os clientes HTTP/2 (e com eles os streams em andamento)"""
+        interrupted = super().interrupt()
+        with self.h2_lock:
+            clients, self.clients = list(self.clients.values()), {}
+            bodies = list(self.bodies)
+        for body in bodies:
+            body.close()
+        for client in clients:
+            try:
+                self.run(client.aclose())
+            except Exception:
+                pass
+        return interrupted + len(bodies)
+
+    def close(self):
+        self.interrupt()
+        super().close()
+
+
+class FetchRecorder:
+    """
+    Grava todas as respostas de uma sessão num arquivo indexado: <pasta>/bodies.dat com os
+    corpos e <pasta>/index.jsonl com uma linha por resposta (método, URL, Range pedido, status,
+    headers, trechos do corpo, tempo até os headers). O corpo gravado é o já descomprimido
+    (Content-Encoding sai dos headers) e só a parte que o app leu: páginas puladas antes do
+    corpo, truncadas ou downloads interrompidos ficam marcados como parciais.
+    Os chunks vão para bodies.dat à medida que chegam (nada de corpo inteiro em memória); com
+    downloads simultâneos eles se intercalam, então cada resposta guarda a lista de trechos
+    [offset, tamanho] do seu corpo ("segments"), com trechos consecutivos já emendados.
+    """
+
+    def __init__(self, folder):
+        self.folder = folder
+        os.makedirs(folder, exist_ok=True)
+        self.lock = Lock()
+        self.bodies = open(os.path.join(folder, 'bodies.dat'), 'ab')
+        self.index = open(os.path.join(folder, 'index.jsonl'), 'a', encoding='utf-8')
+        self.records = 0
+
+    def append(self, chunk):
+        """Acrescenta um chunk de corpo a bodies.dat; retorna o offset onde ele ficou"""
+        with self.lock:
+            offset = self.bodies.tell()
+            self.bodies.write(chunk)
+            return offset
+
+    def write(self, request, response, elapsed, segments, size, complete):
+        headers = {name: value for name, value in response.headers.items() if name.lower() != 'content-encoding'}
+        if complete and 'Content-Length' in headers:
+            headers['Content-Length'] = str(size) # Tamanho descomprimido, o que o replay serve
+        with self.lock:
+            self.bodies.flush() # Corpo no disco antes da linha de índice que aponta para ele
+            self.index.write(json.dumps({
+                'method': request.method, 'url': request.url, 'range': request.headers.get('Range'),
+                'status': response.status_code, 'reason': response.reason, 'headers': headers,
+                'segments': segments, 'size': size, 'elapsed': round(elapsed, 4), 'complete': complete,
+            }) + '\n')
+            self.index.flush()
+            self.records += 1
+
+    def close(self):
+        with self.lock:
+            self.bodies.close()
+            self.index.close()
+
+
+class _RecordingBody:
+    """Envolve response.raw: repassa os chunks ao requests e grava cada um no FetchRecorder"""
+
+    def __init__(self, raw, append, on_done):
+        self.raw = raw
+        self.append = append # callback(chunk) -> offset em bodies.dat
+        self.on_done = on_done # callback(trechos, tamanho, completo), chamado uma única vez
+        self.segments = [] # [offset, tamanho] do corpo em bodies.dat
+        self.size = 0
+        self.done = False
+
+    def _keep(self, chunk):
+        if not chunk or self.done:
+            return
+        offset = self.append(chunk)
+        if self.segments and sum(self.segments[-1]) == offset:
+            self.segments[-1][1] += len(chunk) # Nenhum outro corpo entrou no meio: emenda
+        else:
+            self.segments.append([offset, len(chunk)])
+        self.size += len(chunk)
+
+    def stream(self, amt=64 * 1024, decode_content=True):
+        complete = False
+        try:
+            for chunk in self.raw.stream(amt, decode_content=True):
+                self._keep(chunk)
+                yield chunk
+            complete = True
+        finally:
+            self._finish(complete)
+
+    def read(self, amt=None, decode_content=True, **kwargs):
+        data = self.raw.read(amt, decode_content=True, **kwargs)
+        self._keep(data)
+        if amt is None or not data:
+            self._finish(True)
+        return data
+
+    def _finish(self, complete):
+        if not self.done:
+            self.done = True
+            self.on_done(self.segments, self.size, complete)
+
+    def close(self):
+        self._finish(False) # Sem efeito se o corpo já foi lido até o fim
+        self.raw.close()
+
+    def release_conn(self):
+        release = getattr(self.raw, 'release_conn', None)
+        if release is not None:
+            release()
+
+    def __getattr__(self, name):
+        return getattr(self.raw, name)
+
+
+class RecordingAdapter(requests.adapters.BaseAdapter):
+    """Adaptador que repassa as requisições ao adaptador real e grava as respostas (modo 'record')"""
+
+    def __init__(self, inner, recorder):
+        super().__init__()
+        self.inner = inner
+        self.recorder = recorder
+
+    def send(self, request, stream=False, **kwargs):
+        start = time.perf_counter()
+        response = self.inner.send(request, stream=True, **kwargs)
+        elapsed = time.perf_counter() - start
+        response.raw = _RecordingBody(response.raw, self.recorder.append, lambda segments, size, complete:
+                                      self.recorder.write(request, response, elapsed, segments, size, complete))
+        if not stream:
+            response.content # Mesmo comportamento do requests sem stream: lê (e grava) tudo já
+        return response
+
+    def prewarm(self, url, verify=True):
+        self.inner.prewarm(url, verify)
+
+    def interrupt(self):
+        return self.inner.interrupt()
+
+    def close(self):
+        self.inner.close()
+
+
+class ReplayArchive:
+    """
+    Índice de uma gravação do FetchRecorder: (método, URL, Range) -> respostas na ordem gravada.
+    O Range faz parte da chave: uma retomada gravada (206, só o fim do arquivo) nunca é servida
+    a uma requisição sem Range, nem o contrário.
+    """
+
+    def __init__(self, folder, empty=False):
+        """empty=True: gravação sem nenhuma resposta (toda requisição falha), sem abrir arquivos"""
+        self.folder = folder
+        self.entries = {}
+        self.served = {} # (método, URL, Range) -> quantas vezes já foi servida
+        self.lock = Lock()
+        self.bodies = None
+        if empty:
+            return
+        with open(os.path.join(folder, 'index.jsonl'), 'r', encoding='utf-8') as f:
+            for line in f:
+                if line.strip():
+                    entry = json.loads(line)
+                    if 'range' not in entry and entry['status'] == 206:
+                        continue # Gravação antiga, sem o Range pedido: o 206 não tem a quem ser servido
+                    self.entries.setdefault((entry['method'], entry['url'], entry.get('range')), []).append(entry)
+        self.bodies = open(os.path.join(folder, 'bodies.dat'), 'rb')
+
+    def lookup(self, method, url, range_header=None):
+        """Próxima resposta gravada para a requisição (a última se repete) e o corpo; None se não foi gravada"""
+        key = (method, url, range_header)
+        entries = self.entries.get(key)
+        if not entries:
+            return None, None
+        with self.lock:
+            count = self.served.get(key, 0)
+            self.served[key] = count + 1
+            entry = entries[min(count, len(entries) - 1)]
+            segments = entry.get('segments') or [[entry['offset'], entry['size']]] # Gravação antiga: um trecho
+            body = []
+            for offset, size in segments:
+                self.bodies.seek(offset)
+                body.append(self.bodies.read(size))
+            return entry, b''.join(body)
+
+    def close(self):
+        if self.bodies is not None:
+            self.bodies.close()
+
+
+class _ReplayBody:
+    """Corpo gravado servido em chunks, opcionalmente limitado a uma banda simulada (bytes/s)"""
+
+    def __init__(self, body, rate, abort_check=None):
+        self.body = body
+        self.rate = rate
+        self.abort_check = abort_check
+        self.position = 0
+
+    def stream(self, amt=64 * 1024, decode_content=True):
+        while self.position < len(self.body):
+            if self.abort_check is not None and self.abort_check():
+                raise RequestCancelled("Replay stopped by user")
+            chunk = self.body[self.position:self.position + amt]
+            self.position += len(chunk)
+            if self.rate:
+                time.sleep(len(chunk) / self.rate)
+            yield chunk
+
+    def read(self, amt=None, decode_content=True, **kwargs):
+        return b''.join(self.stream(amt or len(self.body) or 1))
+
+    def close(self):
+        self.position = len(self.body)
+
+    release_conn = close
+
+
+class ReplayAdapter(requests.adapters.BaseAdapter):
+    """
+    Adaptador que responde só a partir de uma gravação (modo 'replay'), sem nenhum acesso à rede.
+    latency_ms=None reproduz o tempo até os headers gravado; um número fixa a latência.
+    bandwidth (bytes/s, 0 = sem limite) simula a banda de cada resposta.
+    URLs que não estão na gravação falham como erro de conexão.
+    """
+
+    def __init__(self, archive, latency_ms=None, bandwidth=0, abort_check=None):
+        super().__init__()
+        self.archive = archive
+        self.latency_ms = latency_ms
+        self.bandwidth = bandwidth
+        self.abort_check = abort_check
+        self.misses = 0
+
+    def send(self, request, stream=False, **kwargs):
+        if self.abort_check is not None and self.abort_check():
+            raise RequestCancelled(f"Request to {request.url} cancelled by stop")
+        entry, body = self.archive.lookup(request.method, request.url, request.headers.get('Range'))
+        if entry is None:
+            self.misses += 1
+            raise requests.exceptions.ConnectionError(f"{request.url} is not in the recording {self.archive.folder}", request=request)
+        delay = entry['elapsed'] if self.latency_ms is None else self.latency_ms / 1000
+        if delay > 0:
+            time.sleep(delay)
+        response = requests.Response()
+        response.status_code = entry['status']
+        response.reason = entry['reason']
+        response.headers = requests.structures.CaseInsensitiveDict(entry['headers'])
+        response.encoding = requests.utils.get_encoding_from_headers(response.headers)
+        response.raw = _ReplayBody(body, self.bandwidth, self.abort_check)
+        response.url = request.url
+        response.request = request
+        response.connection = self
+        if not stream:
+            response.content
+        return response
+
+    def prewarm(self, url, verify=True):
+        pass
+
+    def interrupt(self):
+        return 0
+
+    def close(self):
+        self.archive.close()
+
+
+class ConnectionWarmer:
+    """
+    Pré-aquecimento de hosts recém-descobertos (links enfileirados, imagens em CDNs): enquanto
+    as URLs esperam na fila, resolve o nome no DnsCache e abre uma conexão ociosa no pool.
+    Cada host é aquecido uma vez por execução; falhas são ignoradas (a requisição real as reporta).
+    """
+
+    def __init__(self, session, dns_cache, connect=True, workers=PREWARM_WORKERS, image_session=None):
+        self.session = session
+        self.image_session = image_session or session # Pool das imagens é outro: aquecido à parte
+        self.dns_cache = dns_cache
+        self.connect = connect
+        self.executor = ThreadPoolExecutor(max_workers=workers, thread_name_prefix='prewarm')
+        self.lock = Lock()
+        self.seen = set()
+        self.warmed = 0
+
+    def discover(self, url, image=False):
+        """Agenda o pré-aquecimento do host de url, se ainda não foi feito (não bloqueia)"""
+        parsed = urlparse(url)
+        session = self.image_session if image else self.session
+        key = (parsed.scheme, parsed.netloc, session is self.image_session)
+        with self.lock:
+            if key in self.seen:
+                return
+            self.seen.add(key)
+        try:
+            self.executor.submit(self._warm, session, url, parsed.hostname)
+        except RuntimeError:
+            pass # Já encerrado
+
+    def _warm(self, session, url, host):
+        try:
+            if session.trust_env and requests.utils.get_environ_proxies(url):
+                return # Via proxy: nem o DNS do host é feito localmente
+            if host and not _is_ip_address(host):
+                self.dns_cache.resolve(host)
+            if self.connect:
+                session.get_adapter(url).prewarm(url, verify=session.verify)
+            with self.lock:
+                self.warmed += 1
+        except Exception as e: # Só otimização: qualquer falha fica para a requisição real
+            logging.debug(f"Pre-warm of {host} failed: {e}")
+
+    def close(self):
+        self.executor.shutdown(wait=False, cancel_futures=True)
+
+
+class BandwidthLimiter:
+    """
+    Token bucket global (e, opcionalmente, por host) sobre os bytes lidos do corpo das respostas.
+    Cada leitura reserva seus bytes na hora (o saldo pode ficar negativo) e quem reservou dorme só
+    o necessário para o saldo voltar a zero: sem lock durante a espera, os workers saem em ordem
+    de chegada e a vazão fica lisa no limite. Leituras prioritárias (páginas HTML) debitam do
+    mesmo balde, mas só esperam pelo próprio tráfego prioritário: nunca ficam atrás de imagens.
+    """
+
+    def __init__(self, rate=0, host_rates=None):
+        self.lock = Lock()
+        self.set_limits(rate, host_rates)
+
+    def set_limits(self, rate, host_rates=None):
+        """Altera os limites (bytes/s; 0 = sem limite), inclusive no meio de uma execução"""
+        with self.lock:
+            self.rate = max(int(rate), 0)
+            # Padrões fnmatch de host -> bytes/s (o primeiro que casar vale)
+            self.host_rates = {pattern.lower(): max(int(value), 0) for pattern, value in (host_rates or {}).items()}
+            self.buckets = {} # chave -> [saldo, instante da última atualização]
+            self._host_rate_cache = {}
+
+    @property
+    def active(self):
+        return bool(self.rate or any(self.host_rates.values()))
+
+    def chunk_size(self, default):
+        """Chunk de leitura: com limite, ~BANDWIDTH_SLICE segundos do menor limite"""
+        rates = [rate for rate in (self.rate, *self.host_rates.values()) if rate]
+        if not rates:
+            return default
+        return max(min(default, int(min(rates) * BANDWIDTH_SLICE)), BANDWIDTH_MIN_CHUNK)
+
+    def _host_rate(self, host):
+        rate = self._host_rate_cache.get(host)
+        if rate is None:
+            rate = next((value for pattern, value in self.host_rates.items() if fnmatch.fnmatch(host, pattern)), 0)
+            self._host_rate_cache[host] = rate
+        return rate
+
+    def _reserve(self, key, rate, nbytes, now):
+        """Debita do balde e retorna a espera (s) até o saldo voltar a zero"""
+        burst = rate * BANDWIDTH_BURST
+        bucket = self.buckets.get(key)
+        if bucket is None:
+            bucket = self.buckets[key] = [burst, now]
+        balance = min(bucket[0] + (now - bucket[1]) * rate, burst) - nbytes
+        bucket[0], bucket[1] = balance, now
+        return -balance / rate if balance < 0 else 0.0
+
+    def consume(self, nbytes, host='', priority=False):
+        """Registra nbytes lidos; retorna quantos segundos o chamador deve esperar (0 = segue)"""
+        with self.lock:
+            if not self.rate and not self.host_rates:
+                return 0.0
+            limits = [(None, self.rate)] if self.rate else []
+            host_rate = self._host_rate(host.lower()) if host and self.host_rates else 0
+            if host_rate:
+                limits.append((host, host_rate))
+            now = time.monotonic()
+            delay = 0.0
+            for key, rate in limits:
+                wait = self._reserve(key, rate, nbytes, now)
+                if priority:
+                    wait = self._reserve((key, 'priority'), rate, nbytes, now)
+                delay = max(delay, wait)
+        return delay
+
+
+class RunMetrics:
+    """
+    Métricas de execução com baixo overhead: contadores, gauges e histogramas de latência
+    por estágio e por host. Exportadas periodicamente em JSON e no formato texto do Prometheus.
+    """
+
+    BUCKETS = (0.001, 0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1.0, 2.5, 5.0, 10.0, 30.0) # Segundos
+
+    def __init__(self):
+        self.lock = Lock() # Um único lock curto por atualização; sem alocação no caminho quente
+        self.started = time.time()
+        self.counters = {}   # (nome, host/label) -> valor
+        self.gauges = {}     # nome -> valor
+        self.histograms = {} # (estágio, host) -> [contagens por bucket..., +Inf, soma, total]
+        self._last_rate_sample = (time.monotonic(), 0)
+        self.bytes_per_sec = 0.0
+
+    def incr(self, name, value=1, label=''):
+        key = (name, label)
+        with self.lock:
+            self.counters[key] = self.counters.get(key, 0) + value
+
+    def gauge_add(self, name, delta):
+        with self.lock:
+            self.gauges[name] = self.gauges.get(name, 0) + delta
+
+    def gauge_set(self, name, value):
+        with self.lock:
+            self.gauges[name] = value
+
+    def observe(self, stage, seconds, host=''):
+        """Registra a duração de um estágio (download, parse, escrita...) para um host"""
+        key = (stage, host)
+        index = bisect.bisect_left(self.BUCKETS, seconds)
+        with self.lock:
+            hist = self.histograms.get(key)
+            if hist is None:
+                hist = self.histograms[key] = [0] * (len(self.BUCKETS) + 3)
+            hist[index] += 1
+            hist[-2] += seconds
+            hist[-1] += 1
+
+    def _quantile(self, hist, q):
+        """Quantil aproximado (limite superior do bucket) de um histograma"""
+        target = q * hist[-1]
+        running = 0
+        for i, count in enumerate(hist[:len(self.BUCKETS) + 1]):
+            running += count
+            if running >= target and count:
+                return self.BUCKETS[i] if i < len(self.BUCKETS) else float('inf')
+        return 0.0
+
+    def sample_rates(self):
+        """Atualiza o gauge de bytes/s a partir do contador de bytes (chamado pelo exportador)"""
+        now = time.monotonic()
+        with self.lock:
+            total = sum(v for (name, _), v in self.counters.items() if name == 'bytes_downloaded')
+            last_time, last_total = self._last_rate_sample
+            if now > last_time:
+                self.bytes_per_sec = (total - last_total) / (now - last_time)
+            self._last_rate_sample = (now, total)
+            self.gauges['bytes_per_second'] = round(self.bytes_per_sec, 1)
+
+    def snapshot(self):
+        """Cópia serializável (JSON) das métricas atuais"""
+        with self.lock:
+            counters = {}
+            for (name, label), value in self.counters.items():
+                counters.setdefault(name, {})[label or 'all'] = value
+            stages = {}
+            for (stage, host), hist in self.histograms.items():
+                count = hist[-1]
+                stages.setdefault(stage, {})[host or 'all'] = {
+                    'count': count,
+                    'sum_s': round(hist[-2], 6),
+                    'avg_ms': round(hist[-2] / count * 1000, 3) if count else 0,
+                    'p50_ms': self._quantile(hist, 0.50) * 1000,
+                    'p99_ms': self._quantile(hist, 0.99) * 1000,
+                }
+            return {
+                'uptime_s': round(time.time() - self.started, 3),
+                'counters': counters,
+                'gauges': dict(self.gauges),
+                'stages': stages,
+            }
+
+    def to_prometheus(self):
+        """Métricas no formato de exposição texto do Prometheus"""
+        lines = []
+        with self.lock:
+            for (name, label), value in sorted(self.counters.items()):
+                labels = f'{{label="{label}"}}' if label else ''
+                lines.append(f"image_downloader_{name}_total{labels} {value}")
+            for name, value in sorted(self.gauges.items()):
+                lines.append(f"image_downloader_{name} {value}")
+            for (stage, host), hist in sorted(self.histograms.items()):
+                base = f'stage="{stage}",host="{host}"'
+                running = 0
+                for bound, count in zip(self.BUCKETS + ('+Inf',), hist):
+                    running += count
+                    lines.append(f'image_downloader_stage_seconds_bucket{{{base},le="{bound}"}} {running}')
+                lines.append(f"image_downloader_stage_seconds_sum{{{base}}} {hist[-2]:.6f}")
+                lines.append(f"image_downloader_stage_seconds_count{{{base}}} {hist[-1]}")
+        return '\n'.join(lines) + '\n'
+
+    def write_files(self, json_path, prom_path):
+        """Grava os dois arquivos de forma atômica (quem lê nunca vê arquivo pela metade)"""
+        for path, content in ((json_path, json.dumps(self.snapshot(), indent=2)), (prom_path, self.to_prometheus())):
+            tmp_path = path + '.tmp'
+            with open(tmp_path, 'w', encoding='utf-8') as f:
+                f.write(content)
+            os.replace(tmp_path, path)
+
+    def summary_lines(self):
+        """Resumo legível por estágio (agregado entre hosts) para o log final"""
+        totals = {}
+        with self.lock:
+            for (stage, host), hist in self.histograms.items():
+                agg = totals.setdefault(stage, [0] * (len(self.BUCKETS) + 3))
+                for i, value in enumerate(hist):
+                    agg[i] += value
+        lines = []
+        for stage, hist in sorted(totals.items()):
+            count = hist[-1]
+            if count:
+                lines.append(f"{stage}: n={count} avg={hist[-2] / count * 1000:.1f}ms "
+                             f"p50<={self._quantile(hist, 0.5) * 1000:.0f}ms p99<={self._quantile(hist, 0.99) * 1000:.0f}ms "
+                             f"total={hist[-2]:.2f}s")
+        return lines
+
+
+class ConcurrencyTuner:
+    """
+    Limite de concorrência ajustado em tempo de execução (AIMD guiado pela vazão).
+
+    A cada janela de AUTOTUNE_WINDOW segundos compara vazão, latência média das tarefas e
+    taxa de congestionamento (timeouts, 429/503, conexões recusadas) com a janela anterior:
+    erros acima de AUTOTUNE_ERROR_RATE reduzem o limite multiplicativamente; vazão subindo
+    aumenta o limite (passos grandes até a primeira redução, depois +1); vazão caindo após
+    um aumento volta para o melhor limite visto; latência inflada sem ganho de vazão reduz.
+    Desabilitado, o limite fica fixo no valor inicial.
+    """
+
+    def __init__(self, name, initial, minimum, maximum, enabled=True):
+        self.name = name
+        self.enabled = enabled
+        if not enabled:
+            minimum = maximum = initial
+        self.minimum = max(int(minimum), 1)
+        self.maximum = max(int(maximum), self.minimum)
+        self.limit = min(max(int(initial), self.minimum), self.maximum)
+        self.lock = Lock() # record() é chamado pelas threads de worker
+        self.window_start = time.monotonic()
+        self.window_units = 0
+        self.done = 0
+        self.errors = 0
+        self.latency_sum = 0.0
+        self.starved = False
+        self.windows = 0 # Janelas avaliadas (0 = nada aprendido)
+        self.prev_throughput = None
+        self.base_latency = None
+        self.best_throughput = 0.0
+        self.best_limit = self.limit
+        self.slow_start = True
+        self.last_direction = 0
+
+    def record(self, seconds, congested=False):
+        """Registra uma tarefa concluída (duração e se ela viu sinais de congestionamento)"""
+        with self.lock:
+            self.done += 1
+            self.latency_sum += seconds
+            if congested:
+                self.errors += 1
+
+    def note_starved(self):
+        """O loop não tinha trabalho para preencher o limite (a vazão não reflete a concorrência)"""
+        self.starved = True
+
+    def update(self, total_units):
+        """
+        Fecha a janela de medição, se já passou AUTOTUNE_WINDOW, e ajusta o limite.
+        :param total_units: Total acumulado da unidade de vazão (bytes baixados, páginas processadas).
+        :return: (limite anterior, novo limite, motivo) se o limite mudou, senão None.
+        """
+        if not self.enabled:
+            return None
+        now = time.monotonic()
+        with self.lock:
+            elapsed = now - self.window_start
+            if elapsed < AUTOTUNE_WINDOW or not self.done:
+                return None
+            done, errors, latency_sum, starved = self.done, self.errors, self.latency_sum, self.starved
+            self.done = self.errors = 0
+            self.latency_sum = 0.0
+            self.starved = False
+            self.window_start = now
+
+        throughput = (total_units - self.window_units) / elapsed
+        self.window_units = total_units
+        latency = latency_sum / done
+        error_rate = errors / done
+        self.windows += 1
+        old = self.limit
+        if self.base_latency is None or latency < self.base_latency:
+            self.base_latency = latency
+
+        if error_rate > AUTOTUNE_ERROR_RATE:
+            self.slow_start = False
+            new, reason = int(old * AUTOTUNE_DECREASE), f"congestion on {error_rate:.0%} of tasks"
+        elif starved:
+            self.prev_throughput = None # Janela sem trabalho suficiente: recomeça a comparação
+            return None
+        else:
+            if throughput > self.best_throughput:
+                self.best_throughput, self.best_limit = throughput, old
+            prev, self.prev_throughput = self.prev_throughput, throughput
+            if prev is None or throughput > prev * (1 + AUTOTUNE_GAIN):
+                new, reason = old + (max(1, old // 2) if self.slow_start else 1), "throughput rising"
+            elif throughput < prev * (1 - AUTOTUNE_GAIN) and self.last_direction > 0:
+                self.slow_start = False
+                new = self.best_limit if self.best_limit < old else old - 1
+                new, reason = max(new, int(old * AUTOTUNE_DECREASE)), "throughput dropped after increase"
+            elif latency > self.base_latency * AUTOTUNE_LATENCY_FACTOR:
+                self.slow_start = False
+                new, reason = old - 1, "latency rising without throughput gain"
+            else:
+                new, reason = old + 1, "probing"
+
+        new = min(max(new, self.minimum), self.maximum)
+        self.last_direction = (new > old) - (new < old)
+        if new == old:
+            return None
+        self.limit = new
+        return old, new, reason
+
+    @staticmethod
+    def load_learned(domain_name):
+        """Limites aprendidos em execuções anteriores para o domínio ({} se não houver)"""
+        try:
+            with open(TUNING_FILE, 'r', encoding='utf-8') as f:
+                return json.load(f).get(domain_name, {})
+        except (OSError, ValueError):
+            return {}
+
+    @staticmethod
+    def save_learned(domain_name, tuners):
+        """Grava (atomicamente) o melhor limite de cada tuner que chegou a avaliar alguma janela"""
+        learned = {tuner.name: tuner.best_limit for tuner in tuners if tuner.windows}
+        if not learned:
+            return None
+        try:
+            with open(TUNING_FILE, 'r', encoding='utf-8') as f:
+                data = json.load(f)
+        except (OSError, ValueError):
+            data = {}
+        learned['updated'] = time.time()
+        data.setdefault(domain_name, {}).update(learned)
+        os.makedirs(os.path.dirname(TUNING_FILE), exist_ok=True)
+        tmp_path = TUNING_FILE + '.tmp'
+        with open(tmp_path, 'w', encoding='utf-8') as f:
+            json.dump(data, f, indent=4)
+        os.replace(tmp_path, TUNING_FILE)
+        return learned
+
+
+def parse_retry_after(response):
+    """Segundos pedidos pelo header Retry-After (número ou data HTTP), ou None"""
+    value = response.headers.get('Retry-After') if response is not None else None
+    if not value:
+        return None
+    value = value.strip()
+    if value.isdigit():
+        return float(value)
+    try:
+        return max((parsedate_to_datetime(value) - datetime.now(timezone.utc)).total_seconds(), 0.0)
+    except (TypeError, ValueError):
+        return None
+
+
+class DeferredRetryQueue:
+    """
+    Retentativas de download adiadas, com backoff exponencial (e jitter).
+    Os workers só agendam (push num heap, sem dormir); quem consome é o loop coordenador,
+    que pega as URLs vencidas junto com as novas e dorme só até a próxima vencer.
+    """
+
+    def __init__(self, max_attempts=DOWNLOAD_RETRIES, base_delay=RETRY_BACKOFF_BASE, max_delay=RETRY_BACKOFF_MAX):
+        self.max_attempts = max_attempts
+        self.base_delay = base_delay
+        self.max_delay = max_delay
+        self.lock = Lock()
+        self._heap = [] # (vencimento, seq, url)
+        self._seq = 0
+        self.attempts = {} # url -> retentativas já agendadas
+        self.parks = {} # url -> vezes estacionada (disjuntor aberto)
+
+    def __len__(self):
+        return len(self._heap)
+
+    def _push(self, url, due):
+        heapq.heappush(self._heap, (due, self._seq, url))
+        self._seq += 1
+
+    def schedule(self, url, retry_after=None):
+        """
+        Agenda mais uma tentativa da URL.
+        :return: Atraso em segundos, ou None se as tentativas se esgotaram.
+        """
+        with self.lock:
+            attempt = self.attempts.get(url, 0) + 1
+            if attempt > self.max_attempts:
+                return None
+            self.attempts[url] = attempt
+            delay = min(self.base_delay * 2 ** (attempt - 1), self.max_delay) * random.uniform(0.5, 1.0)
+            if retry_after is not None:
+                delay = max(delay, min(retry_after, self.max_delay))
+            self._push(url, time.monotonic() + delay)
+            return delay
+
+    def park(self, url, due, max_parks=BREAKER_MAX_PARKS):
+        """
+        Reinsere a URL para um instante futuro sem gastar tentativa (host com circuito aberto).
+        :return: False (e não reinsere) se a URL já foi estacionada max_parks vezes.
+        """
+        with self.lock:
+            parks = self.parks.get(url, 0) + 1
+            if parks > max_parks:
+                return False
+            self.parks[url] = parks
+            self._push(url, due)
+            return True
+
+    def pop_due(self):
+        """Próxima URL cujo backoff já venceu, ou None"""
+        with self.lock:
+            if self._heap and self._heap[0][0] <= time.monotonic():
+                return heapq.heappop(self._heap)[2]
+            return None
+
+    def next_due_in(self):
+        """Segundos até a próxima retentativa vencer (None se a fila está vazia)"""
+        with self.lock:
+            return max(self._heap[0][0] - time.monotonic(), 0.0) if self._heap else None
+
+    def drain(self):
+        """Remove e retorna as URLs ainda pendentes (usado no stop)"""
+        with self.lock:
+            urls = [item[2] for item in self._heap]
+            self._heap.clear()
+            return urls
+
+
+class HostCircuitBreaker:
+    """
+    Disjuntor por host: após BREAKER_FAILURE_THRESHOLD falhas transitórias seguidas o host
+    fica "aberto" (nenhuma requisição) por um cooldown; vencido o cooldown, uma única
+    requisição de teste passa (meio-aberto). Sucesso fecha o disjuntor; falha reabre com o
+    dobro do cooldown. Depois de BREAKER_MAX_TRIPS aberturas o host é dado como fora do ar.
+    """
+
+    def __init__(self, threshold=BREAKER_FAILURE_THRESHOLD, cooldown=BREAKER_COOLDOWN, max_trips=BREAKER_MAX_TRIPS):
+        self.threshold = threshold
+        self.cooldown = cooldown
+        self.max_trips = max_trips
+        self.lock = Lock()
+        self.hosts = {} # host -> {'failures', 'trips', 'open_until', 'probing'}
+
+    def _state(self, host):
+        state = self.hosts.get(host)
+        if state is None:
+            state = self.hosts[host] = {'failures': 0, 'trips': 0, 'open_until': 0.0, 'probing': False}
+        return state
+
+    def allow(self, host, url=None):
+        """
+        True se uma requisição para o host pode sair agora (inclui a requisição de teste).
+        A URL de teste fica registrada: end_probe(host, url) a libera se ela terminar sem
+        sucesso nem falha registrados (arquivo já existente, URL descartada...).
+        """
+        with self.lock:
+            state = self.hosts.get(host)
+            if state is None or not state['open_until']:
+                return True # Fechado
+            if state['probing'] or time.monotonic() < state['open_until']:
+                return False
+            state['probing'] = url or True # Meio-aberto: deixa passar uma única requisição de teste
+            return True
+
+    def end_probe(self, host, url):
+        """Fim do download de url: se era o teste e ninguém o resolveu, o próximo pedido vira o novo teste"""
+        with self.lock:
+            state = self.hosts.get(host)
+            if state is not None and state['probing'] == url:
+                state['probing'] = False
+
+    def retry_at(self, host):
+        """Instante (monotonic) em que vale a pena tentar o host de novo"""
+        with self.lock:
+            state = self._state(host)
+            if state['probing']:
+                return time.monotonic() + BREAKER_PROBE_WAIT # Teste em andamento: checa de novo logo
+            return state['open_until']
+
+    def is_dead(self, host):
+        with self.lock:
+            state = self.hosts.get(host)
+            return state is not None and state['trips'] >= self.max_trips
+
+    def record_success(self, host):
+        with self.lock:
+            state = self.hosts.get(host)
+            if state is not None:
+                state.update(failures=0, trips=0, open_until=0.0, probing=False)
+
+    def record_failure(self, host):
+        """
+        Registra uma falha transitória.
+        :return: True se esta falha abriu (ou reabriu) o disjuntor.
+        """
+        with self.lock:
+            state = self._state(host)
+            state['failures'] += 1
+            if not state['probing'] and (state['open_until'] or state['failures'] < self.threshold):
+                return False
+            state['probing'] = False
+            state['open_until'] = time.monotonic() + self.cooldown * 2 ** state['trips']
+            state['trips'] += 1
+            return True
+
+
+class HostSlots:
+    """
+    Orçamento de downloads simultâneos por host na fase de download. Origens HTML (em geral
+    lentas) têm um teto menor que hosts só de imagens (CDNs); URLs de um host no teto esperam
+    aqui enquanto os workers livres pegam URLs de outros hosts. Quando só sobram URLs de hosts
+    no teto, elas passam assim mesmo: o teto ordena o trabalho, não deixa worker ocioso.
+    """
+
+    def __init__(self, limit_for):
+        self.limit_for = limit_for # host -> teto (0 = sem teto)
+        self.lock = Lock()
+        self.limits = {}
+        self.active = {} # host -> downloads em andamento
+        self.waiting = {} # host -> deque de URLs esperando vaga
+        self.held = 0 # URLs que tiveram de esperar vaga
+
+    def _full(self, host):
+        limit = self.limits.get(host)
+        if limit is None:
+            limit = self.limits[host] = self.limit_for(host)
+        return bool(limit) and self.active.get(host, 0) >= limit
+
+    def acquire(self, host, url):
+        """Reserva uma vaga no host; sem vaga, url fica esperando e retorna False"""
+        with self.lock:
+            if self._full(host):
+                self.waiting.setdefault(host, deque()).append(url)
+                self.held += 1
+                return False
+            self.active[host] = self.active.get(host, 0) + 1
+            return True
+
+    def release(self, host):
+        with self.lock:
+            self.active[host] -= 1
+
+    def pop_ready(self, overflow=False):
+        """
+        URL que estava esperando um host que voltou a ter vaga, já com a vaga reservada.
+        overflow: sem host com vaga, pega do host com menos downloads em andamento.
+        :return: URL ou None
+        """
+        with self.lock:
+            chosen = None
+            for host in self.waiting:
+                if not self._full(host):
+                    chosen = host
+                    break
+                if overflow and (chosen is None or self.active.get(host, 0) < self.active.get(chosen, 0)):
+                    chosen = host
+            if chosen is None:
+                return None
+            urls = self.waiting[chosen]
+            url = urls.popleft()
+            if not urls:
+                del self.waiting[chosen]
+            self.active[chosen] = self.active.get(chosen, 0) + 1
+            return url
+
+
+class PublicSuffixList:
+    """
+    Regras da Public Suffix List (normais, curinga '*.' e exceção '!'), com as seções ICANN e
+    privada: o domínio registrável de blog.example.co.uk é example.co.uk, e a.github.io e
+    b.github.io são sites diferentes.
+    """
+
+    _loaded = None # (caminho, lista) carregada uma vez por processo
+    _load_lock = Lock()
+
+    def __init__(self, lines):
+        self.rules, self.wildcards, self.exceptions = set(), set(), set()
+        for line in lines:
+            rule = line.split(None, 1)[0].lower() if line.strip() else ''
+            if not rule or rule.startswith('//'):
+                continue
+            rule = rule.encode('idna').decode('ascii') if not rule.isascii() else rule # Hosts chegam em punycode
+            if rule.startswith('!'):
+                self.exceptions.add(rule[1:])
+            elif rule.startswith('*.'):
+                self.wildcards.add(rule[2:])
+            else:
+                self.rules.add(rule)
+
+    @classmethod
+    def load(cls, paths=PUBLIC_SUFFIX_LIST_PATHS):
+        """A lista do primeiro arquivo legível de paths, ou None se nenhum existir"""
+        with cls._load_lock:
+            if cls._loaded is None or cls._loaded[0] != paths:
+                psl = None
+                for path in paths:
+                    try:
+                        with open(path, 'r', encoding='utf-8') as f:
+                            psl = cls(f)
+                        break
+                    except (OSError, UnicodeError):
+                        continue
+                if psl is None:
+                    logging.warning(f"Public Suffix List not found ({', '.join(paths)}): scope is the start host and its subdomains")
+                cls._loaded = (paths, psl)
+            return cls._loaded[1]
+
+    def public_suffix_length(self, labels):
+        """Quantos rótulos finais de labels formam o sufixo público (a regra mais longa vence; padrão '*': 1)"""
+        for i in range(len(labels)):
+            name = '.'.join(labels[i:])
+            if name in self.exceptions:
+                return len(labels) - i - 1 # !www.ck: o sufixo é ck
+            if name in self.rules or '.'.join(labels[i + 1:]) in self.wildcards:
+                return len(labels) - i # *.ck: qualquer x.ck é sufixo
+        return 1
+
+    def registrable_domain(self, host):
+        """Sufixo público + um rótulo; None para IPs e para hosts que são eles mesmos sufixo público"""
+        host = host.rstrip('.').lower()
+        if not host or _is_ip_address(host):
+            return None
+        labels = host.split('.')
+        length = self.public_suffix_length(labels)
+        if length >= len(labels):
+            return None
+        return '.'.join(labels[-length - 1:])
+
+
+class CrawlScope:
+    """
+    Escopo de uma execução. Páginas: hosts do mesmo domínio registrável da URL inicial, pela
+    Public Suffix List (blog.example.com cobre www.example.com e shop.example.com; a.github.io não
+    cobre b.github.io). Sem a lista, o host inicial (sem o 'www.') e seus subdomínios, comparados
+    por rótulo para que nomes parecidos como evilexample.com fiquem de fora.
+    Imagens: de qualquer host (CDNs). deny_hosts vale para páginas e imagens e vence o allow.
+    Os padrões são fnmatch comparados com o host sem a porta ('*.example.net', 'cdn?.example.com').
+    """
+
+    def __init__(self, start_url, allow_hosts=SCOPE_ALLOW_HOSTS, deny_hosts=SCOPE_DENY_HOSTS, public_suffixes=None):
+        """public_suffixes: PublicSuffixList (padrão: PublicSuffixList.load()); False força o escopo por host"""
+        self.public_suffixes = PublicSuffixList.load() if public_suffixes is None else public_suffixes or None
+        host = (urlparse(start_url).hostname or '').rstrip('.')
+        site = self.public_suffixes.registrable_domain(host) if self.public_suffixes else None
+        if site is None: # Sem a lista, IP ou o próprio host é sufixo público
+            site = host[4:] if host.startswith('www.') and '.' in host[4:] else host # www.example.com cobre os outros subdomínios
+        self.site = site
+        self.allow_hosts = [pattern.lower() for pattern in allow_hosts]
+        self.deny_hosts = [pattern.lower() for pattern in deny_hosts]
+        self._verdicts = {} # netloc -> (página permitida, imagem permitida); escrita idempotente, sem lock
+
+    def _verdict(self, netloc):
+        verdict = self._verdicts.get(netloc)
+        if verdict is None:
+            try:
+                host = urlparse('//' + netloc).hostname or '' # Sem usuário/porta
+            except ValueError:
+                host = '' # IPv6 malformado
+            allowed = bool(host) and not any(fnmatch.fnmatchcase(host, pattern) for pattern in self.deny_hosts)
+            host = host.rstrip('.')
+            page = allowed and (self._same_site(host) or any(fnmatch.fnmatchcase(host, pattern) for pattern in self.allow_hosts))
+            verdict = self._verdicts[netloc] = (page, allowed)
+        return verdict
+
+    def _same_site(self, host):
+        if host != self.site and not host.endswith('.' + self.site):
+            return False
+        # Subdomínio que é ele mesmo um sufixo privado (ex.: site.example.com sob *.example.com na lista)
+        return self.public_suffixes is None or host == self.site or self.public_suffixes.registrable_domain(host) == self.site
+
+    def allows_page(self, netloc):
+        """True se páginas do host (netloc, com ou sem porta) fazem parte do crawl"""
+        return self._verdict(netloc.lower())[0]
+
+    def allows_image(self, netloc):
+        """True se imagens do host podem ser baixadas"""
+        return self._verdict(netloc.lower())[1]
+
+
+class UrlCanonicalizer:
+    """
+    Forma canônica das URLs de página, para que variações da mesma página contem uma vez só
+    em processed_urls: remove parâmetros de rastreamento/sessão, ordena os parâmetros e
+    aplica regras por domínio. Os pedaços da query são mantidos byte a byte (sem re-encode).
+
+    Regras por domínio (config.json, chave url_rules), aplicadas ao domínio e subdomínios:
+        {"exemplo.com": {"strip_params": ["ref"], "keep_params": ["id", "page"], "sort_params": true}}
+    keep_params, se presente, é uma lista branca: os demais parâmetros são descartados.
+    """
+
+    def __init__(self, strip_params=TRACKING_PARAMS, sort_params=CANONICAL_SORT_PARAMS, url_rules=None):
+        self.strip_params = list(strip_params) # Padrões fnmatch, comparados em minúsculas
+        self.sort_params = sort_params
+        self.url_rules = dict(url_rules or {})
+
+    def rule_for(self, host):
+        """Regra do domínio mais específico que casa com o host ({} se nenhuma)"""
+        best = None
+        for domain in self.url_rules:
+            domain_lower = domain.lower()
+            if (host == domain_lower or host.endswith('.' + domain_lower)) and (best is None or len(domain) > len(best)):
+                best = domain
+        return self.url_rules[best] if best is not None else {}
+
+    def canonical_path(self, path):
+        # IDs de sessão embutidos no path (;jsessionid=...) também geram páginas "novas"
+        return SESSION_PATH_PARAM_RE.sub('', path)
+
+    def canonical_query(self, host, query):
+        if not query:
+            return ''
+        rule = self.rule_for(host)
+        strip = self.strip_params + [p.lower() for p in rule.get('strip_params', [])]
+        keep = rule.get('keep_params')
+        if keep is not None:
+            keep = {p.lower() for p in keep} # Comparado com nomes já em minúsculas
+        kept = []
+        for piece in query.split('&'):
+            if not piece:
+                continue
+            name = unquote_plus(piece.split('=', 1)[0]).lower()
+            if any(fnmatch.fnmatchcase(name, pattern) for pattern in strip):
+                continue
+            if keep is not None and name not in keep:
+                continue
+            kept.append(piece)
+        if rule.get('sort_params', self.sort_params):
+            kept.sort()
+        return '&'.join(kept)
+
+
+class TrapDetector:
+    """
+    Detecta armadilhas de crawler (calendários infinitos, paginação sem fim, paths que se
+    repetem) antes de gastar uma requisição:
+      - segmento de path repetido mais de TRAP_MAX_SEGMENT_REPEATS vezes ou path fundo demais;
+      - query com parâmetros demais (ou o mesmo parâmetro repetido);
+      - mais de max_per_template URLs com o mesmo "molde" (números/IDs trocados por
+        marcadores e só os nomes dos parâmetros), que limita o número de fetches por padrão.
+
+    O limite é adaptativo: cada página do molde que rendeu imagens novas ou links para
+    outros moldes (record_yield) libera mais um fetch. Um catálogo real (/produto/{n} com
+    fotos) continua andando; um calendário que só aponta para o mês seguinte para no limite.
+    """
+
+    def __init__(self, max_per_template=TRAP_MAX_PER_TEMPLATE):
+        self.max_per_template = max_per_template # 0 = sem limite por molde
+        self.lock = Lock()
+        self.template_counts = {}
+        self.capped_templates = {} # molde -> URLs puladas pelo limite (resumo no fim do scan)
+        self.productive = {} # molde -> páginas que renderam imagens ou links novos (fetches extras)
+        self.skipped = 0
+
+    @staticmethod
+    def template_of(parsed):
+        """Molde da URL: host + path com números/IDs genéricos + nomes (ordenados) dos parâmetros"""
+        segments = ['{id}' if TRAP_ID_SEGMENT_RE.match(seg) else TRAP_NUMBER_RE.sub('{n}', seg) for seg in parsed.path.split('/')]
+        names = sorted({piece.split('=', 1)[0] for piece in parsed.query.split('&') if piece})
+        return f"{parsed.netloc}{'/'.join(segments)}?{'&'.join(names)}"
+
+    def check(self, url):
+        """
+        Registra a URL que está para ser buscada.
+        :return: None se pode buscar, ou o motivo (str) se parece uma armadilha.
+        """
+        parsed = urlparse(url)
+        segments = [seg for seg in parsed.path.split('/') if seg]
+        reason = None
+        if len(segments) > TRAP_MAX_PATH_DEPTH:
+            reason = f"path deeper than {TRAP_MAX_PATH_DEPTH} segments"
+        elif segments and max(segments.count(seg) for seg in set(segments)) > TRAP_MAX_SEGMENT_REPEATS:
+            reason = "repeating path segments"
+        else:
+            names = [piece.split('=', 1)[0] for piece in parsed.query.split('&') if piece]
+            if len(names) > TRAP_MAX_QUERY_PARAMS:
+                reason = f"more than {TRAP_MAX_QUERY_PARAMS} query parameters"
+            elif len(names) != len(set(names)):
+                reason = "repeated query parameters"
+
+        with self.lock:
+            if reason is None and self.max_per_template:
+                template = self.template_of(parsed)
+                count = self.template_counts.get(template, 0) + 1
+                self.template_counts[template] = count
+                if count > self.max_per_template + self.productive.get(template, 0):
+                    reason = f"more than {self.max_per_template} URLs matching {template}"
+                    if template in self.capped_templates:
+                        reason = '' # Já avisado: conta, mas não loga de novo
+                    self.capped_templates[template] = self.capped_templates.get(template, 0) + 1
+            if reason is not None:
+                self.skipped += 1
+        return reason
+
+    def record_yield(self, url, new_images, new_links):
+        """Registra o que a página buscada rendeu: imagens novas ou links novos para outro molde liberam um fetch a mais"""
+        template = self.template_of(urlparse(url))
+        productive = new_images > 0 or any(self.template_of(urlparse(link)) != template for link in new_links)
+        if productive:
+            with self.lock:
+                self.productive[template] = self.productive.get(template, 0) + 1
+
+
+class ArchiveWriter:
+    """
+    Saída em contêineres: as imagens são acrescentadas em shards de tamanho limitado
+    (tar, zip ou WARC) em vez de um arquivo por imagem. Uma thread dedicada faz toda a
+    escrita; os workers só entregam o registro (bytes em memória ou o parcial já completo
+    em disco) numa fila limitada, que dá backpressure se o disco não acompanhar, e recebem
+    um Future que só se resolve quando a imagem está no shard (ou com o erro da escrita).
+
+    Cada shard tem um índice lateral <shard>.idx.jsonl com uma linha por imagem:
+    url, name, offset e size dos bytes da imagem dentro do shard (acesso aleatório com
+    seek + read), content_type e, com metadata=True, os headers da resposta.
+    """
+
+    FORMATS = {'tar': 'tar', 'zip': 'zip', 'warc': 'warc'} # modo -> extensão do shard
+
+    def __init__(self, folder, fmt, shard_bytes=ARCHIVE_SHARD_BYTES, metadata=False):
+        self.folder = folder
+        self.fmt = fmt
+        self.ext = self.FORMATS[fmt]
+        self.shard_bytes = shard_bytes
+        self.metadata = metadata
+        self.queue = Queue(maxsize=ARCHIVE_QUEUE_SIZE)
+        self.closed = False # Depois do close() a fila não tem mais leitor: submit recusa
+        self.submit_lock = Lock()
+        self.next_index = self._next_shard_index()
+        self.shard_path = None
+        self.container = None # TarFile/ZipFile/arquivo .warc aberto
+        self.index_file = None
+        self.shard_size = 0
+        self.records = 0
+        self.shards_written = []
+        self.thread = Thread(target=self._run, name='archive-writer', daemon=True)
+
+    @staticmethod
+    def existing_url_hashes(folder):
+        """Hashes de URL das imagens já gravadas em shards (lidos dos índices laterais)"""
+        hashes = set()
+        for name in os.listdir(folder):
+            if not name.endswith(ARCHIVE_INDEX_SUFFIX):
+                continue
+            with open(os.path.join(folder, name), 'r', encoding='utf-8') as f:
+                for line in f:
+                    try:
+                        hashes.add(url_hash(json.loads(line)['url']))
+                    except (ValueError, KeyError):
+                        continue # Linha truncada (execução interrompida no meio da escrita)
+        return hashes
+
+    def _next_shard_index(self):
+        # Nunca reabre um shard antigo: cada execução começa um novo
+        indexes = [int(m.group(1)) for m in map(ARCHIVE_SHARD_RE.match, os.listdir(self.folder)) if m]
+        return max(indexes) + 1 if indexes else 0
+
+    def start(self):
+        self.thread.start()
+        return self
+
+    def submit(self, name, url, data=None, path=None, response=None):
+        """
+        Entrega uma imagem completa para a thread de escrita (bloqueia se a fila estiver cheia).
+        data: bytes da imagem, ou path: arquivo completo em disco (removido só depois de copiado).
+        :return: Future resolvido quando a imagem está no shard (com a exceção se a escrita falhar;
+                 path continua então do chamador), ou None se o writer já foi fechado
+        """
+        headers = dict(response.headers) if response is not None else {}
+        record = {
+            'name': name, 'url': url, 'data': data, 'path': path,
+            'status': response.status_code if response is not None else 200,
+            'reason': response.reason if response is not None else 'OK',
+            'headers': headers, 'downloaded_at': time.time(),
+            'content_type': response.headers.get('content-type', '') if response is not None else '',
+            'future': Future(),
+        }
+        # O put fica sob o lock: o sentinela do close() nunca entra na frente de um registro aceito.
+        # Fila cheia não trava o close(): a thread de escrita continua esvaziando sem o lock
+        with self.submit_lock:
+            if self.closed:
+                return None
+            self.queue.put(record)
+        return record['future']
+
+    def close(self):
+        """Recusa novos registros, espera a fila esvaziar e fecha o shard atual"""
+        with self.submit_lock:
+            if self.closed:
+                return
+            self.closed = True
+        if self.thread.is_alive():
+            self.queue.put(None)
+            self.thread.join()
+
+    def _run(self):
+        while True:
+            record = self.queue.get()
+            if record is None:
+                break
+            try:
+                self._write(record)
+            except Exception as e: # Um registro com erro não derruba a thread; o worker trata a falha
+                logging.exception(f"Archive writer failed on {record['url']}")
+                record['future'].set_exception(e)
+                continue
+            if record['path']:
+                try: os.remove(record['path'])
+                except OSError: pass
+            record['future'].set_result(True)
+        self._close_shard()
+
+    def _open_shard(self):
+        self.shard_path = os.path.join(self.folder, f"images-{self.next_index:05d}.{self.ext}")
+        self.next_index += 1
+        if self.fmt == 'tar':
+            self.container = tarfile.open(self.shard_path, 'w', format=tarfile.PAX_FORMAT)
+        elif self.fmt == 'zip':
+            self.container = zipfile.ZipFile(self.shard_path, 'w', compression=zipfile.ZIP_STORED) # Imagens já são comprimidas
+        else:
+            self.container = open(self.shard_path, 'wb', buffering=WRITE_BUFFER_SIZE)
+            info = f"software: Image Downloader {APP_VERSION}\r\nformat: WARC File Format 1.1\r\n".encode('utf-8')
+            self._write_warc_record('warcinfo', None, 'application/warc-fields', [info], len(info))
+        self.index_file = open(self.shard_path + ARCHIVE_INDEX_SUFFIX, 'w', encoding='utf-8')
+        self.shard_size = 0
+        self.shards_written.append(self.shard_path)
+
+    def _close_shard(self):
+        if self.container is not None:
+            self.container.close()
+            self.index_file.close()
+            self.container = self.index_file = None
+
+    def _write(self, record):
+        if self.container is None or self.shard_size >= self.shard_bytes:
+            self._close_shard()
+            self._open_shard()
+        size = len(record['data']) if record['data'] is not None else os.path.getsize(record['path'])
+        source = io.BytesIO(record['data']) if record['data'] is not None else open(record['path'], 'rb')
+        with source:
+            if self.fmt == 'tar':
+                offset = self._write_tar(record, source, size)
+            elif self.fmt == 'zip':
+                offset = self._write_zip(record, source, size)
+            else:
+                offset = self._write_warc(record, source, size)
+        entry = {
+            'url': record['url'], 'name': record['name'], 'offset': offset, 'size': size,
+            'content_type': record['content_type'], 'downloaded_at': record['downloaded_at'],
+        }
+        if self.metadata:
+            entry['status'] = record['status']
+            entry['headers'] = record['headers']
+        self.index_file.write(json.dumps(entry) + '\n')
+        self.records += 1
+
+    def _write_tar(self, record, source, size):
+        info = tarfile.TarInfo(record['name'])
+        info.size = size
+        info.mtime = int(record['downloaded_at'])
+        self.container.addfile(info, source)
+        end = self.container.offset
+        self.shard_size = end
+        # Dados começam depois do(s) header(s); o tarfile completa o último bloco de 512 bytes
+        offset = end - ((size + tarfile.BLOCKSIZE - 1) // tarfile.BLOCKSIZE) * tarfile.BLOCKSIZE
+        if self.metadata:
+            meta = json.dumps({'url': record['url'], 'status': record['status'], 'headers': record['headers']}).encode('utf-8')
+            meta_info = tarfile.TarInfo(record['name'] + '.json')
+            meta_info.size = len(meta)
+            meta_info.mtime = info.mtime
+            self.container.addfile(meta_info, io.BytesIO(meta))
+            self.shard_size = self.container.offset
+        return offset
+
+    def _write_zip(self, record, source, size):
+        info = zipfile.ZipInfo(record['name'], time.localtime(record['downloaded_at'])[:6])
+        info.compress_type = zipfile.ZIP_STORED
+        info.file_size = size # Tamanho conhecido: header local definitivo, sem data descriptor
+        info.comment = record['url'].encode('utf-8')
+        with self.container.open(info, 'w') as dest:
+            shutil.copyfileobj(source, dest, CHUNK_SIZE_MAX)
+        # Header local: 30 bytes fixos + nome (ASCII ou UTF-8) + extra; os dados vêm logo depois
+        try:
+            name_length = len(info.filename.encode('ascii'))
+        except UnicodeEncodeError:
+            name_length = len(info.filename.encode('utf-8'))
+        offset = info.header_offset + 30 + name_length + len(info.extra)
+        if self.metadata:
+            meta = json.dumps({'url': record['url'], 'status': record['status'], 'headers': record['headers']})
+            self.container.writestr(record['name'] + '.json', meta)
+        self.shard_size = self.container.fp.tell()
+        return offset
+
+    def _write_warc(self, record, source, size):
+        # Registro response: bloco = resposta HTTP (linha de status + headers + corpo como gravado)
+        headers = record['headers'] if self.metadata else {'Content-Type': record['content_type']}
+        http_head = [f"HTTP/1.1 {record['status']} {record['reason']}"]
+        http_head += [f"{k}: {v}" for k, v in headers.items() if k.lower() not in ('transfer-encoding', 'content-length', 'content-range')]
+        http_head.append(f"Content-Length: {size}")
+        http_head = ('\r\n'.join(http_head) + '\r\n\r\n').encode('latin-1', 'replace')
+        return self._write_warc_record('response', record['url'], 'application/http; msgtype=response',
+                                       [http_head, source], len(http_head) + size, record['downloaded_at'])
+
+    def _write_warc_record(self, warc_type, url, content_type, parts, length, timestamp=None):
+        """Grava um registro WARC/1.1; retorna o offset do último pedaço (o corpo da imagem)"""
+        f = self.container
+        warc_headers = [
+            "WARC/1.1",
+            f"WARC-Type: {warc_type}",
+            f"WARC-Record-ID: <urn:uuid:{uuid.uuid4()}>",
+            f"WARC-Date: {datetime.fromtimestamp(timestamp or time.time(), timezone.utc).strftime('%Y-%m-%dT%H:%M:%SZ')}",
+        ]
+        if url:
+            warc_headers.append(f"WARC-Target-URI: {url}")
+        warc_headers += [f"Content-Type: {content_type}", f"Content-Length: {length}"]
+        f.write(('\r\n'.join(warc_headers) + '\r\n\r\n').encode('utf-8'))
+        offset = f.tell()
+        for part in parts:
+            offset = f.tell()
+            if isinstance(part, bytes):
+                f.write(part)
+            else:
+                shutil.copyfileobj(part, f, CHUNK_SIZE_MAX)
+        f.write(b'\r\n\r\n')
+        self.shard_size = f.tell()
+        return offset
+
+
+class InvalidImageError(ValueError):
+    """Imagem que não decodifica (truncada/corrompida); levantada pela validação do pós-processamento"""
+
+
+def postprocess_validate(path, options):
+    """
+    Valida a imagem decodificando-a por inteiro com Pillow. Sem Pillow, confere só o
+    marcador de fim do formato (pega a maioria dos arquivos truncados).
+    """
+    try:
+        from PIL import Image
+    except ImportError:
+        Image = None
+    if Image is not None:
+        try:
+            with Image.open(path) as img:
+                img.verify()
+            with Image.open(path) as img:
+                img.load() # verify() não decodifica os pixels; load() acusa arquivo truncado
+                return {'format': img.format, 'width': img.width, 'height': img.height}
+        except (OSError, SyntaxError, ValueError) as e: # Pillow usa SyntaxError para alguns arquivos ruins
+            raise InvalidImageError(str(e)) from None
+
+    size = os.path.getsize(path)
+    with open(path, 'rb') as f:
+        head = f.read(12)
+        f.seek(max(size - 32, 0))
+        tail = f.read()
+    if head.startswith(b'\xff\xd8'):
+        valid, fmt = b'\xff\xd9' in tail, 'JPEG'
+    elif head.startswith(b'\x89PNG'):
+        valid, fmt = b'IEND' in tail, 'PNG'
+    elif head.startswith(b'GIF8'):
+        valid, fmt = tail.rstrip(b'\0').endswith(b';'), 'GIF'
+    elif head.startswith(b'RIFF') and head[8:12] == b'WEBP':
+        valid, fmt = int.from_bytes(head[4:8], 'little') + 8 <= size, 'WEBP'
+    else:
+        return {'format': None} # Formato sem checagem estrutural
+    if not valid:
+        raise InvalidImageError(f"{fmt} end marker missing (truncated file)")
+    return {'format': fmt}
+
+
+def _derived_path(path, options, kind, ext):
+    folder = os.path.join(options['derived_dir'], kind)
+    os.makedirs(folder, exist_ok=True)
+    return os.path.join(folder, os.path.splitext(os.path.basename(path))[0] + ext)
+
+
+def _require_pillow():
+    try:
+        from PIL import Image
+    except ImportError:
+        raise RuntimeError("Pillow is not installed (pip install Pillow)") from None
+    return Image
+
+
+def postprocess_thumbnail(path, options):
+    """Miniatura JPEG (lado maior = thumbnail_size) em <domínio>/derived/thumbnails/"""
+    Image = _require_pillow()
+    out_path = _derived_path(path, options, 'thumbnails', '.jpg')
+    with Image.open(path) as img:
+        img.thumbnail((options['thumbnail_size'], options['thumbnail_size']))
+        if img.mode not in ('RGB', 'L'):
+            img = img.convert('RGB')
+        img.save(out_path + '.tmp', 'JPEG', quality=85)
+    os.replace(out_path + '.tmp', out_path)
+    return {'thumbnail': out_path}
+
+
+def postprocess_webp(path, options):
+    """Versão WebP em <domínio>/derived/webp/ (imagens que já são WebP são puladas)"""
+    Image = _require_pillow()
+    with Image.open(path) as img:
+        if img.format == 'WEBP':
+            return None
+        out_path = _derived_path(path, options, 'webp', '.webp')
+        img.save(out_path + '.tmp', 'WEBP', quality=options['webp_quality'])
+    os.replace(out_path + '.tmp', out_path)
+    return {'webp': out_path}
+
+
+def postprocess_phash(path, options):
+    """
+    Hash perceptual (dHash de 64 bits): a imagem reduzida a 9x8 em tons de cinza, um bit por
+    par de pixels vizinhos na linha. Reencodes e redimensionamentos mudam poucos bits.
+    """
+    Image = _require_pillow()
+    with Image.open(path) as img:
+        width, height = img.size
+        img.draft('L', (64, 64)) # JPEG: decodifica já reduzida (bem mais rápido); outros formatos ignoram
+        gray = img.convert('L').resize((9, 8), Image.LANCZOS)
+    pixels = list(gray.getdata())
+    value = 0
+    for row in range(8):
+        for col in range(8):
+            value = value << 1 | (pixels[row * 9 + col] > pixels[row * 9 + col + 1])
+    return {'hash': f"{value:016x}", 'width': width, 'height': height}
+
+
+POSTPROCESS_FUNCTIONS = {
+    'validate': postprocess_validate,
+    'thumbnail': postprocess_thumbnail,
+    'webp': postprocess_webp,
+    'phash': postprocess_phash,
+}
+PILLOW_STEPS = ('thumbnail', 'webp', 'phash') # Etapas que não funcionam sem Pillow
+
+
+def run_postprocess(path, steps, options):
+    """
+    Executado nos processos do pool: roda as etapas em ordem sobre um arquivo baixado.
+    Etapas são nomes de POSTPROCESS_FUNCTIONS ou plugins "modulo:funcao" com a mesma
+    assinatura (path, options) -> dict | None.
+    """
+    results = {}
+    for step in steps:
+        func = POSTPROCESS_FUNCTIONS.get(step)
+        if func is None:
+            module_name, _, func_name = step.partition(':')
+            func = getattr(importlib.import_module(module_name), func_name)
+        results[step] = func(path, options)
+    return results
+
+
+class PostProcessor:
+    """
+    Estágio de pós-processamento em um ProcessPoolExecutor (CPU fora do GIL), sobreposto ao
+    download. Os workers de download só fazem put_nowait numa fila limitada: se ela encher,
+    o arquivo fica sem pós-processamento (contado como 'skipped'), mas o download nunca espera.
+    Uma thread alimentadora mantém no máximo 2 tarefas por processo no pool.
+    """
+
+    def __init__(self, steps, options, workers, on_result):
+        self.steps = list(steps)
+        self.options = options
+        self.on_result = on_result # callback(url, path, status, detalhe) chamado fora dos workers de download
+        from concurrent.futures import ProcessPoolExecutor # Só carregado quando há pós-processamento
+        # spawn em todas as plataformas: fork com threads ativas pode travar o filho
+        self.pool = ProcessPoolExecutor(max_workers=workers, mp_context=multiprocessing.get_context('spawn'))
+        self.queue = Queue(maxsize=POSTPROCESS_QUEUE_SIZE)
+        self.slots = Semaphore(workers * 2)
+        self.lock = Lock()
+        self.counts = {'ok': 0, 'invalid': 0, 'error': 0, 'skipped': 0}
+        self.feeder = Thread(target=self._feed, name='postprocess-feeder', daemon=True)
+        self.feeder.start()
+
+    def submit(self, path, url):
+        """Enfileira um arquivo completo; nunca bloqueia (fila cheia = pula o arquivo)"""
+        try:
+            self.queue.put_nowait((path, url))
+            return True
+        except Full:
+            with self.lock:
+                self.counts['skipped'] += 1
+            return False
+
+    def _feed(self):
+        while True:
+            item = self.queue.get()
+            if item is None:
+                break
+            self.slots.acquire()
+            try:
+                future = self.pool.submit(run_postprocess, item[0], self.steps, self.options)
+            except RuntimeError: # Pool já encerrado
+                self.slots.release()
+                break
+            future.add_done_callback(lambda f, item=item: self._done(item, f))
+
+    def _done(self, item, future):
+        self.slots.release()
+        if future.cancelled():
+            return
+        path, url = item
+        error = future.exception()
+        if error is None:
+            status, detail = 'ok', future.result()
+        elif isinstance(error, InvalidImageError):
+            status, detail = 'invalid', str(error)
+        else:
+            status, detail = 'error', f"{type(error).__name__}: {error}"
+        with self.lock:
+            self.counts[status] += 1
+        self.on_result(url, path, status, detail)
+
+    def close(self, cancel=False):
+        """Espera o que está na fila/pool terminar; cancel=True descarta o que ainda não começou"""
+        if cancel:
+            try:
+                while True:
+                    self.queue.get_nowait()
+                    self.counts['skipped'] += 1
+            except Empty:
+                pass
+        self.queue.put(None)
+        self.feeder.join()
+        self.pool.shutdown(wait=True, cancel_futures=cancel)
+        return dict(self.counts)
+
+
+class NearDuplicateIndex:
+    """
+    Índice persistente (por domínio) dos hashes perceptuais das imagens mantidas, para achar
+    variantes da mesma imagem pela distância de Hamming.
+
+    Multi-index hashing em vez de BK-tree: o hash é dividido em PHASH_BANDS faixas e cada faixa
+    indexada num dict. Dois hashes a distância <= threshold têm ao menos uma faixa a distância
+    <= threshold // PHASH_BANDS, então a busca só visita os buckets vizinhos dessas faixas
+    (~1 ms com 1 milhão de hashes; a BK-tree percorre boa parte da árvore com hashes bem
+    distribuídos). Em disco é um JSONL só de acréscimo: {"hash", "url", "file", "width",
+    "height"} para imagens mantidas e {"url", "duplicate_of"} para variantes descartadas.
+    """
+
+    def __init__(self, path, threshold=PHASH_THRESHOLD):
+        self.path = path
+        self.threshold = threshold
+        self.bits = 64 // PHASH_BANDS
+        self.mask = (1 << self.bits) - 1
+        radius = threshold // PHASH_BANDS
+        self.flips = [0] + [sum(1 << bit for bit in bits)
+                            for k in range(1, radius + 1) for bits in combinations(range(self.bits), k)]
+        self.lock = Lock()
+        self.tables = [{} for _ in range(PHASH_BANDS)] # faixa -> bucket -> [posições]
+        self.hashes = []
+        self.records = [] # None = removido (variante descartada depois)
+        self.by_url = {}
+        self.suppressed = {} # url descartada -> url mantida
+        self.file = None
+
+    def load(self):
+        """Carrega o índice do disco e o reescreve compactado se a maior parte for lixo"""
+        lines = 0
+        if os.path.exists(self.path):
+            with open(self.path, 'r', encoding='utf-8') as f:
+                for line in f:
+                    if not line.strip():
+                        continue
+                    entry = json.loads(line)
+                    lines += 1
+                    if 'duplicate_of' in entry:
+                        self._remove(entry['url'])
+                        self.suppressed[entry['url']] = entry['duplicate_of']
+                    else:
+                        self._insert(int(entry.pop('hash'), 16), entry)
+        if lines > 2 * (len(self.by_url) + len(self.suppressed)):
+            self._compact()
+        os.makedirs(os.path.dirname(self.path) or '.', exist_ok=True)
+        self.file = open(self.path, 'a', encoding='utf-8')
+        return self
+
+    def _compact(self):
+        tmp_path = self.path + '.tmp'
+        with open(tmp_path, 'w', encoding='utf-8') as f:
+            for value, record in zip(self.hashes, self.records):
+                if record is not None:
+                    f.write(json.dumps({'hash': f"{value:016x}", **record}) + '\n')
+            for url, kept in self.suppressed.items():
+                f.write(json.dumps({'url': url, 'duplicate_of': kept}) + '\n')
+        os.replace(tmp_path, self.path)
+
+    def _insert(self, value, record):
+        self._remove(record['url'])
+        position = len(self.hashes)
+        self.hashes.append(value)
+        self.records.append(record)
+        self.by_url[record['url']] = position
+        for band, table in enumerate(self.tables):
+            table.setdefault((value >> (band * self.bits)) & self.mask, []).append(position)
+
+    def _remove(self, url):
+        position = self.by_url.pop(url, None)
+        if position is not None:
+            self.records[position] = None # Fica nos buckets; find() ignora
+
+    def find(self, value):
+        """Imagens mantidas a distância <= threshold: lista de (distância, registro)"""
+        matches = {}
+        with self.lock:
+            for band, table in enumerate(self.tables):
+                key = (value >> (band * self.bits)) & self.mask
+                for flip in self.flips:
+                    for position in table.get(key ^ flip, ()):
+                        if position in matches or self.records[position] is None:
+                            continue
+                        distance = (self.hashes[position] ^ value).bit_count()
+                        if distance <= self.threshold:
+                            matches[position] = (distance, self.records[position])
+        return list(matches.values())
+
+    def add(self, value, record):
+        """Registra uma imagem mantida"""
+        with self.lock:
+            self._insert(value, record)
+            self.file.write(json.dumps({'hash': f"{value:016x}", **record}) + '\n')
+
+    def suppress(self, url, duplicate_of):
+        """Registra uma variante descartada (sai do índice; não é baixada de novo)"""
+        with self.lock:
+            self._remove(url)
+            self.suppressed[url] = duplicate_of
+            self.file.write(json.dumps({'url': url, 'duplicate_of': duplicate_of}) + '\n')
+
+    def close(self):
+        if self.file:
+            self.file.close()
+            self.file = None
+
+
+class RunHistory:
+    """Histórico persistente de um domínio: páginas e imagens já vistas em execuções anteriores"""
+
+    def __init__(self, domain_name):
+        self.path = os.path.join(HISTORY_FOLDER, f"{domain_name}.json")
+        self.lock = Lock() # Páginas são registradas por várias threads de scan
+        self.pages = {}  # url -> {'first_seen', 'last_visit', 'unchanged', 'links'}
+        self.images = {} # url -> {'first_seen', 'file'}
+        self.start_run()
+
+    def start_run(self):
+        """Zera o que é por execução (histórico mantido em memória entre execuções no modo serviço)"""
+        self.new_images = [] # Imagens baixadas nesta execução (para o manifesto delta)
+        self.pages_skipped = 0
+        self.run_started = time.time()
+
+    def load(self):
+        """Carrega o histórico do disco (arquivo ausente = primeira execução)"""
+        if not os.path.exists(self.path):
+            return False
+        with open(self.path, 'r', encoding='utf-8') as f:
+            data = json.load(f)
+        self.pages = data.get('pages', {})
+        self.images = data.get('images', {})
+        return True
+
+    def save(self):
+        """Grava o histórico de forma atômica (arquivo temporário + rename)"""
+        os.makedirs(HISTORY_FOLDER, exist_ok=True)
+        tmp_path = self.path + '.tmp'
+        with self.lock:
+            data = {'updated': time.time(), 'pages': self.pages, 'images': self.images}
+            with open(tmp_path, 'w', encoding='utf-8') as f:
+                json.dump(data, f)
+        os.replace(tmp_path, self.path)
+
+    def is_known_image(self, url):
+        """True se a imagem já foi baixada em alguma execução anterior"""
+        return url in self.images
+
+    def forget_image(self, url):
+        """Remove uma imagem do histórico (ex.: arquivo inválido apagado pelo pós-processamento)"""
+        with self.lock:
+            self.images.pop(url, None)
+            self.new_images = [entry for entry in self.new_images if entry['url'] != url]
+
+    def mark_image(self, url, file_path):
+        """Registra uma imagem baixada com sucesso nesta execução"""
+        now = time.time()
+        with self.lock:
+            self.images[url] = {'first_seen': now, 'file': file_path}
+            self.new_images.append({'url': url, 'file': file_path, 'downloaded_at': now})
+
+    def page_due(self, url):
+        """
+        Decide se a página deve ser buscada de novo.
+        Páginas que não trouxeram novidades são revisitadas com intervalo exponencial.
+        :return: (due, known_links) - known_links são os links vistos na última visita.
+        """
+        with self.lock:
+            record = self.pages.get(url)
+            if not record or not record.get('unchanged'):
+                return True, []
+            interval = min(PAGE_REVISIT_BASE * 2 ** (record['unchanged'] - 1), PAGE_REVISIT_MAX)
+            if self.run_started - record.get('last_visit', 0) >= interval:
+                return True, []
+            self.pages_skipped += 1
+            return False, list(record.get('links', []))
+
+    def record_page(self, url, links, new_images):
+        """Registra a visita a uma página e se ela trouxe links ou imagens novas"""
+        now = time.time()
+        links = list(dict.fromkeys(links)) # Remove duplicados mantendo a ordem
+        with self.lock:
+            record = self.pages.get(url)
+            if record is None:
+                self.pages[url] = {'first_seen': now, 'last_visit': now, 'unchanged': 0, 'links': links}
+                return
+            has_new_links = bool(set(links) - set(record.get('links', [])))
+            record['unchanged'] = 0 if (has_new_links or new_images) else record.get('unchanged', 0) + 1
+            record['last_visit'] = now
+            record['links'] = links
+
+    def write_delta_manifest(self, folder):
+        """Grava a lista de imagens novas desta execução em <folder>/delta_<timestamp>.json"""
+        stamp = datetime.fromtimestamp(self.run_started).strftime("%Y%m%d_%H%M%S")
+        manifest_path = os.path.join(folder, f"delta_{stamp}.json")
+        with self.lock:
+            manifest = {
+                'run_started': datetime.fromtimestamp(self.run_started).isoformat(),
+                'pages_skipped': self.pages_skipped,
+                'new_images': self.new_images,
+            }
+        with open(manifest_path, 'w', encoding='utf-8') as f:
+            json.dump(manifest, f, indent=4)
+        return manifest_path
+
+
+class RunProfiler:
+    """
+    Perfilamento opcional de uma execução, separado por estágio do pipeline (as threads
+    scan_*, download_*, archive-writer, ... de cada estágio):
+    - 'sample': amostra as pilhas das threads a cada PROFILE_SAMPLE_INTERVAL (tempo de parede,
+      inclui espera de rede/disco; workers ociosos não contam) -> <estágio>.collapsed, no
+      formato de pilhas colapsadas do flamegraph.pl/speedscope, e o resumo em summary.txt;
+    - 'cprofile': cProfile em cada tarefa dos workers -> <estágio>.pstats (+ texto);
+    - 'tracemalloc': snapshots de alocação (início, pico, fim) -> tracemalloc.txt.
+    Pode ser parado e retomado no meio da execução; o que já foi coletado vai para os relatórios.
+    """
+
+    STAGE_THREADS = (('scan_', 'scan'), ('download_', 'download'), ('archive-writer', 'archive'),
+                     ('postprocess-feeder', 'postprocess'), ('http2-loop', 'http2'), ('prewarm_', 'prewarm'))
+    TASK_STAGES = ('scan', 'download') # Threads de pool: só contam amostras dentro de uma tarefa
+
+    def __init__(self, modes):
+        self.modes = set(modes)
+        self.lock = Lock()
+        self.stacks = {} # estágio -> {pilha colapsada: amostras}
+        self.samples = 0
+        self.profiles = {} # estágio -> [cProfile.Profile de cada thread]
+        self.thread_state = local()
+        self.cprofile_error = None
+        self.active = False
+        self.sampler = None
+        self.sampler_stop = Event()
+        self.snapshots = {} # 'start'/'peak'/'end' -> tracemalloc.Snapshot
+        self.peak_traced = 0
+        self.owns_tracemalloc = False
+
+    @classmethod
+    def stage_of(cls, thread_name):
+        for prefix, stage in cls.STAGE_THREADS:
+            if thread_name.startswith(prefix):
+                return stage
+        return None
+
+    def start(self):
+        if self.active:
+            return
+        self.active = True
+        if 'tracemalloc' in self.modes:
+            if not tracemalloc.is_tracing():
+                tracemalloc.start(PROFILE_TRACEMALLOC_FRAMES)
+                self.owns_tracemalloc = True
+            self.snapshots.setdefault('start', tracemalloc.take_snapshot())
+        if self.modes & {'sample', 'tracemalloc'}:
+            self.sampler_stop.clear()
+            self.sampler = Thread(target=self._sample_loop, name='profiler', daemon=True)
+            self.sampler.start()
+
+    def stop(self):
+        """Para a coleta; o que já foi coletado fica para write_reports"""
+        if not self.active:
+            return
+        self.active = False
+        self.sampler_stop.set()
+        if self.sampler is not None:
+            self.sampler.join()
+            self.sampler = None
+        if 'tracemalloc' in self.modes and tracemalloc.is_tracing():
+            self.snapshots['end'] = tracemalloc.take_snapshot()
+            if self.owns_tracemalloc:
+                tracemalloc.stop()
+                self.owns_tracemalloc = False
+
+    def _sample_loop(self):
+        sampling = 'sample' in self.modes
+        next_snapshot = time.monotonic() + PROFILE_SNAPSHOT_INTERVAL
+        while not self.sampler_stop.wait(PROFILE_SAMPLE_INTERVAL if sampling else 1.0):
+            if sampling:
+                self._sample()
+            if 'tracemalloc' in self.modes and time.monotonic() >= next_snapshot:
+                next_snapshot = time.monotonic() + PROFILE_SNAPSHOT_INTERVAL
+                traced = tracemalloc.get_traced_memory()[0]
+                if traced > self.peak_traced: # Snapshot é caro: só quando o uso passa do pico anterior
+                    self.peak_traced = traced
+                    self.snapshots['peak'] = tracemalloc.take_snapshot()
+
+    def _sample(self):
+        names = {thread.ident: thread.name for thread in enumerate_threads()}
+        frames = sys._current_frames()
+        with self.lock:
+            self.samples += 1
+            for thread_id, frame in frames.items():
+                stage = self.stage_of(names.get(thread_id, ''))
+                if stage is None:
+                    continue
+                stack = []
+                in_task = stage not in self.TASK_STAGES
+                while frame is not None:
+                    code = frame.f_code
+                    if code.co_name == '_run_task':
+                        in_task = True
+                    stack.append(f"{os.path.basename(code.co_filename)}:{getattr(code, 'co_qualname', code.co_name)}")
+                    frame = frame.f_back
+                if in_task:
+                    counts = self.stacks.setdefault(stage, {})
+                    key = ';'.join(reversed(stack))
+                    counts[key] = counts.get(key, 0) + 1
+
+    def run_task(self, func, *args):
+        """Executa uma tarefa de worker sob o cProfile da thread (modo 'cprofile')"""
+        if 'cprofile' not in self.modes or not self.active or self.cprofile_error:
+            return func(*args)
+        profile = getattr(self.thread_state, 'profile', None)
+        if profile is None:
+            profile = self.thread_state.profile = cProfile.Profile()
+            with self.lock:
+                self.profiles.setdefault(self.stage_of(current_thread().name) or 'other', []).append(profile)
+        try:
+            profile.enable()
+        except ValueError as e: # Python 3.12+: um único profiler ativo por vez no interpretador
+            self.cprofile_error = str(e)
+            return func(*args)
+        try:
+            return func(*args)
+        finally:
+            profile.disable()
+
+    def write_reports(self, folder):
+        """Grava os relatórios em folder; retorna os nomes dos arquivos gravados"""
+        os.makedirs(folder, exist_ok=True)
+        written = []
+        with self.lock:
+            stacks = {stage: dict(counts) for stage, counts in self.stacks.items()}
+            profiles = {stage: list(items) for stage, items in self.profiles.items()}
+        if 'sample' in self.modes:
+            summary = [f"{self.samples} samples every {PROFILE_SAMPLE_INTERVAL * 1000:g} ms (wall clock)", ""]
+            for stage, counts in sorted(stacks.items()):
+                name = f"{stage}.collapsed"
+                with open(os.path.join(folder, name), 'w', encoding='utf-8') as f:
+                    for stack, count in sorted(counts.items(), key=lambda item: item[1], reverse=True):
+                        f.write(f"{stack} {count}\n")
+                written.append(name)
+                summary += self._stage_summary(stage, counts)
+            with open(os.path.join(folder, 'summary.txt'), 'w', encoding='utf-8') as f:
+                f.write('\n'.join(summary) + '\n')
+            written.append('summary.txt')
+        for stage, items in sorted(profiles.items()):
+            stats = pstats.Stats(*items)
+            stats.dump_stats(os.path.join(folder, f"{stage}.pstats"))
+            with open(os.path.join(folder, f"{stage}_pstats.txt"), 'w', encoding='utf-8') as f:
+                pstats.Stats(*items, stream=f).sort_stats('cumulative').print_stats(PROFILE_TOP)
+            written += [f"{stage}.pstats", f"{stage}_pstats.txt"]
+        if self.snapshots:
+            with open(os.path.join(folder, 'tracemalloc.txt'), 'w', encoding='utf-8') as f:
+                f.write('\n'.join(self._tracemalloc_report()) + '\n')
+            written.append('tracemalloc.txt')
+            if 'end' in self.snapshots:
+                self.snapshots['end'].dump(os.path.join(folder, 'tracemalloc_end.snapshot')) # tracemalloc.Snapshot.load
+                written.append('tracemalloc_end.snapshot')
+        return written
+
+    @staticmethod
+    def _stage_summary(stage, counts):
+        """Funções com mais amostras no topo da pilha (self) e em qualquer ponto da pilha (total)"""
+        total = sum(counts.values())
+        own, inclusive = {}, {}
+        for stack, count in counts.items():
+            frames = stack.split(';')
+            own[frames[-1]] = own.get(frames[-1], 0) + count
+            for frame in set(frames):
+                inclusive[frame] = inclusive.get(frame, 0) + count
+        lines = [f"== {stage}: {total} samples", "  self:"]
+        for frame, count in sorted(own.items(), key=lambda item: item[1], reverse=True)[:PROFILE_TOP]:
+            lines.append(f"    {count * 100 / total:5.1f}%  {frame}")
+        lines.append("  total:")
+        for frame, count in sorted(inclusive.items(), key=lambda item: item[1], reverse=True)[:PROFILE_TOP]:
+            lines.append(f"    {count * 100 / total:5.1f}%  {frame}")
+        return lines + [""]
+
+    def _tracemalloc_report(self):
+        ignore = (tracemalloc.Filter(False, tracemalloc.__file__), tracemalloc.Filter(False, '<frozen importlib._bootstrap*>'))
+        snapshots = {name: snapshot.filter_traces(ignore) for name, snapshot in self.snapshots.items()}
+        lines = []
+        for name in ('peak', 'end'):
+            if name in snapshots:
+                stats = snapshots[name].statistics('lineno')
+                lines.append(f"== {name}: {sum(stat.size for stat in stats) / 1024 ** 2:.1f} MB traced, top allocation sites")
+                lines += [f"  {stat}" for stat in stats[:PROFILE_TOP]] + [""]
+        if 'start' in snapshots and 'end' in snapshots:
+            lines.append("== end vs start: growth by allocation site")
+            lines += [f"  {stat}" for stat in snapshots['end'].compare_to(snapshots['start'], 'lineno')[:PROFILE_TOP]]
+        return lines
+
+
+class RunManifest:
+    """
+    Registro estruturado da execução: uma linha JSON por página ou imagem (URL, página de
+    origem, profundidade, status, bytes, duração, caminho salvo, sha256 do conteúdo) em
+    MANIFEST_FOLDER/<domínio>_<timestamp>.jsonl. A escrita é bufferizada e descarregada a cada
+    MANIFEST_FLUSH_INTERVAL segundos, então outras ferramentas podem consumir o arquivo durante
+    a execução. Uma URL pode ter mais de um registro (retentativas, pós-processamento): vale o último.
+    """
+
+    COLUMNS = ('type', 'url', 'source_page', 'depth', 'status', 'http_status', 'bytes', 'duration',
+               'path', 'sha256', 'links', 'error', 'time')
+    PARQUET_TYPES = {'depth': 'int64', 'http_status': 'int64', 'bytes': 'int64', 'links': 'int64',
+                     'duration': 'float64', 'time': 'float64'} # As demais colunas são string
+
+    def __init__(self, domain_name):
+        os.makedirs(MANIFEST_FOLDER, exist_ok=True)
+        stem = os.path.join(MANIFEST_FOLDER, f"{domain_name}_{datetime.now().strftime('%Y%m%d_%H%M%S')}")
+        for attempt in range(1, 1000): # Execuções no mesmo segundo (modo serviço) ganham sufixo
+            self.path = f"{stem}.jsonl" if attempt == 1 else f"{stem}_{attempt}.jsonl"
+            try:
+                self.file = open(self.path, 'x', encoding='utf-8', buffering=WRITE_BUFFER_SIZE)
+                break
+            except FileExistsError:
+                continue
+        else:
+            raise FileExistsError(f"Too many manifests named {stem}*.jsonl")
+        self.lock = Lock()
+        self.last_flush = time.monotonic()
+        self.records = 0
+
+    def write(self, record_type, url, **fields):
+        """Acrescenta um registro (campos None são omitidos); chamado por várias threads"""
+        record = {'type': record_type, 'url': url}
+        record.update((name, value) for name, value in fields.items() if value is not None)
+        record['time'] = round(time.time(), 3)
+        line = json.dumps(record) + '\n'
+        with self.lock:
+            if self.file is None:
+                return # Já fechado (resultado tardio do pós-processamento)
+            self.file.write(line)
+            self.records += 1
+            now = time.monotonic()
+            if now - self.last_flush >= MANIFEST_FLUSH_INTERVAL:
+                self.file.flush()
+                self.last_flush = now
+
+    def close(self):
+        with self.lock:
+            if self.file is not None:
+                self.file.close()
+                self.file = None
+
+    def _records(self):
+        with open(self.path, 'r', encoding='utf-8') as f:
+            for line in f:
+                if line.strip():
+                    yield json.loads(line)
+
+    def write_csv(self):
+        """Rollup <manifesto>.csv com as colunas de COLUMNS (lido em streaming do JSONL)"""
+        csv_path = os.path.splitext(self.path)[0] + '.csv'
+        with open(csv_path, 'w', encoding='utf-8', newline='') as f:
+            writer = csv.DictWriter(f, fieldnames=self.COLUMNS, extrasaction='ignore')
+            writer.writeheader()
+            writer.writerows(self._records())
+        return csv_path
+
+    def write_parquet(self):
+        """Rollup <manifesto>.parquet (requer pyarrow)"""
+        import pyarrow
+        import pyarrow.json
+        import pyarrow.parquet
+        schema = pyarrow.schema([(name, getattr(pyarrow, self.PARQUET_TYPES.get(name, 'string'))()) for name in self.COLUMNS])
+        table = pyarrow.json.read_json(self.path, parse_options=pyarrow.json.ParseOptions(
+            explicit_schema=schema, unexpected_field_behavior='ignore'))
+        parquet_path = os.path.splitext(self.path)[0] + '.parquet'
+        pyarrow.parquet.write_table(table, parquet_path)
+        return parquet_path
 
-# Configuração aprimorada de logging para o arquivo
-# Agora inclui o nome do nível de log
-logging.basicConfig(
-    filename=LOG_FILE,
-    level=logging.DEBUG, # Define o nível mínimo para DEBUG para capturar tudo no arquivo
-    format='%(asctime)s - %(levelname)s - %(message)s', # Adicionado levelname
-    filemode='w' # 'w' para sobrescrever a cada execução, 'a' para append
-)
 
 class ImageDownloader:
     def __init__(self, root):
-        """Inicializa o aplicativo com a janela principal"""
+        """Inicializa o aplicativo com a janela principal (root=None: sem interface, para scripts/benchmarks)"""
+        setup_logging()
         self.root = root
-        self.setup_ui()
-        self.session = self.create_session() # Usando a versão com retries
-        self.stop_flag = False
-        self.paused = False
-        self.pause_cond = Condition(Lock())
+        self._gui_log = deque(maxlen=GUI_LOG_BUFFER) # (hora, mensagem, tag) aguardando _flush_gui_log
+        self._gui_log_lock = Lock()
+        self._gui_log_scheduled = False # Já há um flush agendado no Tk
+        if root is not None:
+            self.setup_ui()
+        else:
+            self._setup_headless_state()
+        self.chunk_size = DOWNLOAD_CHUNK_SIZE # 0 = adaptativo; pode vir do config.json
+        self.shard_levels = SHARD_LEVELS # Subpastas por hash na saída; pode vir do config.json
+        self.metrics_interval = METRICS_INTERVAL # Exportação periódica das métricas; pode vir do config.json
+        self.max_page_bytes = MAX_PAGE_BYTES # Limite de tamanho das páginas; pode vir do config.json
+        self.output_mode = OUTPUT_MODE # Arquivos soltos ou shards tar/zip/warc; pode vir do config.json
+        self.archive_shard_bytes = ARCHIVE_SHARD_BYTES
+        self.archive_metadata = False # Guarda status/headers da resposta junto de cada imagem
+        self.archive_writer = None # ArchiveWriter da execução (só nos modos de shard)
+        self.postprocess_steps = list(POSTPROCESS_STEPS) # Pós-processamento; pode vir do config.json
+        self.postprocess_workers = POSTPROCESS_WORKERS
+        self.postprocess_delete_invalid = True # Apaga imagens que falham na validação (baixadas de novo depois)
+        self.thumbnail_size = THUMBNAIL_SIZE
+        self.webp_quality = WEBP_QUALITY
+        self.post_processor = None # PostProcessor da execução
+        self.near_duplicates = NEAR_DUPLICATES # Pode vir do config.json
+        self.near_duplicate_threshold = PHASH_THRESHOLD
+        self.near_duplicate_index = None # NearDuplicateIndex do domínio durante a execução
+        self.near_duplicates_dropped = 0
+        self.manifest_enabled = MANIFEST # Pode vir do config.json
+        self.manifest_rollups = list(MANIFEST_ROLLUPS)
+        self.manifest = None # RunManifest da execução
+        self.profile_modes = list(PROFILE_MODES) # Pode vir do config.json
+        self.profiler = None # RunProfiler da execução (se Profile estiver ligado em algum momento)
+        self.manifest_path = None # Caminho do último manifesto (resumo do run_headless)
+        self.image_sources = {} # URL da imagem -> (página onde foi vista primeiro, profundidade), para o manifesto
+        self.bandwidth = BandwidthLimiter() # Limite de banda; ajustável durante a execução (set_bandwidth_limit)
+        self.host_bandwidth_limits = {} # Padrão de host -> KB/s; pode vir do config.json
+        self.scope_allow_hosts = list(SCOPE_ALLOW_HOSTS) # Escopo e orçamentos por host; podem vir do config.json
+        self.scope_deny_hosts = list(SCOPE_DENY_HOSTS)
+        self.origin_image_connections = ORIGIN_IMAGE_CONNECTIONS
+        self.cdn_image_connections = CDN_IMAGE_CONNECTIONS
+        self.scope = CrawlScope('') # Recriados a cada execução em _prepare_run
+        self.host_slots = HostSlots(lambda host: 0)
+        self.min_workers = MIN_WORKERS # Limites do autotune; podem vir do config.json
+        self.max_workers = MAX_WORKERS_LIMIT
+        self.metrics = RunMetrics() # Recriado a cada execução em _prepare_run
+        self.download_tuner = None # Limites de concorrência, criados a cada execução em _prepare_run
+        self.retry_queue = DeferredRetryQueue() # Recriados a cada execução em _prepare_run
+        self.host_breaker = HostCircuitBreaker()
+        self.failed_downloads = {} # url -> motivo da falha final
+        self.scan_tuner = None
+        self._metrics_stop = Event()
+        self.dns_cache = DnsCache(DNS_SERVERS, enabled=DNS_CACHE) # Servidores/TTL podem vir do config.json
+        self.prewarm_connections = PREWARM_CONNECTIONS
+        self.connection_warmer = None # ConnectionWarmer da execução
+        self.http2 = HTTP2 # Pode vir do config.json (recria a sessão)
+        self.transport_mode = TRANSPORT_MODE # Idem, junto com as opções de gravação/replay abaixo
+        self.recording_folder = RECORDING_FOLDER
+        self.replay_latency_ms = REPLAY_LATENCY_MS
+        self.replay_bandwidth_kbps = REPLAY_BANDWIDTH_KBPS
+        self.recorder = None # FetchRecorder do modo record
+        self.replay_archive = None # ReplayArchive do modo replay
+        self.history_cache = None # Modo serviço: domínio -> RunHistory mantido entre execuções
+        self._html_parser = None # 'lxml' ou 'html.parser', resolvido na primeira página
+        self.create_sessions() # Sessões com retries: self.session (páginas) e self.image_session (imagens)
+        # Pausa/stop baseados em eventos: quem está pausado dorme em _resume_event (zero CPU)
+        # e o stop acorda todo mundo. Cada tarefa guarda o evento de stop da sua execução
+        # (thread-local), então tarefas atrasadas de um run parado nunca "revivem" no seguinte.
+        self._stop_event = Event()
+        self._resume_event = Event()
+        self._resume_event.set()
+        self._task_state = local()
+        self._stop_waiter = Future() # Resolvido no stop: acorda o wait() do loop principal
         self.is_running = False
         self.download_count = 0
         self.images_found = 0
         self.pages_processed = 0
+        self.bytes_downloaded = 0
+        self._progress_lock = Lock() # Protege os contadores acima, amostrados pela UI
+        self._progress_job = None # Callback periódico do root.after que atualiza o progresso
+        self._rate_samples = deque() # (instante, imagens baixadas, bytes) para taxa e ETA
+        self.phase = 'idle' # 'scan' ou 'download' durante uma execução
         self.url_queue = Queue()
         self.processed_urls = set()
         self.image_urls = set()
         self.base_domain = None # Para armazenar o domínio base do scan
         self.base_domain_name = None # Para armazenar o nome seguro da pasta do domínio
+        self.history = None # RunHistory do domínio quando o modo incremental está ativo
+        self.canonicalizer = UrlCanonicalizer() # Regras podem vir do config.json
+        self.trap_max_per_template = TRAP_MAX_PER_TEMPLATE
+        self.trap_detector = TrapDetector() # Recriado a cada execução em _prepare_run
+        self.download_targets = [] # Imagens efetivamente enviadas para download nesta execução
+        self.download_dir = None # Pasta de saída resolvida uma vez por execução
+        self._existing_hashes = set() # Hashes de URL das imagens já salvas na pasta de saída
+        self._partial_hashes = set() # Hashes de URL com parcial retomável em .partial/
+        self._created_shards = set() # Subpastas de shard já criadas nesta execução
 
         # Carregar configuração após a UI ser configurada (principalmente entry_url)
         self.load_config()
 
+    @property
+    def stop_flag(self):
+        """True se a execução da tarefa atual (ou a corrente) recebeu stop"""
+        event = getattr(self._task_state, 'stop_event', None) or self._stop_event
+        return event.is_set()
+
+    @stop_flag.setter
+    def stop_flag(self, value):
+        if value:
+            self._stop_event.set()
+            self._resume_event.set() # Acorda quem está pausado para ver o stop
+            try:
+                self._stop_waiter.set_result(None)
+            except InvalidStateError:
+                pass # Stop já sinalizado
+        elif self._stop_event.is_set():
+            self._stop_event = Event() # Novo evento: tarefas do run anterior continuam paradas
+            self._stop_waiter = Future()
+
+    @property
+    def paused(self):
+        return not self._resume_event.is_set()
+
+    @paused.setter
+    def paused(self, value):
+        if value:
+            self._resume_event.clear()
+        else:
+            self._resume_event.set()
+
+    def _run_task(self, stop_event, tuner, func, *args):
+        """Executa uma tarefa de worker vinculada ao evento de stop da sua execução e alimenta o tuner"""
+        self._task_state.stop_event = stop_event
+        self._task_state.congested = False
+        started = time.perf_counter()
+        profiler = self.profiler
+        try:
+            if profiler is not None:
+                return profiler.run_task(func, *args)
+            return func(*args)
+        finally:
+            tuner.record(time.perf_counter() - started, self._task_state.congested)
+            self._task_state.stop_event = None
+
+    def _note_congestion(self, response=None):
+        """Marca a tarefa atual como congestionada (timeout, conexão falhou, 429/503...) para o autotune"""
+        if response is None or response.status_code in CONGESTION_STATUS:
+            self._task_state.congested = True
+
+    def _interrupt_connections(self):
+        """Fecha os sockets das requisições em andamento (usado pelo stop)"""
+        interrupted = 0
+        adapters = set(self.session.adapters.values()) | set(self.image_session.adapters.values())
+        for adapter in adapters:
+            if hasattr(adapter, 'interrupt'): # CancellableHTTPAdapter e os adaptadores de gravação/replay
+                interrupted += adapter.interrupt()
+        return interrupted
+
+    def create_sessions(self):
+        """
+        (Re)cria as duas sessões: self.session para as páginas e self.image_session para as
+        imagens. Cada uma tem seu adaptador e seus pools de conexão, então downloads de imagem
+        nunca disputam (nem esperam) conexões keep-alive das origens HTML e vice-versa.
+        O cookie jar é o mesmo: cookies das páginas (consentimento, anti-hotlink, login) seguem
+        nas requisições de imagem. Nos modos record/replay as duas compartilham a mesma gravação.
+        """
+        self._open_transport()
+        self.session = self.create_session()
+        self.image_session = self.create_session()
+        self.image_session.cookies = self.session.cookies
+
     def create_session(self):
         """Cria e configura uma sessão HTTP com headers, timeout e retries"""
         session = requests.Session()
@@ -65,20 +2955,82 @@ class ImageDownloader:
         })
 
         # Configuração de Retries
+        # Só uma retentativa rápida dentro do worker (falhas passageiras de conexão); falhas que
+        # persistem vão para a fila de retentativas adiadas, sem prender o worker em backoff
         retries = Retry(
-            total=3,            # Número total de tentativas
-            backoff_factor=0.5,  # Fator de espera entre tentativas (0.5, 1, 2 segundos...)
+            total=1,            # Número total de tentativas
+            backoff_factor=0.1,  # Espera curta entre tentativas
             status_forcelist=[500, 502, 503, 504], # Tentar novamente para estes códigos de status
-            allowed_methods=frozenset(['HEAD', 'GET', 'OPTIONS']) # Métodos que permitem retry
+            allowed_methods=frozenset(['HEAD', 'GET', 'OPTIONS']), # Métodos que permitem retry
+            respect_retry_after_header=False, # Retry-After é respeitado pela fila adiada, não com sleep no worker
+            raise_on_status=False # 5xx persistente volta como resposta: raise_for_status dá o HTTPError com status e Retry-After
         )
 
         # Monta o adaptador com a política de retry para http e https
-        adapter = HTTPAdapter(max_retries=retries)
+        # (CancellableHTTPAdapter permite ao stop derrubar conexões em andamento)
+        # pool_maxsize acompanha o teto de concorrência para não descartar conexões keep-alive
+        # dns_cache: resolução compartilhada entre workers, com TTL
+        adapter_cls = CancellableHTTPAdapter
+        if self.http2:
+            missing = [module for module in ('httpx', 'h2') if importlib.util.find_spec(module) is None]
+            if missing:
+                self.log_message(f"HTTP/2 disabled: {', '.join(missing)} not installed (pip install 'httpx[http2]')", "warning", level=logging.WARNING)
+            else:
+                adapter_cls = Http2Adapter # HTTP/2 por host (ALPN), com fallback para o HTTP/1.1 acima
+        adapter = adapter_cls(max_retries=retries, abort_check=lambda: self.stop_flag,
+                              dns_cache=self.dns_cache, pool_maxsize=MAX_WORKERS_LIMIT)
+        adapter = self._wrap_transport(adapter)
         session.mount('http://', adapter)
         session.mount('https://', adapter)
 
         return session
 
+    def _open_transport(self):
+        """Modos record/replay: abre a gravação usada pelas sessões criadas em seguida"""
+        recorder, self.recorder = getattr(self, 'recorder', None), None
+        if recorder is not None:
+            recorder.close() # Sessões recriadas: a gravação anterior termina aqui
+        archive, self.replay_archive = getattr(self, 'replay_archive', None), None
+        if archive is not None:
+            archive.close()
+        if self.transport_mode == 'record':
+            self.recorder = FetchRecorder(self.recording_folder)
+            self.log_message(f"Recording all responses to {self.recording_folder}", "info")
+        elif self.transport_mode == 'replay':
+            try:
+                self.replay_archive = ReplayArchive(self.recording_folder)
+            except (OSError, ValueError, KeyError) as e:
+                # Nunca cai para a rede real: o replay vira uma gravação vazia e toda requisição falha
+                self.replay_archive = ReplayArchive(self.recording_folder, empty=True)
+                self.log_message(f"Cannot replay from {self.recording_folder}: {e}. Every request will fail (no network access in replay mode).", "error", level=logging.ERROR)
+                return
+            self.log_message(f"Replaying {sum(len(entries) for entries in self.replay_archive.entries.values())} recorded responses "
+                             f"from {self.recording_folder} (no network access)", "info")
+
+    def _wrap_transport(self, adapter):
+        """Modos record/replay: grava as respostas do adaptador real ou o substitui pela gravação"""
+        if self.recorder is not None:
+            return RecordingAdapter(adapter, self.recorder)
+        if self.replay_archive is not None:
+            return ReplayAdapter(self.replay_archive, self.replay_latency_ms, self.replay_bandwidth_kbps * 1024,
+                                 abort_check=lambda: self.stop_flag)
+        return adapter
+
+    def _setup_headless_state(self):
+        """Cria as variáveis de configuração que a UI criaria, com os mesmos valores padrão"""
+        self.max_depth = HeadlessVar(1)
+        self.image_types = {
+            'JPG': HeadlessVar(True),
+            'PNG': HeadlessVar(True),
+            'GIF': HeadlessVar(False),
+            'WEBP': HeadlessVar(True)
+        }
+        self.incremental_mode = HeadlessVar(False)
+        self.workers = HeadlessVar(MAX_WORKERS)
+        self.autotune = HeadlessVar(False)
+        self.profiling = HeadlessVar(False)
+        self.bandwidth_kbps = HeadlessVar(BANDWIDTH_LIMIT_KBPS)
+
     def _configure_styles(self):
         """Configura estilos ttk e fontes para o tema dark hacking"""
         self.style = ttk.Style()
@@ -195,6 +3147,76 @@ class ImageDownloader:
                                highlightthickness=1)
         depth_spin.pack(side=tk.LEFT)
 
+        # Concorrência de download (o scan usa metade); com Auto Tune é o valor inicial
+        tk.Label(config_frame,
+                 text="Workers:",
+                 font=self.terminal_font,
+                 fg=self.text_color,
+                 bg=self.bg_color).pack(side=tk.LEFT, padx=(10, 5))
+
+        self.workers = tk.IntVar(value=MAX_WORKERS)
+        tk.Spinbox(config_frame,
+                   from_=1, to=MAX_WORKERS_LIMIT,
+                   textvariable=self.workers,
+                   width=3,
+                   font=self.terminal_font,
+                   bg=self.widget_bg,
+                   fg=self.text_color,
+                   buttonbackground=self.widget_bg,
+                   relief='flat',
+                   bd=0,
+                   highlightbackground=self.widget_border,
+                   highlightcolor=self.highlight_color,
+                   highlightthickness=1).pack(side=tk.LEFT)
+
+        # Autotune: ajusta a concorrência pela vazão/latência/erros observados
+        self.autotune = tk.BooleanVar(value=False)
+        tk.Checkbutton(config_frame,
+                       text="Auto Tune",
+                       variable=self.autotune,
+                       font=self.terminal_font,
+                       fg=self.text_color,
+                       bg=self.bg_color,
+                       selectcolor=self.widget_bg,
+                       activebackground=self.bg_color,
+                       activeforeground=self.text_color).pack(side=tk.LEFT, padx=(5, 0))
+
+        # Perfilamento: pode ser ligado/desligado durante a execução; relatórios ao final
+        self.profiling = tk.BooleanVar(value=False)
+        tk.Checkbutton(config_frame,
+                       text="Profile",
+                       variable=self.profiling,
+                       font=self.terminal_font,
+                       fg=self.text_color,
+                       bg=self.bg_color,
+                       selectcolor=self.widget_bg,
+                       activebackground=self.bg_color,
+                       activeforeground=self.text_color).pack(side=tk.LEFT, padx=(5, 0))
+        self.profiling.trace_add('write', lambda *args: self._apply_profiling())
+
+        # Limite de banda (KB/s, 0 = sem limite); vale na hora, mesmo com a execução em andamento
+        tk.Label(config_frame,
+                 text="KB/s:",
+                 font=self.terminal_font,
+                 fg=self.text_color,
+                 bg=self.bg_color).pack(side=tk.LEFT, padx=(10, 5))
+
+        self.bandwidth_kbps = tk.IntVar(value=BANDWIDTH_LIMIT_KBPS)
+        tk.Spinbox(config_frame,
+                   from_=0, to=10 ** 7, increment=256,
+                   textvariable=self.bandwidth_kbps,
+                   width=6,
+                   font=self.terminal_font,
+                   bg=self.widget_bg,
+                   fg=self.text_color,
+                   buttonbackground=self.widget_bg,
+                   relief='flat',
+                   bd=0,
+                   highlightbackground=self.widget_border,
+                   highlightcolor=self.highlight_color,
+                   highlightthickness=1).pack(side=tk.LEFT)
+        self.bandwidth_kbps.trace_add('write', lambda *args: self._apply_bandwidth_limit())
+
         # Configuração de tipos de imagem
         tk.Label(config_frame,
                  text="Image Types:",
@@ -221,6 +3243,18 @@ class ImageDownloader:
                                activeforeground=self.text_color)
             cb.pack(side=tk.LEFT, padx=(0, 5))
 
+        # Modo incremental: baixa apenas imagens não vistas em execuções anteriores
+        self.incremental_mode = tk.BooleanVar(value=False)
+        tk.Checkbutton(config_frame,
+                       text="Only New",
+                       variable=self.incremental_mode,
+                       font=self.terminal_font,
+                       fg=self.text_color,
+                       bg=self.bg_color,
+                       selectcolor=self.widget_bg,
+                       activebackground=self.bg_color,
+                       activeforeground=self.text_color).pack(side=tk.LEFT, padx=(10, 5))
+
         # Seção de botões
         button_frame = tk.Frame(main_frame, bg=self.bg_color)
         button_frame.pack(fill=tk.X, pady=(0, 15))
@@ -373,43 +3407,56 @@ class ImageDownloader:
         # Log para o arquivo
         logging.log(level, message)
 
-        # Atualiza a GUI (thread-safe)
-        # A função `update_gui` será executada na thread principal do Tkinter
-        def update_gui():
+        # Atualiza a GUI (thread-safe): a linha entra no buffer e um único callback do Tk por
+        # lote (a cada GUI_LOG_FLUSH_MS) insere tudo, então o custo na UI não cresce com a
+        # quantidade de mensagens por segundo dos workers
+        if not (hasattr(self, 'root') and self.root):
+            return # Sem interface (ou app fechando): só o arquivo de log
+        self._gui_log.append((timestamp, message, tag))
+        with self._gui_log_lock:
+            if self._gui_log_scheduled:
+                return
+            self._gui_log_scheduled = True
+        try:
+            self.root.after(GUI_LOG_FLUSH_MS, self._flush_gui_log)
+        except (RuntimeError, tk.TclError):
+            pass # Janela já destruída
+
+    def _flush_gui_log(self):
+        """Insere no log da GUI as linhas acumuladas desde o último flush (thread principal)"""
+        with self._gui_log_lock:
+            self._gui_log_scheduled = False
+        lines = []
+        while True:
             try:
-                # Verifica se os widgets ainda existem antes de tentar atualizá-los
-                if hasattr(self, 'log_text') and self.log_text.winfo_exists():
-                    self.log_text.config(state=tk.NORMAL) # Habilita para escrever
-                    # Insere timestamp com tag 'timestamp'
+                lines.append(self._gui_log.popleft())
+            except IndexError:
+                break
+        if not lines:
+            return
+        try:
+            # Verifica se os widgets ainda existem antes de tentar atualizá-los
+            if hasattr(self, 'log_text') and self.log_text.winfo_exists():
+                self.log_text.config(state=tk.NORMAL) # Habilita para escrever
+                for timestamp, message, tag in lines:
+                    # Timestamp com tag 'timestamp' e a mensagem com a tag de cor correspondente
                     self.log_text.insert(tk.END, f"[{timestamp}] ", "timestamp")
-                    # Insere a mensagem com a tag de cor correspondente
                     self.log_text.insert(tk.END, message + "\n", tag)
-                    self.log_text.see(tk.END) # Rola para o final
-                    self.log_text.config(state=tk.DISABLED) # Desabilita para evitar edição
-
-                if hasattr(self, 'status_message') and self.status_message.winfo_exists():
-                    # Atualiza a barra de status com uma parte da mensagem
-                    status_text = f"Status: {message[:70]}" + ("..." if len(message) > 70 else "")
-                    self.status_message.config(text=status_text)
+                self.log_text.see(tk.END) # Rola para o final
+                self.log_text.config(state=tk.DISABLED) # Desabilita para evitar edição
 
-            except tk.TclError as e:
-                # Captura erro comum quando a janela é fechada enquanto uma atualização está pendente
-                #print(f"TclError during GUI update: {e}") # Opcional: imprimir no console
-                pass # Ignora o erro, pois a janela está fechando
-
-            except Exception as e:
-                # Loga qualquer outro erro inesperado na atualização da GUI (vai para o arquivo)
-                logging.error(f"Error updating GUI log/status: {e}", exc_info=True)
+            if hasattr(self, 'status_message') and self.status_message.winfo_exists():
+                # Atualiza a barra de status com uma parte da última mensagem
+                message = lines[-1][1]
+                status_text = f"Status: {message[:70]}" + ("..." if len(message) > 70 else "")
+                self.status_message.config(text=status_text)
 
+        except tk.TclError:
+            pass # Janela fechada enquanto uma atualização estava pendente
 
-        # Agenda a função de atualização para ser executada na thread principal do Tkinter
-        # using root.after is crucial for thread-safe GUI updates
-        if hasattr(self, 'root') and self.root:
-            self.root.after(0, update_gui)
-        else:
-            # Se o root não existe (app fechando), ainda loga para o arquivo
-            pass
-            # print(f"GUI not available for log: {message}") # Opcional: imprimir no console
+        except Exception as e:
+            # Loga qualquer outro erro inesperado na atualização da GUI (vai para o arquivo)
+            logging.error(f"Error updating GUI log/status: {e}", exc_info=True)
 
 
     def load_config(self):
@@ -427,6 +3474,93 @@ class ImageDownloader:
                         for type_name, value in config['image_types'].items():
                             if type_name in self.image_types:
                                 self.image_types[type_name].set(value)
+                    if 'incremental_mode' in config and hasattr(self, 'incremental_mode'):
+                        self.incremental_mode.set(bool(config['incremental_mode']))
+                    if 'chunk_size' in config:
+                        self.chunk_size = max(int(config['chunk_size']), 0)
+                    if 'metrics_interval' in config:
+                        self.metrics_interval = max(float(config['metrics_interval']), 0)
+                    if 'shard_levels' in config:
+                        self.shard_levels = min(max(int(config['shard_levels']), 0), URL_HASH_LENGTH // 2)
+                    if 'host_bandwidth_limits_kbps' in config:
+                        self.host_bandwidth_limits = {str(host): max(int(kbps), 0) for host, kbps in config['host_bandwidth_limits_kbps'].items()}
+                    if 'bandwidth_limit_kbps' in config and hasattr(self, 'bandwidth_kbps'):
+                        self.bandwidth_kbps.set(max(int(config['bandwidth_limit_kbps']), 0))
+                    if 'workers' in config and hasattr(self, 'workers'):
+                        self.workers.set(min(max(int(config['workers']), 1), MAX_WORKERS_LIMIT))
+                    if 'autotune' in config and hasattr(self, 'autotune'):
+                        self.autotune.set(bool(config['autotune']))
+                    if 'profile' in config and hasattr(self, 'profiling'):
+                        self.profiling.set(bool(config['profile']))
+                    if 'profile_modes' in config:
+                        self.profile_modes = [str(mode) for mode in config['profile_modes'] if mode in ('sample', 'cprofile', 'tracemalloc')]
+                    if 'min_workers' in config:
+                        self.min_workers = min(max(int(config['min_workers']), 1), MAX_WORKERS_LIMIT)
+                    if 'max_workers' in config:
+                        self.max_workers = min(max(int(config['max_workers']), self.min_workers), MAX_WORKERS_LIMIT)
+                    if config.get('output_mode') in ('files',) + tuple(ArchiveWriter.FORMATS):
+                        self.output_mode = config['output_mode']
+                    if 'archive_shard_mb' in config:
+                        self.archive_shard_bytes = max(int(config['archive_shard_mb']), 1) * 1024 * 1024
+                    if 'archive_metadata' in config:
+                        self.archive_metadata = bool(config['archive_metadata'])
+                    if 'postprocess' in config:
+                        self.postprocess_steps = [str(step) for step in config['postprocess']]
+                    if 'postprocess_workers' in config:
+                        self.postprocess_workers = max(int(config['postprocess_workers']), 1)
+                    if 'postprocess_delete_invalid' in config:
+                        self.postprocess_delete_invalid = bool(config['postprocess_delete_invalid'])
+                    if 'thumbnail_size' in config:
+                        self.thumbnail_size = max(int(config['thumbnail_size']), 16)
+                    if 'webp_quality' in config:
+                        self.webp_quality = min(max(int(config['webp_quality']), 1), 100)
+                    if 'near_duplicates' in config:
+                        self.near_duplicates = bool(config['near_duplicates'])
+                    if 'near_duplicate_threshold' in config:
+                        self.near_duplicate_threshold = min(max(int(config['near_duplicate_threshold']), 0), 32)
+                    if 'manifest' in config:
+                        self.manifest_enabled = bool(config['manifest'])
+                    if 'manifest_rollups' in config:
+                        self.manifest_rollups = [str(fmt).lower() for fmt in config['manifest_rollups'] if str(fmt).lower() in ('csv', 'parquet')]
+                    if 'dns_cache' in config:
+                        self.dns_cache.enabled = bool(config['dns_cache'])
+                    if 'dns_servers' in config:
+                        self.dns_cache.servers = [str(server) for server in config['dns_servers']]
+                    if 'dns_default_ttl' in config:
+                        self.dns_cache.default_ttl = max(int(config['dns_default_ttl']), DNS_MIN_TTL)
+                    if 'prewarm_connections' in config:
+                        self.prewarm_connections = bool(config['prewarm_connections'])
+                    transport = (self.http2, self.transport_mode, self.recording_folder, self.replay_latency_ms, self.replay_bandwidth_kbps)
+                    if 'http2' in config:
+                        self.http2 = bool(config['http2'])
+                    if config.get('transport_mode') in ('live', 'record', 'replay'):
+                        self.transport_mode = config['transport_mode']
+                    if 'recording_folder' in config:
+                        self.recording_folder = str(config['recording_folder'])
+                    if 'replay_latency_ms' in config:
+                        self.replay_latency_ms = None if config['replay_latency_ms'] is None else max(float(config['replay_latency_ms']), 0)
+                    if 'replay_bandwidth_kbps' in config:
+                        self.replay_bandwidth_kbps = max(int(config['replay_bandwidth_kbps']), 0)
+                    if transport != (self.http2, self.transport_mode, self.recording_folder, self.replay_latency_ms, self.replay_bandwidth_kbps):
+                        self.create_sessions() # Troca o adaptador das sessões
+                    if 'max_page_bytes' in config:
+                        self.max_page_bytes = max(int(config['max_page_bytes']), 0)
+                    if 'strip_params' in config:
+                        self.canonicalizer.strip_params = [str(p).lower() for p in config['strip_params']]
+                    if 'sort_params' in config:
+                        self.canonicalizer.sort_params = bool(config['sort_params'])
+                    if 'url_rules' in config:
+                        self.canonicalizer.url_rules = dict(config['url_rules'])
+                    if 'trap_max_per_template' in config:
+                        self.trap_max_per_template = max(int(config['trap_max_per_template']), 0)
+                    if 'scope_allow_hosts' in config:
+                        self.scope_allow_hosts = [str(host).lower() for host in config['scope_allow_hosts']]
+                    if 'scope_deny_hosts' in config:
+                        self.scope_deny_hosts = [str(host).lower() for host in config['scope_deny_hosts']]
+                    if 'origin_image_connections' in config:
+                        self.origin_image_connections = max(int(config['origin_image_connections']), 0)
+                    if 'cdn_image_connections' in config:
+                        self.cdn_image_connections = max(int(config['cdn_image_connections']), 0)
 
                 self.log_message(f"Config loaded from {CONFIG_FILE}", "success")
             except json.JSONDecodeError:
@@ -443,11 +3577,56 @@ class ImageDownloader:
         target_url = self.entry_url.get() if hasattr(self, 'entry_url') else ''
         scan_depth = self.max_depth.get() if hasattr(self, 'max_depth') else 1
         image_types_state = {name: var.get() for name, var in self.image_types.items()} if hasattr(self, 'image_types') else {}
+        incremental_mode = self.incremental_mode.get() if hasattr(self, 'incremental_mode') else False
+        workers = self._get_workers() if hasattr(self, 'workers') else MAX_WORKERS
+        autotune = self.autotune.get() if hasattr(self, 'autotune') else False
 
         config = {
             'target_url': target_url,
             'scan_depth': scan_depth,
-            'image_types': image_types_state
+            'image_types': image_types_state,
+            'incremental_mode': incremental_mode,
+            'chunk_size': getattr(self, 'chunk_size', DOWNLOAD_CHUNK_SIZE),
+            'shard_levels': getattr(self, 'shard_levels', SHARD_LEVELS),
+            'metrics_interval': getattr(self, 'metrics_interval', METRICS_INTERVAL),
+            'workers': workers,
+            'bandwidth_limit_kbps': self._get_bandwidth_kbps() if hasattr(self, 'bandwidth_kbps') else BANDWIDTH_LIMIT_KBPS,
+            'host_bandwidth_limits_kbps': getattr(self, 'host_bandwidth_limits', {}),
+            'autotune': autotune,
+            'min_workers': getattr(self, 'min_workers', MIN_WORKERS),
+            'max_workers': getattr(self, 'max_workers', MAX_WORKERS_LIMIT),
+            'strip_params': self.canonicalizer.strip_params,
+            'sort_params': self.canonicalizer.sort_params,
+            'url_rules': self.canonicalizer.url_rules,
+            'trap_max_per_template': getattr(self, 'trap_max_per_template', TRAP_MAX_PER_TEMPLATE),
+            'scope_allow_hosts': getattr(self, 'scope_allow_hosts', list(SCOPE_ALLOW_HOSTS)),
+            'scope_deny_hosts': getattr(self, 'scope_deny_hosts', list(SCOPE_DENY_HOSTS)),
+            'origin_image_connections': getattr(self, 'origin_image_connections', ORIGIN_IMAGE_CONNECTIONS),
+            'cdn_image_connections': getattr(self, 'cdn_image_connections', CDN_IMAGE_CONNECTIONS),
+            'max_page_bytes': getattr(self, 'max_page_bytes', MAX_PAGE_BYTES),
+            'output_mode': getattr(self, 'output_mode', OUTPUT_MODE),
+            'archive_shard_mb': getattr(self, 'archive_shard_bytes', ARCHIVE_SHARD_BYTES) // (1024 * 1024),
+            'archive_metadata': getattr(self, 'archive_metadata', False),
+            'postprocess': getattr(self, 'postprocess_steps', list(POSTPROCESS_STEPS)),
+            'postprocess_workers': getattr(self, 'postprocess_workers', POSTPROCESS_WORKERS),
+            'postprocess_delete_invalid': getattr(self, 'postprocess_delete_invalid', True),
+            'thumbnail_size': getattr(self, 'thumbnail_size', THUMBNAIL_SIZE),
+            'webp_quality': getattr(self, 'webp_quality', WEBP_QUALITY),
+            'near_duplicates': getattr(self, 'near_duplicates', NEAR_DUPLICATES),
+            'near_duplicate_threshold': getattr(self, 'near_duplicate_threshold', PHASH_THRESHOLD),
+            'profile': bool(self.profiling.get()) if hasattr(self, 'profiling') else False,
+            'profile_modes': getattr(self, 'profile_modes', list(PROFILE_MODES)),
+            'manifest': getattr(self, 'manifest_enabled', MANIFEST),
+            'manifest_rollups': getattr(self, 'manifest_rollups', list(MANIFEST_ROLLUPS)),
+            'dns_cache': self.dns_cache.enabled if hasattr(self, 'dns_cache') else DNS_CACHE,
+            'dns_servers': self.dns_cache.servers if hasattr(self, 'dns_cache') else list(DNS_SERVERS),
+            'dns_default_ttl': self.dns_cache.default_ttl if hasattr(self, 'dns_cache') else DNS_DEFAULT_TTL,
+            'prewarm_connections': getattr(self, 'prewarm_connections', PREWARM_CONNECTIONS),
+            'http2': getattr(self, 'http2', HTTP2),
+            'transport_mode': getattr(self, 'transport_mode', TRANSPORT_MODE),
+            'recording_folder': getattr(self, 'recording_folder', RECORDING_FOLDER),
+            'replay_latency_ms': getattr(self, 'replay_latency_ms', REPLAY_LATENCY_MS),
+            'replay_bandwidth_kbps': getattr(self, 'replay_bandwidth_kbps', REPLAY_BANDWIDTH_KBPS)
         }
         try:
             with open(CONFIG_FILE, 'w') as f:
@@ -482,7 +3661,7 @@ class ImageDownloader:
 
 
     def create_domain_folder(self, domain_name):
-        """Cria a estrutura de pastas: DOWNLOAD_FOLDER/domain_name"""
+        """Cria a estrutura de pastas: DOWNLOAD_FOLDER/domain_name (e a subpasta de parciais)"""
         try:
             main_folder = DOWNLOAD_FOLDER
             if not os.path.exists(main_folder):
@@ -494,6 +3673,11 @@ class ImageDownloader:
                 os.makedirs(domain_folder)
                 self.log_message(f"Created domain folder: {domain_folder}", "success")
 
+            # Pasta oculta para downloads parciais (.part + sidecar com validadores)
+            partial_folder = os.path.join(domain_folder, PARTIAL_FOLDER)
+            if not os.path.exists(partial_folder):
+                os.makedirs(partial_folder)
+
             return domain_folder
 
         except OSError as e:
@@ -503,7 +3687,11 @@ class ImageDownloader:
 
 
     def generate_image_name(self, img_url, response_headers=None):
-        """Gera nome de arquivo válido para a imagem, tentando usar Content-Type"""
+        """
+        Gera nome de arquivo válido para a imagem, tentando usar Content-Type.
+        O nome leva um sufixo com o hash da URL: é determinístico (mesma URL -> mesmo nome)
+        e URLs diferentes com o mesmo basename (/a/1.jpg e /b/1.jpg) não colidem.
+        """
         try:
             # Tenta obter extensão do Content-Type se disponível
             content_type = response_headers.get('content-type', '') if response_headers else ''
@@ -546,11 +3734,10 @@ class ImageDownloader:
 
             # Lida com nomes vazios após limpeza
             if not name_part:
-                timestamp_suffix = int(time.time() * 1000)
-                safe_filename = f"image_{timestamp_suffix}{final_ext}"
+                safe_filename = f"image_{url_hash(img_url)}{final_ext}"
                 self.log_message(f"Generated fallback name for {img_url}: {safe_filename}", "debug", level=logging.DEBUG)
             else:
-                safe_filename = f"{name_part}{final_ext}"
+                safe_filename = f"{name_part}_{url_hash(img_url)}{final_ext}"
 
 
             return safe_filename
@@ -558,12 +3745,17 @@ class ImageDownloader:
         except Exception as e:
             self.log_message(f"Error generating image name for {img_url}: {e}", "error", level=logging.ERROR)
             logging.exception(f"Detailed image name generation error for {img_url}")
-            # Fallback final em caso de erro inesperado
-            return f"fallback_error_{int(time.time() * 1000)}.jpg"
+            # Fallback final em caso de erro inesperado (ainda determinístico)
+            return f"fallback_error_{url_hash(img_url)}.jpg"
 
 
-    def normalize_url(self, url, base_url=None):
-        """Normaliza URL removendo fragmentos, params opcionais e junta com base se relativo"""
+    def normalize_url(self, url, base_url=None, canonical=False):
+        """
+        Normaliza URL removendo fragmentos, params opcionais e junta com base se relativo.
+        canonical=True (URLs de página) também aplica o UrlCanonicalizer: sem parâmetros de
+        rastreamento/sessão e com os parâmetros ordenados. URLs de imagem não passam por isso,
+        pois CDNs com URL assinada podem depender da query exata.
+        """
         if not url:
             return None
         try:
@@ -593,9 +3785,14 @@ class ImageDownloader:
 
             # Recria a URL normalizada (lowercase no scheme e netloc)
             # Mantém case do path e query se existir, pois alguns servidores são case-sensitive
-            normalized = f"{parsed.scheme.lower()}://{parsed.netloc.lower()}{path}"
-            if parsed.query:
-                normalized += f"?{parsed.query}"
+            netloc = parsed.netloc.lower()
+            query = parsed.query
+            if canonical:
+                path = self.canonicalizer.canonical_path(path)
+                query = self.canonicalizer.canonical_query(netloc, query)
+            normalized = f"{parsed.scheme.lower()}://{netloc}{path}"
+            if query:
+                normalized += f"?{query}"
 
             return normalized
 
@@ -647,13 +3844,13 @@ class ImageDownloader:
             return False
 
 
-    def process_page(self, url, depth, base_domain):
+    def process_page(self, url, depth, scope):
         """Processa página para encontrar imagens e links"""
         if self.stop_flag or depth > self.max_depth.get():
             self.log_message(f"Stopping scan for {url}: stop requested or max depth reached ({depth})", "debug", level=logging.DEBUG)
             return
 
-        normalized_url = self.normalize_url(url)
+        normalized_url = self.normalize_url(url, canonical=True)
         if not normalized_url:
             self.log_message(f"Skipping invalid URL: {url}", "warning", level=logging.WARNING)
             return
@@ -662,11 +3859,11 @@ class ImageDownloader:
             self.log_message(f"Skipping already processed URL: {normalized_url}", "debug", level=logging.DEBUG)
             return
 
-        # Verifica se pertence ao domínio base antes de processar
+        # Verifica se pertence ao escopo antes de processar
         try:
             page_domain = urlparse(normalized_url).netloc.lower()
-            # Permite subdomínios do base_domain
-            if not page_domain.endswith(base_domain):
+            # Mesmo domínio registrável (subdomínios incluídos) ou host liberado em scope_allow_hosts
+            if not scope.allows_page(page_domain):
                 self.log_message(f"Skipping external domain: {normalized_url}", "debug", level=logging.DEBUG)
                 return
         except Exception as e:
@@ -675,76 +3872,163 @@ class ImageDownloader:
             return # Ignora URLs inválidas ou com erro na checagem
 
         self.processed_urls.add(normalized_url)
+
+        # Modo incremental: páginas sem novidades recentes não são buscadas de novo,
+        # mas os links conhecidos delas continuam sendo percorridos
+        if self.history and depth > 0:
+            due, known_links = self.history.page_due(normalized_url)
+            if not due:
+                self.log_message(f"Skipping unchanged page (incremental): {normalized_url}", "debug", level=logging.DEBUG)
+                if self.manifest is not None:
+                    self.manifest.write('page', normalized_url, depth=depth, status='unchanged', links=len(known_links))
+                if depth < self.max_depth.get():
+                    for link in known_links:
+                        if link not in self.processed_urls:
+                            self.url_queue.put((depth + 1, link))
+                return
+
         self.pages_processed += 1
 
+        metrics = self.metrics
+        metrics.gauge_add('pages_in_flight', 1)
+        outcome = 'error' # Rótulo do contador de páginas, ajustado nos caminhos de saída
+        response, page_bytes, page_links, error = None, None, [], None # Para o manifesto
+        page_start = time.perf_counter()
         try:
             self.log_message(f"Scanning page ({self.pages_processed}): {url} (Depth {depth})", "info")
-            response = self.session.get(url, timeout=REQUEST_TIMEOUT)
-            response.raise_for_status() # Lança exceção para status >= 400
-
-            # Verifica se é HTML antes de tentar parsear
-            content_type = response.headers.get('content-type', '').lower()
-            if 'html' not in content_type:
-                self.log_message(f"Skipping non-HTML content at {url} ({content_type})", "debug", level=logging.DEBUG)
-                return
-
-            # --- Usa lxml se disponível (tentativa de usar a versão mais rápida) ---
-            parser = 'html.parser' # Default
+            # stream=True: só os headers chegam aqui; o corpo é lido (com limite) depois de checar o tipo
+            response = self.session.get(url, timeout=REQUEST_TIMEOUT, stream=True)
+            # elapsed = até os headers (DNS + conexão + TTFB)
+            metrics.observe('page_request', response.elapsed.total_seconds(), page_domain)
+            metrics.incr('http_responses', label=str(response.status_code))
             try:
-                import lxml
-                parser = 'lxml'
-            except ImportError:
-                # Loga a primeira vez que lxml não é encontrado
-                if not hasattr(self, '_lxml_warned'):
-                    self.log_message("lxml parser not found, using html.parser (slower). Install 'pip install lxml' for better performance.", "warning", level=logging.WARNING)
-                    self._lxml_warned = True # Flag para logar apenas uma vez
-            except Exception as e:
-                self.log_message(f"Error importing lxml, falling back to html.parser: {e}", "warning", level=logging.WARNING)
-                if not hasattr(self, '_lxml_warned'):
-                    self._lxml_warned = True
-
-
+                response.raise_for_status() # Lança exceção para status >= 400
+
+                # Verifica se é HTML antes de baixar o corpo (imagens/PDFs linkados não são lidos)
+                content_type = response.headers.get('content-type', '').lower()
+                if 'html' not in content_type:
+                    self.log_message(f"Skipping non-HTML content at {url} ({content_type})", "debug", level=logging.DEBUG)
+                    outcome = 'non_html'
+                    return
+
+                body_start = time.perf_counter()
+                body, truncated = self._read_page_body(response)
+                metrics.observe('page_body', time.perf_counter() - body_start, page_domain)
+                metrics.incr('page_bytes', len(body), label=page_domain)
+                page_bytes = len(body)
+            finally:
+                response.close() # Devolve a conexão ao pool (ou a descarta, se o corpo não foi lido)
+            if truncated:
+                metrics.incr('pages_truncated', label=page_domain)
+                self.log_message(f"Page larger than {self.max_page_bytes} bytes, parsing only the beginning: {url}", "warning", level=logging.WARNING)
+
+            parser = self._get_html_parser()
             try:
-                soup = BeautifulSoup(response.text, parser)
+                stage_start = time.perf_counter()
+                # Bytes + encoding já conhecido: o parser decodifica direto, sem detecção de charset
+                # sobre o corpo inteiro e sem manter uma cópia str da página
+                soup = bs4.BeautifulSoup(body, parser, from_encoding=sniff_html_encoding(content_type, body))
+                body = None # O corpo não é mais necessário; só a árvore fica em memória
+                metrics.observe('html_parse', time.perf_counter() - stage_start, page_domain)
             except Exception as parse_err: # Captura outros erros de parsing
                 self.log_message(f"Failed to parse HTML at {url} using {parser}: {parse_err}", "error", level=logging.ERROR)
                 logging.exception(f"Detailed HTML parsing error for {url}")
+                error = f"parse error: {parse_err}"
                 return
             # --- Fim do Bloco parser ---
 
 
-            self.find_images_on_page(soup, url) # Chama método separado para imagens
+            stage_start = time.perf_counter()
+            new_images, images_on_page = self.find_images_on_page(soup, url, depth) # Chama método separado para imagens
+            metrics.observe('image_extraction', time.perf_counter() - stage_start, page_domain)
 
+            queued_links = []
             if depth < self.max_depth.get():
-                self.find_links_on_page(soup, url, depth, base_domain) # Chama método separado para links
+                stage_start = time.perf_counter()
+                page_links, queued_links = self.find_links_on_page(soup, url, depth, scope) # Chama método separado para links
+                metrics.observe('link_extraction', time.perf_counter() - stage_start, page_domain)
+            self.trap_detector.record_yield(normalized_url, images_on_page, queued_links) # Limite adaptativo por molde
+
+            if self.history:
+                self.history.record_page(normalized_url, page_links, new_images)
+            outcome = 'ok'
 
 
         except requests.exceptions.Timeout:
+            self._note_congestion()
             self.log_message(f"Timeout accessing {url}", "warning", level=logging.WARNING)
+            error = "timeout"
         except requests.exceptions.TooManyRedirects:
             self.log_message(f"Too many redirects at {url}", "warning", level=logging.WARNING)
+            error = "too many redirects"
+        except RequestCancelled:
+            self.log_message(f"Page request cancelled by stop: {url}", "debug", level=logging.DEBUG)
+            outcome = 'stopped'
         except requests.exceptions.RequestException as e:
             # Loga erros de rede com nível apropriado
             level = logging.ERROR
             tag = "error"
-            if hasattr(e, 'response') and e.response is not None:
+            error = f"HTTP {e.response.status_code}" if getattr(e, 'response', None) is not None else f"network error ({type(e).__name__})"
+            if self.stop_flag:
+                # Conexão derrubada pelo stop: não é um erro de rede
+                self.log_message(f"Page request interrupted by stop: {url}", "debug", level=logging.DEBUG)
+            elif hasattr(e, 'response') and e.response is not None:
+                self._note_congestion(e.response)
                 if e.response.status_code in [404, 403, 401]: # Considerar 4xx como avisos
                     level = logging.WARNING
                     tag = "warning"
                 self.log_message(f"HTTP error scanning {url}: Status {e.response.status_code}", tag, level=level)
+                logging.exception(f"Detailed network error scan {url}") # Loga traceback
             else:
-                 self.log_message(f"Network error scanning {url}: {str(e)}", tag, level=level)
-            logging.exception(f"Detailed network error scan {url}") # Loga traceback
+                self._note_congestion()
+                self.log_message(f"Network error scanning {url}: {str(e)}", tag, level=level)
+                logging.exception(f"Detailed network error scan {url}") # Loga traceback
 
 
         except Exception as e:
             self.log_message(f"Unexpected error processing page {url}: {type(e).__name__} - {str(e)}", "error", level=logging.ERROR)
             logging.exception(f"Detailed exception processing page {url}") # Log completo no arquivo
+            error = f"{type(e).__name__}: {e}"
+
+        finally:
+            metrics.gauge_add('pages_in_flight', -1)
+            metrics.incr('pages', label=outcome)
+            if self.manifest is not None:
+                self.manifest.write('page', normalized_url, depth=depth, status=outcome,
+                                    http_status=response.status_code if response is not None else None,
+                                    bytes=page_bytes, duration=round(time.perf_counter() - page_start, 4),
+                                    links=len(page_links), error=error)
 
 
-    def find_images_on_page(self, soup, base_url):
-        """Encontra URLs de imagem na página e as adiciona ao set"""
+    def _read_page_body(self, response):
+        """
+        Lê o corpo da página em chunks até max_page_bytes (já descomprimido, então vale também
+        contra gzip bomb).
+        :return: (bytes, truncado)
+        """
+        limit = self.max_page_bytes
+        chunks = []
+        size = 0
+        host = urlparse(response.url).netloc
+        throttled = self.bandwidth.active
+        for chunk in response.iter_content(self.bandwidth.chunk_size(PAGE_CHUNK_SIZE) if throttled else PAGE_CHUNK_SIZE):
+            if self.stop_flag:
+                raise RequestCancelled("Page download stopped by user")
+            if throttled:
+                self._throttle(len(chunk), host, priority=True) # Páginas não esperam atrás das imagens
+            chunks.append(chunk)
+            size += len(chunk)
+            if limit and size > limit:
+                return b''.join(chunks)[:limit], True # Para de ler: o resto da página nem é baixado
+        return b''.join(chunks), False
+
+    def find_images_on_page(self, soup, base_url, depth=None):
+        """
+        Encontra URLs de imagem na página e as adiciona ao set.
+        :return: (imagens nunca vistas em execuções anteriores, para o histórico; imagens novas nesta execução)
+        """
         images_found_on_this_page = 0
+        unseen_images = 0 # Imagens nunca vistas em execuções anteriores (modo incremental)
         for img in soup.find_all(['img', 'source']): # Inclui tag <source> para <picture>
             if self.stop_flag: break
             # Pega src ou srcset, tratando srcset básico (pega a primeira URL)
@@ -757,29 +4041,41 @@ class ImageDownloader:
             img_url_abs = self.normalize_url(img_src, base_url=base_url)
 
             if img_url_abs and self.is_image_url(img_url_abs):
-                # Usamos um lock para garantir que a atualização do set e contador seja segura entre threads
-                # Na verdade, como image_urls só é preenchido na fase de scan antes do download,
-                # não precisamos de um lock aqui se a fase de scan for única.
-                # Mas como process_page pode ser chamado por múltiplas threads, é mais seguro usar um lock.
-                # Ou melhor, usamos um set thread-safe ou mecanismos da Queue,
-                # mas para um set simples, um Lock manual é ok.
-                # Vamos usar a abordagem de adicionar e depois verificar o tamanho total fora dos workers.
-                initial_image_count = len(self.image_urls)
-                self.image_urls.add(img_url_abs)
-                if len(self.image_urls) > initial_image_count:
-                    # Apenas incrementa se for uma nova imagem
-                    self.images_found += 1
+                if not self.scope.allows_image(urlparse(img_url_abs).netloc):
+                    self.log_message(f"Skipping image from denied host: {img_url_abs}", "debug", level=logging.DEBUG)
+                    continue
+                # process_page roda em várias threads: o teste "é nova?" e o contador ficam sob o
+                # mesmo lock dos contadores de progresso. A UI só amostra os contadores
+                # periodicamente (_refresh_progress), sem um callback por imagem.
+                with self._progress_lock:
+                    initial_image_count = len(self.image_urls)
+                    self.image_urls.add(img_url_abs)
+                    is_new = len(self.image_urls) > initial_image_count
+                    if is_new:
+                        self.images_found += 1
+                        if self.manifest is not None:
+                            self.image_sources[img_url_abs] = (base_url, depth)
+                if is_new:
+                    # Apenas conta se for uma nova imagem
                     images_found_on_this_page += 1
-                    # Atualiza contagem total encontrada (sem barra de progresso ainda, só texto)
-                    self.update_progress(self.download_count, self.images_found, is_scanning=True)
+                    self._prewarm_host(img_url_abs, image=True) # CDN nova: DNS/conexão prontos antes da fase de download
+                    if self.history and not self.history.is_known_image(img_url_abs):
+                        unseen_images += 1
 
         if images_found_on_this_page > 0:
             self.log_message(f"Found {images_found_on_this_page} new image URL(s) on {base_url}", "debug", level=logging.DEBUG)
 
+        return unseen_images, images_found_on_this_page
+
 
-    def find_links_on_page(self, soup, base_url, depth, base_domain):
-        """Encontra links na página e os adiciona à fila para processamento futuro"""
+    def find_links_on_page(self, soup, base_url, depth, scope):
+        """
+        Encontra links na página e os adiciona à fila.
+        :return: (links do domínio, para o histórico; links enfileirados agora, para o limite de armadilhas)
+        """
         links_added_count = 0
+        queued_links = []
+        domain_links = [] # Todos os links do domínio, inclusive já processados (modo incremental e manifesto)
         for link in soup.find_all('a', href=True):
             if self.stop_flag: break
             href = link['href']
@@ -790,15 +4086,20 @@ class ImageDownloader:
             new_url_abs = self.normalize_url(href, base_url=base_url)
             if not new_url_abs: continue
 
-            new_normalized = self.normalize_url(new_url_abs) # Normaliza de novo para checar domínio
+            new_normalized = self.normalize_url(new_url_abs, canonical=True) # Forma canônica: deduplicação e domínio
+
+            if (self.history or self.manifest is not None) and new_normalized and scope.allows_page(urlparse(new_normalized).netloc):
+                domain_links.append(new_normalized)
 
             if new_normalized and new_normalized not in self.processed_urls:
                 try:
                     new_domain = urlparse(new_normalized).netloc.lower()
-                    # Permanece no domínio/subdomínio do domínio base original
-                    if new_domain.endswith(base_domain):
-                        self.url_queue.put((depth + 1, new_url_abs)) # Adiciona à fila para processar
+                    # Permanece no escopo (domínio registrável da URL inicial e hosts liberados)
+                    if scope.allows_page(new_domain):
+                        self.url_queue.put((depth + 1, new_normalized)) # Enfileira a forma canônica (sem rastreamento)
                         links_added_count += 1
+                        queued_links.append(new_normalized)
+                        self._prewarm_host(new_normalized)
                         self.log_message(f"Added link to queue: {new_normalized} (Depth {depth+1})", "debug", level=logging.DEBUG)
                     #else:
                         #self.log_message(f"Skipping external link: {new_normalized}", "debug", level=logging.DEBUG) # Muito verboso
@@ -812,14 +4113,13 @@ class ImageDownloader:
         #if links_added_count > 0: # Mover log para fora do loop
             #self.log_message(f"Added {links_added_count} links to queue from {base_url}", "debug")
 
+        return domain_links, queued_links
+
 
     def download_image(self, img_url): # Removido 'domain' pois base_domain_name agora é self.
         """Baixa imagem para pasta do domínio"""
         # --- Pausa / Stop Check ---
-        while self.paused and not self.stop_flag:
-            with self.pause_cond:
-                # Espera com timeout curto para que a thread não fique presa se stop_flag mudar
-                self.pause_cond.wait(timeout=0.1)
+        self._wait_while_paused()
         if self.stop_flag:
             self.log_message(f"Download task cancelled for {os.path.basename(img_url)} due to stop request.", "debug", level=logging.DEBUG)
             return False # Download foi parado
@@ -836,141 +4136,753 @@ class ImageDownloader:
              self.log_message(f"Base domain name not set, cannot download {img_url}", "error", level=logging.ERROR)
              return False
 
-        domain_folder = self.create_domain_folder(self.base_domain_name)
+        # Estrutura de pastas resolvida uma única vez por execução (ver _prepare_download_dirs)
+        domain_folder = self.download_dir or self._prepare_download_dirs()
         if not domain_folder:
             # create_domain_folder já logou o erro
             return False # Não pode continuar sem a pasta
 
+        # Já baixada (nome salvo contém o hash da URL): pula sem nenhuma requisição nem stat
+        metrics = self.metrics
+        url_key = url_hash(img_url)
+        if url_key in self._existing_hashes:
+            self.log_message(f"Image already exists, skipping: {img_url}", "info", level=logging.INFO)
+            metrics.incr('images', label='skipped')
+            self._record_image(img_url, 'skipped')
+            return False # Conta como pulado, não falha
+
         # --- Download ---
+        # Parcial determinístico por URL em DOWNLOAD_FOLDER/<domínio>/.partial/: sobrevive a
+        # stop/timeout/erro e é retomado com Range/If-Range na próxima tentativa
+        part_path = os.path.join(domain_folder, PARTIAL_FOLDER, f"{url_key}.part")
+        meta_path = part_path + '.json'
+        tmp_path = None # Parcial em escrita; descartado no finally se não puder ser retomado
+        downloaded_size = 0
+        resume_from = 0
+        partial_state = None # Validadores (ETag forte/Last-Modified) se o parcial puder ser retomado
+        host = urlparse(img_url).netloc.lower()
+        outcome = 'error' # Rótulo do contador de imagens
+        response, img_path, failure, content_hash = None, None, None, None # Para o manifesto
+        hasher = hashlib.sha256() if self.manifest is not None else None
+        download_start = time.perf_counter()
+        metrics.gauge_add('images_in_flight', 1)
         try:
             # Loga o início da tentativa de download para o arquivo/debug
             self.log_message(f"Attempting to download: {os.path.basename(img_url)} from {img_url}", "debug", level=logging.DEBUG)
 
+            # identity: os offsets do Range precisam valer para o corpo exatamente como é gravado
+            request_headers = {'Accept-Encoding': 'identity'}
+            resume_from, validator = 0, None
+            if url_key in self._partial_hashes: # Evita abrir o sidecar de URLs sem parcial
+                resume_from, validator = self._load_partial_state(part_path, meta_path, img_url)
+            if resume_from:
+                request_headers['Range'] = f"bytes={resume_from}-"
+                request_headers['If-Range'] = validator
+
             # Usa stream=True para potencialmente grandes arquivos e lê em chunks
-            response = self.session.get(img_url, stream=True, timeout=REQUEST_TIMEOUT)
+            response = self.image_session.get(img_url, stream=True, timeout=REQUEST_TIMEOUT, headers=request_headers)
+            if resume_from and (response.status_code == 416 or (response.status_code == 206 and not
+                                response.headers.get('content-range', '').startswith(f"bytes {resume_from}-"))):
+                # Range inválido (arquivo remoto encolheu/mudou) ou 206 de outro trecho (os bytes não
+                # continuam o parcial): descarta o parcial e baixa do zero
+                if response.status_code == 206:
+                    self.log_message(f"Server answered range for {img_url} with {response.headers.get('content-range') or 'no Content-Range'}, restarting download", "debug", level=logging.DEBUG)
+                response.close()
+                self._discard_partial(part_path, meta_path)
+                resume_from = 0
+                request_headers.pop('Range')
+                request_headers.pop('If-Range')
+                response = self.image_session.get(img_url, stream=True, timeout=REQUEST_TIMEOUT, headers=request_headers)
+            metrics.observe('image_request', response.elapsed.total_seconds(), host) # DNS + conexão + TTFB
+            metrics.incr('http_responses', label=str(response.status_code))
             response.raise_for_status() # Lança exceção para status >= 400
+            if response.status_code == 206 and not resume_from:
+                # Corpo parcial sem Range pedido: nunca é gravado como se fosse o arquivo inteiro
+                response.close()
+                raise ValueError("Unexpected partial content (206) without a range request")
+
+            # 206 com o offset pedido = retomada; 200 = servidor ignorou o Range ou o arquivo mudou (If-Range)
+            content_range = response.headers.get('content-range', '')
+            if resume_from and response.status_code == 206 and content_range.startswith(f"bytes {resume_from}-"):
+                self.log_message(f"Resuming {os.path.basename(img_url)} from byte {resume_from}", "debug", level=logging.DEBUG)
+            else:
+                if resume_from:
+                    self.log_message(f"Server did not honor range for {img_url}, restarting download", "debug", level=logging.DEBUG)
+                resume_from = 0
+            total_size = self._expected_total_size(response, resume_from)
 
             # Gera nome do arquivo usando headers se possível
             img_name = self.generate_image_name(img_url, response.headers)
-            img_path = os.path.join(domain_folder, img_name)
-
-            # Verifica se o arquivo já existe ANTES de baixar tudo
-            if os.path.exists(img_path):
-                # Opcional: verificar tamanho do arquivo para retomar/sobrescrever?
-                self.log_message(f"Image already exists, skipping: {self.base_domain_name}/{img_name}", "info", level=logging.INFO)
-                return False # Conta como pulado, não falha
-
-            # Escreve o arquivo em chunks
-            # downloaded_size = 0 # Remover se não usado para progress bar por arquivo
-            # total_size = int(response.headers.get('content-length', 0)) # Remover se não usado
-
-            with open(img_path, 'wb') as f:
-                for chunk in response.iter_content(8192): # Chunk size de 8KB
-                    if self.stop_flag:
-                        raise Exception("Download stopped by user") # Levanta exceção para sair do loop
-
-                    # Pausa check dentro do loop de download
-                    while self.paused and not self.stop_flag:
-                        with self.pause_cond:
-                            self.pause_cond.wait(timeout=0.1) # Short timeout for responsiveness
-                    # Verifica stop_flag novamente após sair da pausa
-                    if self.stop_flag:
-                        raise Exception("Download stopped by user") # Levanta exceção para sair do loop
-
+            archive_writer = self.archive_writer
+            img_path = os.path.join(self._image_folder(url_key), img_name) if archive_writer is None else f"{archive_writer.fmt}:{img_name}"
+
+            # Modo shard: imagens pequenas com tamanho conhecido ficam só em memória (nada de
+            # arquivo temporário); as demais passam pelo parcial em disco, que permite retomar
+            in_memory = archive_writer is not None and not resume_from and 0 < total_size <= ARCHIVE_MEMORY_MAX
+
+            # Validadores guardados para o caso de interrupção (o sidecar só é gravado se preciso).
+            # O parcial é exclusivo da URL e cada URL é baixada por um único worker,
+            # então não é preciso lock no caminho de escrita
+            partial_state = None if in_memory else self._partial_validators(img_url, response.headers, total_size)
+            downloaded_size = resume_from
+            if not in_memory:
+                tmp_path = part_path
+            if hasher is not None and resume_from:
+                self._hash_file_prefix(hasher, part_path, resume_from) # Bytes já baixados numa tentativa anterior
+            # Chunk fixo (config) ou adaptativo: arquivos grandes em poucas iterações Python
+            chunk_size = self.chunk_size or adaptive_chunk_size(total_size - resume_from if total_size else 0)
+            throttled = self.bandwidth.active # Lido uma vez: o limite pode mudar no meio, o chunk não
+            if throttled:
+                chunk_size = self.bandwidth.chunk_size(chunk_size)
+            write_time = 0.0
+            body_start = time.perf_counter()
+            data = None
+            sink = io.BytesIO() if in_memory else open(part_path, 'ab' if resume_from else 'wb', buffering=WRITE_BUFFER_SIZE)
+            with sink as f:
+                if not in_memory and total_size - resume_from >= PREALLOCATE_MIN_SIZE:
+                    self._preallocate(f, resume_from, total_size - resume_from)
+                for chunk in response.iter_content(chunk_size):
+                    # Um único teste barato por chunk; a espera/condição só entra em jogo se pausado/parado
+                    if self.paused or self.stop_flag:
+                        self._wait_while_paused()
+                        if self.stop_flag:
+                            raise RequestCancelled("Download stopped by user") # Sai do loop; o parcial fica para o resume
+
+                    if throttled:
+                        self._throttle(len(chunk), host)
+                    if hasher is not None:
+                        hasher.update(chunk)
+                    write_start = time.perf_counter()
                     f.write(chunk)
-                    # downloaded_size += len(chunk) # Remover se não usado
-
-            # Verifica se o arquivo foi criado corretamente (não vazio)
-            if os.path.getsize(img_path) == 0:
-                os.remove(img_path)
+                    write_time += time.perf_counter() - write_start
+                    downloaded_size += len(chunk)
+                if in_memory:
+                    data = f.getvalue()
+                write_start = time.perf_counter()
+            write_time += time.perf_counter() - write_start # flush/close do arquivo
+            metrics.observe('image_body', time.perf_counter() - body_start - write_time, host)
+
+            # Verifica se o arquivo foi criado corretamente (não vazio e completo)
+            if downloaded_size == 0:
                 raise ValueError("Downloaded file is empty")
-
-            # Download concluído com sucesso
-            self.download_count += 1
+            if total_size and downloaded_size < total_size:
+                # Falha de rede (transitória), não de disco: vai para a fila de retentativas e retoma do parcial
+                raise requests.exceptions.ConnectionError(f"Connection closed after {downloaded_size} of {total_size} bytes")
+
+            write_start = time.perf_counter()
+            if archive_writer is not None:
+                # A thread de escrita copia para o shard (e remove o parcial, se houver)
+                written = archive_writer.submit(img_name, img_url, data=data, path=None if in_memory else part_path, response=response)
+                if written is None:
+                    # Worker atrasado depois do fim da execução: o parcial em disco fica (finally), nada vai para o shard
+                    raise RequestCancelled(f"Archive closed before {img_url} could be written")
+                # Só conta como baixada (contador, histórico, _existing_hashes) com a imagem já no shard;
+                # um erro da escrita sobe para os handlers abaixo e o parcial fica para a retentativa
+                written.result()
+            else:
+                # Rename atômico: o arquivo aparece completo ou não aparece
+                os.replace(part_path, img_path)
+            metrics.observe('disk_write', write_time + time.perf_counter() - write_start, host)
+            tmp_path = None
+            if self.post_processor is not None:
+                self.post_processor.submit(img_path, img_url) # Não bloqueia: fila cheia = sem pós-processamento
+            self._existing_hashes.add(url_key)
+            if resume_from: # Só existe sidecar se este download foi uma retomada
+                try: os.remove(meta_path)
+                except OSError: pass
+
+            # Download concluído com sucesso (a UI lê o contador no próximo refresh)
+            with self._progress_lock:
+                self.download_count += 1
+            if self.history:
+                self.history.mark_image(img_url, img_path)
             self.log_message(f"Successfully downloaded: {self.base_domain_name}/{img_name}", "success", level=logging.INFO)
-            self.update_progress(self.download_count, len(self.image_urls)) # Atualiza progresso total
+            self.host_breaker.record_success(host)
+            outcome = 'ok'
+            if hasher is not None:
+                content_hash = hasher.hexdigest()
             return True
 
         except requests.exceptions.Timeout:
+            self._note_congestion()
             self.log_message(f"Timeout downloading {img_url}", "warning", level=logging.WARNING)
+            failure = "timeout"
+            self._download_failed(img_url, host, failure, transient=True)
             return False # Falha no download
 
         except requests.exceptions.TooManyRedirects:
             self.log_message(f"Too many redirects downloading {img_url}", "warning", level=logging.WARNING)
+            failure = "too many redirects"
+            self._download_failed(img_url, host, failure, transient=False)
             return False # Falha no download
 
+        except RequestCancelled:
+            self.log_message(f"Download cancelled by stop: {img_url}", "debug", level=logging.DEBUG)
+            return False
+
         except requests.exceptions.RequestException as e:
+            if self.stop_flag:
+                # Conexão derrubada pelo stop: o parcial fica para o resume, não é um erro de rede
+                self.log_message(f"Download interrupted by stop: {img_url}", "debug", level=logging.DEBUG)
+                return False
+            self._note_congestion(getattr(e, 'response', None))
             # Loga erros de rede com nível apropriado
             level = logging.ERROR
             tag = "error"
             if hasattr(e, 'response') and e.response is not None:
-                if e.response.status_code in [404, 403, 401]: # Considerar 4xx como avisos
+                status = e.response.status_code
+                if status in [404, 403, 401]: # Considerar 4xx como avisos
                     level = logging.WARNING
                     tag = "warning"
-                self.log_message(f"HTTP error downloading {img_url}: Status {e.response.status_code}", tag, level=level)
+                self.log_message(f"HTTP error downloading {img_url}: Status {status}", tag, level=level)
+                failure = f"HTTP {status}"
+                self._download_failed(img_url, host, failure, transient=status >= 500 or status == 429,
+                                      retry_after=parse_retry_after(e.response))
             else:
-                 self.log_message(f"Network error downloading {img_url}: {str(e)}", tag, level=level)
+                self.log_message(f"Network error downloading {img_url}: {str(e)}", tag, level=level)
+                failure = f"network error ({type(e).__name__})"
+                self._download_failed(img_url, host, failure, transient=True)
             logging.exception(f"Detailed network error download {img_url}") # Loga traceback
             return False # Falha no download
 
 
         except IOError as e:
             # Captura erros de escrita no disco
-            self.log_message(f"File system error saving {img_url} to {img_path}: {e}", "error", level=logging.ERROR)
+            self.log_message(f"File system error saving {img_url} to {tmp_path or domain_folder}: {e}", "error", level=logging.ERROR)
             logging.exception(f"Detailed IOError saving image {img_url}")
-            # Tenta limpar o arquivo parcial se ele existir
-            if 'img_path' in locals() and os.path.exists(img_path):
-                try: os.remove(img_path)
-                except OSError: pass # Ignora erros na remoção
+            failure = f"file system error: {e}"
+            self._download_failed(img_url, host, failure, transient=False)
             return False
 
         except Exception as e:
             # Captura qualquer outro erro inesperado
             self.log_message(f"Unexpected error downloading {img_url}: {type(e).__name__} - {str(e)}", "error", level=logging.ERROR)
             logging.exception(f"Detailed unexpected exception downloading image {img_url}")
-            # Tenta limpar o arquivo parcial se ele existir
-            if 'img_path' in locals() and os.path.exists(img_path):
-                try: os.remove(img_path)
-                except OSError: pass # Ignora erros na remoção
+            failure = f"{type(e).__name__}: {e}"
+            self._download_failed(img_url, host, failure, transient=False)
             return False
 
-    def update_progress(self, current, total, is_scanning=False):
-        """Atualiza a barra de progresso e o texto (thread-safe)"""
-        # Função para atualizar a GUI na thread principal
-        def perform_update():
+        finally:
+            metrics.gauge_add('images_in_flight', -1)
+            metrics.incr('images', label='stopped' if outcome == 'error' and self.stop_flag else outcome)
+            if self.manifest is not None:
+                if outcome == 'ok':
+                    record_status = 'ok'
+                elif self.stop_flag or failure is None:
+                    record_status = 'stopped'
+                else: # Transitória vai para a fila de retentativas; definitiva entra nas falhas finais
+                    record_status = 'failed' if img_url in self.failed_downloads else 'retry'
+                self._record_image(img_url, record_status, http_status=response.status_code if response is not None else None,
+                                   bytes=downloaded_size or None, duration=round(time.perf_counter() - download_start, 4),
+                                   path=img_path if outcome == 'ok' else None, sha256=content_hash, error=failure)
+            if downloaded_size > resume_from:
+                metrics.incr('bytes_downloaded', downloaded_size - resume_from, label=host)
+                with self._progress_lock:
+                    self.bytes_downloaded += downloaded_size - resume_from
+
+            # Parcial com validador é mantido para retomar na próxima tentativa; sem validador
+            # não há como garantir que os bytes ainda valem, então é descartado
+            if tmp_path:
+                if partial_state and downloaded_size > 0:
+                    # Remove a pré-alocação: o tamanho do parcial é o offset da retomada
+                    try:
+                        os.truncate(tmp_path, downloaded_size)
+                        with open(meta_path, 'w', encoding='utf-8') as f:
+                            json.dump(partial_state, f)
+                        self._partial_hashes.add(url_key) # Uma retentativa nesta execução retoma daqui
+                    except OSError:
+                        self._discard_partial(tmp_path, meta_path)
+                    self.log_message(f"Keeping partial download of {img_url} ({downloaded_size} bytes) for resume", "debug", level=logging.DEBUG)
+                else:
+                    self._discard_partial(tmp_path, meta_path)
+
+    @staticmethod
+    def _hash_file_prefix(hasher, path, size):
+        """Alimenta o hash com os primeiros size bytes de um arquivo (parcial de um download retomado)"""
+        with open(path, 'rb') as f:
+            while size > 0:
+                block = f.read(min(size, WRITE_BUFFER_SIZE))
+                if not block:
+                    break
+                hasher.update(block)
+                size -= len(block)
+
+    def _download_failed(self, img_url, host, reason, transient, retry_after=None):
+        """
+        Trata a falha de um download: falhas transitórias vão para a fila de retentativas
+        adiadas (e contam para o disjuntor do host); as demais, ou as que esgotaram as
+        tentativas, entram na lista de falhas finais do resumo.
+        """
+        if self.stop_flag:
+            return # Interrompido pelo stop: não é falha do host nem da URL
+        if not transient:
+            self.host_breaker.record_success(host) # O host respondeu; o problema é da URL
+            self._record_final_failure(img_url, reason)
+            return
+        if self.host_breaker.record_failure(host):
+            self.metrics.incr('circuit_breaker_trips', label=host)
+            self.log_message(f"Circuit breaker open for {host}: pausing requests to this host", "warning", level=logging.WARNING)
+        delay = self.retry_queue.schedule(img_url, retry_after)
+        if delay is None:
+            self._record_final_failure(img_url, f"{reason} (gave up after {self.retry_queue.max_attempts} retries)")
+            return
+        self.metrics.incr('retries_scheduled', label=host)
+        self.log_message(f"Retrying {img_url} in {delay:.1f}s ({reason})", "debug", level=logging.DEBUG)
+
+    def _record_final_failure(self, img_url, reason):
+        with self._progress_lock:
+            self.failed_downloads[img_url] = reason
+        self.metrics.incr('download_failures', label=reason.split(' (', 1)[0])
+
+    def _next_download_target(self, pending_targets):
+        """
+        Próxima URL a baixar: retentativas vencidas primeiro, depois as que esperavam vaga no
+        host, depois as novas. Cada URL ocupa uma vaga do orçamento do seu host (HostSlots).
+        URLs de hosts com disjuntor aberto são estacionadas na fila adiada; de hosts fora do ar,
+        viram falha.
+        :return: URL ou None se não há nada pronto agora.
+        """
+        slots = self.host_slots
+        while True:
+            img_url = self.retry_queue.pop_due()
+            reserved = False
+            if img_url is None:
+                img_url = slots.pop_ready()
+                reserved = img_url is not None
+            if img_url is None:
+                img_url = next(pending_targets, None)
+            if img_url is None:
+                img_url = slots.pop_ready(overflow=True) # Só sobraram hosts no teto: usa os workers livres
+                reserved = img_url is not None
+            if img_url is None:
+                return None
+            host = urlparse(img_url).netloc.lower()
+            if self.host_breaker.is_dead(host):
+                if reserved:
+                    slots.release(host)
+                self._record_final_failure(img_url, f"host {host} unavailable (circuit breaker open)")
+            elif not reserved and not slots.acquire(host, img_url):
+                continue # Host no teto: a URL espera vaga e o worker vai para outro host
+            elif self.host_breaker.allow(host, img_url):
+                return img_url
+            else:
+                slots.release(host)
+                if not self.retry_queue.park(img_url, self.host_breaker.retry_at(host)):
+                    self._record_final_failure(img_url, f"host {host} unavailable (circuit breaker open)")
+
+    def _download_in_host_slot(self, img_url):
+        """
+        download_image devolvendo a vaga do host antes de o future terminar (o loop já a vê livre)
+        e liberando o teste do disjuntor se esta URL era o teste e saiu sem resolvê-lo.
+        """
+        host = urlparse(img_url).netloc.lower()
+        try:
+            return self.download_image(img_url)
+        finally:
+            self.host_breaker.end_probe(host, img_url)
+            self.host_slots.release(host)
+
+    def _prepare_download_dirs(self):
+        """
+        Resolve e cria a estrutura de saída uma única vez por execução e indexa o que já existe
+        (hashes de imagens salvas e de parciais), evitando stat/makedirs por imagem.
+        """
+        domain_folder = self.create_domain_folder(self.base_domain_name)
+        if not domain_folder:
+            return None
+        existing, partials = set(), set()
+        for dirpath, dirnames, filenames in os.walk(domain_folder):
+            if dirpath == domain_folder and DERIVED_FOLDER in dirnames:
+                dirnames.remove(DERIVED_FOLDER) # Miniaturas/conversões não contam como imagem baixada
+            if os.path.basename(dirpath) == PARTIAL_FOLDER:
+                partials.update(name.split('.', 1)[0] for name in filenames if name.endswith('.part.json'))
+                continue
+            for name in filenames:
+                match = SAVED_NAME_HASH_RE.search(name)
+                if match:
+                    existing.add(match.group(1))
+        self._partial_hashes = partials
+        self._created_shards = set()
+        if self.output_mode in ArchiveWriter.FORMATS:
+            # Modo shard: o que já foi baixado está nos índices laterais dos shards
             try:
-                # Check if widgets exist before updating
-                if not (hasattr(self, 'progress_bar') and self.progress_bar.winfo_exists() and
-                        hasattr(self, 'lbl_progress') and self.lbl_progress.winfo_exists()):
-                    return # Do nothing if widgets are gone
-
-                if is_scanning:
-                    self.lbl_progress.config(text=f"Scanning... Found {total} images on {self.pages_processed} pages")
-                    # Não atualiza a barra de progresso no modo scanning determinate
+                existing |= ArchiveWriter.existing_url_hashes(domain_folder)
+            except OSError as e:
+                self.log_message(f"Could not read archive indexes in {domain_folder}: {e}", "warning", level=logging.WARNING)
+            self.archive_writer = ArchiveWriter(domain_folder, self.output_mode, self.archive_shard_bytes, self.archive_metadata).start()
+            self.log_message(f"Writing images into {self.output_mode} shards of up to {self.archive_shard_bytes // (1024 * 1024)} MB in {domain_folder}", "info")
+        self._existing_hashes = existing
+        self.download_dir = domain_folder
+        self._start_post_processor(domain_folder)
+        self.log_message(f"Output folder ready: {domain_folder} ({len(existing)} images already present, {len(partials)} resumable partials)", "debug", level=logging.DEBUG)
+        return domain_folder
+
+    def _start_post_processor(self, domain_folder):
+        """Cria o pool de pós-processamento da execução, se houver etapas configuradas"""
+        steps = list(self.postprocess_steps)
+        if self.near_duplicates and 'phash' not in steps:
+            steps.append('phash')
+        if not steps:
+            return
+        if self.output_mode != 'files':
+            self.log_message("Post-processing runs only with output_mode 'files'; skipping it for this run", "warning", level=logging.WARNING)
+            return
+        if importlib.util.find_spec('PIL') is None:
+            unavailable = [step for step in steps if step in PILLOW_STEPS]
+            if unavailable:
+                self.log_message(f"Pillow not installed: skipping post-processing steps {', '.join(unavailable)} (pip install Pillow)", "warning", level=logging.WARNING)
+                steps = [step for step in steps if step not in PILLOW_STEPS]
+            if not steps:
+                return
+        options = {
+            'derived_dir': os.path.join(domain_folder, DERIVED_FOLDER),
+            'thumbnail_size': self.thumbnail_size,
+            'webp_quality': self.webp_quality,
+        }
+        if 'phash' in steps:
+            self._open_near_duplicate_index()
+        self.post_processor = PostProcessor(steps, options, self.postprocess_workers, self._postprocess_result)
+        self.log_message(f"Post-processing enabled: {', '.join(steps)} ({self.postprocess_workers} processes)", "info")
+
+    def _postprocess_result(self, img_url, img_path, status, detail):
+        """Resultado de um arquivo do pós-processamento (roda numa thread do pool, não num worker de download)"""
+        self.metrics.incr('postprocess', label=status)
+        if status == 'ok':
+            self.log_message(f"Post-processed {os.path.basename(img_path)}", "debug", level=logging.DEBUG)
+            if detail.get('phash') and self.near_duplicate_index is not None:
+                self._check_near_duplicate(img_url, img_path, detail['phash'])
+        elif status == 'invalid':
+            self.log_message(f"Invalid image {img_url}: {detail}", "warning", level=logging.WARNING)
+            if self.postprocess_delete_invalid:
+                # Sem o arquivo (e fora do histórico), a imagem é baixada de novo na próxima execução
+                try:
+                    size = os.path.getsize(img_path)
+                    os.remove(img_path)
+                except OSError:
+                    pass
+                else: # Não conta mais como baixada: contadores da UI/resumo descontam o arquivo
+                    with self._progress_lock:
+                        self.download_count -= 1
+                        self.bytes_downloaded -= size
+                self._existing_hashes.discard(url_hash(img_url))
+                if self.history:
+                    self.history.forget_image(img_url)
+            self._record_image(img_url, 'invalid', path=img_path, error=str(detail))
+        else:
+            self.log_message(f"Post-processing failed for {img_url}: {detail}", "error", level=logging.ERROR)
+
+    def _open_near_duplicate_index(self):
+        """Carrega o índice de hashes perceptuais do domínio; variantes já descartadas não são baixadas de novo"""
+        self.near_duplicates_dropped = 0
+        index = NearDuplicateIndex(os.path.join(HISTORY_FOLDER, f"{self.base_domain_name}.phash.jsonl"),
+                                   self.near_duplicate_threshold)
+        try:
+            index.load()
+        except (OSError, ValueError, KeyError) as e:
+            self.log_message(f"Could not load near-duplicate index {index.path}: {e}", "warning", level=logging.WARNING)
+            return
+        self.near_duplicate_index = index
+        self._existing_hashes |= {url_hash(url) for url in index.suppressed}
+        self.log_message(f"Near-duplicate index: {len(index.by_url)} images, {len(index.suppressed)} dropped variants "
+                         f"(threshold {index.threshold})", "info")
+
+    def _check_near_duplicate(self, img_url, img_path, phash):
+        """
+        Compara a imagem recém-baixada com as já mantidas: de cada grupo de variantes fica só a
+        de maior resolução; as outras são apagadas e registradas no manifesto.
+        """
+        value = int(phash['hash'], 16)
+        record = {'url': img_url, 'file': img_path, 'width': phash['width'], 'height': phash['height']}
+        matches = [(distance, other) for distance, other in self.near_duplicate_index.find(value) if other['url'] != img_url]
+        if matches:
+            distance, best = max(matches, key=lambda match: match[1]['width'] * match[1]['height'])
+            if record['width'] * record['height'] <= best['width'] * best['height']:
+                self._drop_near_duplicate(record, best, distance)
+                return
+            for distance, other in matches:
+                self._drop_near_duplicate(other, record, distance)
+        self.near_duplicate_index.add(value, record)
+
+    def _drop_near_duplicate(self, dropped, kept, distance):
+        """Apaga uma variante (e seus derivados) e a registra no índice e no manifesto"""
+        self.near_duplicate_index.suppress(dropped['url'], kept['url'])
+        try:
+            size = os.path.getsize(dropped['file'])
+            os.remove(dropped['file'])
+        except OSError:
+            pass
+        else: # A variante não conta mais como baixada (os derivados nunca contaram)
+            with self._progress_lock:
+                self.download_count -= 1
+                self.bytes_downloaded -= size
+        paths = []
+        stem = os.path.splitext(os.path.basename(dropped['file']))[0]
+        derived_dir = os.path.join(self.download_dir, DERIVED_FOLDER)
+        if os.path.isdir(derived_dir): # Miniatura/WebP têm o mesmo nome base da imagem
+            for kind in os.listdir(derived_dir):
+                for ext in ('.jpg', '.webp'):
+                    paths.append(os.path.join(derived_dir, kind, stem + ext))
+        for path in paths:
+            try:
+                os.remove(path)
+            except OSError:
+                pass
+        entry = {'url': dropped['url'], 'file': dropped['file'], 'width': dropped['width'], 'height': dropped['height'],
+                 'duplicate_of': kept['url'], 'kept_file': kept['file'], 'distance': distance,
+                 'time': datetime.now().isoformat(timespec='seconds')}
+        try:
+            with open(os.path.join(self.download_dir, NEAR_DUPLICATE_MANIFEST), 'a', encoding='utf-8') as f:
+                f.write(json.dumps(entry) + '\n')
+        except OSError as e:
+            self.log_message(f"Could not write {NEAR_DUPLICATE_MANIFEST}: {e}", "warning", level=logging.WARNING)
+        self.near_duplicates_dropped += 1
+        self.metrics.incr('near_duplicates')
+        self._record_image(dropped['url'], 'near_duplicate', path=dropped['file'], error=f"near-duplicate of {kept['url']} (distance {distance})")
+        self.log_message(f"Near-duplicate: dropped {dropped['width']}x{dropped['height']} {dropped['url']} "
+                         f"(kept {kept['width']}x{kept['height']} {kept['url']}, distance {distance})", "debug", level=logging.DEBUG)
+
+    def _close_post_processor(self, cancel=False):
+        """Espera o pós-processamento pendente (ou o descarta, num stop) e loga o resumo"""
+        processor, self.post_processor = self.post_processor, None
+        if processor is None:
+            return
+        counts = processor.close(cancel=cancel)
+        self.log_message(f"Post-processing: {counts['ok']} ok, {counts['invalid']} invalid, "
+                         f"{counts['error']} errors, {counts['skipped']} skipped", "info")
+        index, self.near_duplicate_index = self.near_duplicate_index, None
+        if index is not None:
+            index.close()
+            if self.near_duplicates_dropped:
+                self.log_message(f"Dropped {self.near_duplicates_dropped} near-duplicate variants (see {NEAR_DUPLICATE_MANIFEST})", "info")
+
+    def _start_profiler(self):
+        """Cria (na primeira vez na execução) e liga o perfilamento"""
+        if self.profiler is None:
+            self.profiler = RunProfiler(self.profile_modes)
+        self.profiler.start()
+        self.log_message(f"Profiling on: {', '.join(sorted(self.profiler.modes)) or 'no modes configured'}", "info")
+
+    def _apply_profiling(self):
+        """Profile ligado/desligado: vale na hora durante uma execução, senão na próxima"""
+        if not getattr(self, 'is_running', False):
+            return # Também o trace disparado pelo load_config antes do __init__ terminar
+        if self.profiling.get():
+            self._start_profiler()
+        elif self.profiler is not None and self.profiler.active:
+            self.profiler.stop()
+            self.log_message("Profiling paused; reports are written when the run finishes", "info")
+
+    def set_profiling(self, enabled):
+        """Liga/desliga o perfilamento (UI, scripts, CLI), inclusive no meio de uma execução"""
+        self.profiling.set(bool(enabled)) # Na UI o trace aplica; sem UI aplica aqui
+        if self.root is None:
+            self._apply_profiling()
+
+    def _close_profiler(self):
+        """Para o perfilamento e grava os relatórios por estágio"""
+        profiler, self.profiler = self.profiler, None
+        if profiler is None:
+            return
+        profiler.stop()
+        if profiler.cprofile_error:
+            self.log_message(f"cProfile unavailable in this run: {profiler.cprofile_error}", "warning", level=logging.WARNING)
+        folder = os.path.join(PROFILE_FOLDER, f"{self.base_domain_name}_{datetime.now().strftime('%Y%m%d_%H%M%S')}")
+        try:
+            written = profiler.write_reports(folder)
+            self.log_message(f"Profile reports written to {folder}: {', '.join(written)}", "info")
+        except (OSError, TypeError, ValueError) as e:
+            self.log_message(f"Failed to write profile reports to {folder}: {e}", "error", level=logging.ERROR)
+            logging.exception("Detailed profile report error")
+
+    def _close_manifest(self):
+        """Fecha o manifesto da execução e grava os rollups configurados"""
+        manifest, self.manifest = self.manifest, None
+        if manifest is None:
+            return
+        manifest.close()
+        self.log_message(f"Run manifest written: {manifest.path} ({manifest.records} records)", "info")
+        for fmt in self.manifest_rollups:
+            if fmt == 'parquet' and importlib.util.find_spec('pyarrow') is None:
+                self.log_message("pyarrow not installed: skipping the Parquet manifest rollup (pip install pyarrow)", "warning", level=logging.WARNING)
+                continue
+            try:
+                path = manifest.write_csv() if fmt == 'csv' else manifest.write_parquet()
+                self.log_message(f"Manifest rollup written: {path}", "info")
+            except Exception as e: # Rollup é acessório: o JSONL já está completo
+                self.log_message(f"Failed to write {fmt} rollup of {manifest.path}: {e}", "warning", level=logging.WARNING)
+                logging.exception(f"Detailed {fmt} rollup error")
+
+    def _record_image(self, img_url, status, **fields):
+        """Registro de uma imagem no manifesto; página de origem e profundidade vêm do scan"""
+        manifest = self.manifest
+        if manifest is not None:
+            source_page, depth = self.image_sources.get(img_url, (None, None))
+            manifest.write('image', img_url, source_page=source_page, depth=depth, status=status, **fields)
+
+    def _close_archive_writer(self):
+        """Descarrega a fila da thread de escrita e fecha o shard aberto"""
+        writer, self.archive_writer = self.archive_writer, None
+        if writer is None:
+            return
+        writer.close()
+        if writer.records:
+            shards = ', '.join(os.path.basename(path) for path in writer.shards_written)
+            self.log_message(f"Archived {writer.records} images into {shards}", "info")
+
+    def _image_folder(self, url_key):
+        """Pasta final da imagem: a do domínio, ou uma subpasta derivada do hash se SHARD_LEVELS > 0"""
+        if not self.shard_levels:
+            return self.download_dir
+        shard = os.path.join(*(url_key[2 * i:2 * i + 2] for i in range(self.shard_levels)))
+        if shard not in self._created_shards:
+            # Criada uma vez por execução; exist_ok cobre a corrida entre workers
+            os.makedirs(os.path.join(self.download_dir, shard), exist_ok=True)
+            self._created_shards.add(shard)
+        return os.path.join(self.download_dir, shard)
+
+    def _wait_while_paused(self):
+        """Bloqueia a thread enquanto a operação estiver pausada (retorna logo se parada)"""
+        while self.paused and not self.stop_flag:
+            # Sem polling: resume e stop setam o evento
+            self._resume_event.wait()
+
+    def _preallocate(self, f, offset, length):
+        """Reserva espaço em disco para o corpo (menos fragmentação); ignorado se o SO/FS não suportar"""
+        if not hasattr(os, 'posix_fallocate'):
+            return
+        try:
+            os.posix_fallocate(f.fileno(), offset, length)
+        except OSError:
+            pass # Ex.: sistema de arquivos sem suporte; segue sem pré-alocar
+
+    def _load_partial_state(self, part_path, meta_path, img_url):
+        """Retorna (offset, validador) de um parcial retomável desta URL, ou (0, None)"""
+        try:
+            with open(meta_path, 'r', encoding='utf-8') as f:
+                meta = json.load(f)
+            offset = os.path.getsize(part_path)
+        except (OSError, ValueError):
+            return 0, None # Sem parcial (ou sidecar corrompido)
+        validator = meta.get('etag') or meta.get('last_modified')
+        if meta.get('url') != img_url or not validator or not offset:
+            self._discard_partial(part_path, meta_path)
+            return 0, None
+        if meta.get('total') and offset >= meta['total']:
+            # Parcial maior/igual ao total esperado não é confiável: recomeça
+            self._discard_partial(part_path, meta_path)
+            return 0, None
+        return offset, validator
+
+    def _partial_validators(self, img_url, headers, total_size):
+        """Conteúdo do sidecar de retomada a partir da resposta, ou None se o parcial não for retomável"""
+        etag = headers.get('etag', '')
+        if etag.startswith('W/'):
+            etag = '' # If-Range exige validador forte
+        last_modified = headers.get('last-modified', '')
+        if (not etag and not last_modified) or headers.get('accept-ranges', '').lower() == 'none':
+            return None
+        return {'url': img_url, 'etag': etag, 'last_modified': last_modified, 'total': total_size}
+
+    def _discard_partial(self, part_path, meta_path):
+        """Remove o parcial e o sidecar de uma URL (ignora se não existirem)"""
+        for path in (part_path, meta_path):
+            try: os.remove(path)
+            except OSError: pass # Ignora erros na remoção
+
+    def _expected_total_size(self, response, resume_from):
+        """Tamanho total esperado do arquivo (0 se desconhecido), a partir de Content-Range ou Content-Length"""
+        try:
+            if resume_from:
+                # Content-Range: bytes <início>-<fim>/<total>
+                total = response.headers.get('content-range', '').rsplit('/', 1)[-1]
+                return int(total) if total.isdigit() else 0
+            return int(response.headers.get('content-length', 0))
+        except ValueError:
+            return 0
+
+    def update_progress(self, current, total, is_scanning=False):
+        """Atualiza a barra de progresso e o texto (thread-safe). Usado nas mudanças de fase/estado."""
+        # Schedule update on the main thread
+        if hasattr(self, 'root') and self.root:
+            self.root.after(0, lambda: self._apply_progress(current, total, is_scanning))
+
+    def _apply_progress(self, current, total, is_scanning, rate_text=''):
+        """Desenha o progresso na UI (somente na thread principal do Tkinter)"""
+        try:
+            # Check if widgets exist before updating
+            if not (hasattr(self, 'progress_bar') and self.progress_bar.winfo_exists() and
+                    hasattr(self, 'lbl_progress') and self.lbl_progress.winfo_exists()):
+                return # Do nothing if widgets are gone
+
+            if is_scanning:
+                self.lbl_progress.config(text=f"Scanning... Found {total} images on {self.pages_processed} pages{rate_text}")
+                # Não atualiza a barra de progresso no modo scanning determinate
+                animate = not self.paused and not self.stop_flag
+                if str(self.progress_bar['mode']) != 'indeterminate' or animate != getattr(self, '_bar_animating', False):
                     self.progress_bar.config(mode='indeterminate') # Modo indeterminado durante o scan
-                    if not self.paused and not self.stop_flag:
+                    if animate:
                         self.progress_bar.start() # Anima a barra
                     else:
                         self.progress_bar.stop() # Para a animação se pausado/parado
+                    self._bar_animating = animate
 
-                else: # Modo download
-                    self.progress_bar.config(mode='determinate') # Modo determinado para download
+            else: # Modo download
+                if str(self.progress_bar['mode']) != 'determinate':
                     self.progress_bar.stop() # Para a animação indeterminada se estiver rodando
-                    total_for_progress = max(total, 1) # Evita divisão por zero
-                    progress_percent = (current / total_for_progress) * 100
-                    self.progress_bar['value'] = progress_percent
-                    self.lbl_progress.config(text=f"Downloading... {current}/{total} images ({progress_percent:.1f}%)")
+                    self.progress_bar.config(mode='determinate') # Modo determinado para download
+                    self._bar_animating = False
+                total_for_progress = max(total, 1) # Evita divisão por zero
+                progress_percent = (current / total_for_progress) * 100
+                self.progress_bar['value'] = progress_percent
+                self.lbl_progress.config(text=f"Downloading... {current}/{total} images ({progress_percent:.1f}%){rate_text}")
+
+        except tk.TclError as e:
+            # Ignore TclError if GUI is closing
+            pass
+        except Exception as e:
+            logging.error(f"Error updating progress bar: {e}")
 
-            except tk.TclError as e:
-                # Ignore TclError if GUI is closing
-                pass
-            except Exception as e:
-                logging.error(f"Error updating progress bar: {e}")
+    def _start_progress_refresh(self):
+        """Inicia a amostragem periódica dos contadores (custo de UI constante, independente dos workers)"""
+        if self._progress_job is None and self.root is not None:
+            self._rate_samples.clear()
+            self._progress_job = self.root.after(PROGRESS_REFRESH_MS, self._refresh_progress)
 
+    def _refresh_progress(self):
+        """Amostra os contadores, calcula taxa/ETA na janela deslizante e redesenha (thread principal)"""
+        if not self.is_running:
+            self._progress_job = None
+            return
 
-        # Schedule update on the main thread
-        if hasattr(self, 'root') and self.root:
-            self.root.after(0, perform_update)
+        now = time.monotonic()
+        with self._progress_lock:
+            downloaded, total_bytes, found = self.download_count, self.bytes_downloaded, self.images_found
+        samples = self._rate_samples
+        if self.phase != getattr(self, '_rate_phase', None):
+            samples.clear() # A taxa do scan não vale para o download
+            self._rate_phase = self.phase
+        samples.append((now, downloaded, total_bytes, self.pages_processed))
+        while len(samples) > 2 and now - samples[0][0] > PROGRESS_RATE_WINDOW:
+            samples.popleft()
+        oldest = samples[0]
+        elapsed = now - oldest[0]
+
+        if self.phase == 'download':
+            total = len(self.download_targets)
+            rate_text = ''
+            if elapsed > 0:
+                img_rate = (downloaded - oldest[1]) / elapsed
+                mb_rate = (total_bytes - oldest[2]) / elapsed / (1024 * 1024)
+                rate_text = f" - {img_rate:.1f} img/s, {mb_rate:.2f} MB/s"
+                if img_rate > 0:
+                    eta = int((total - downloaded) / img_rate)
+                    rate_text += f", ETA {eta // 60:02d}:{eta % 60:02d}"
+            self._apply_progress(downloaded, total, False, rate_text)
+        elif self.phase == 'scan':
+            rate_text = f" - {(self.pages_processed - oldest[3]) / elapsed:.1f} pages/s" if elapsed > 0 else ''
+            self._apply_progress(downloaded, found, True, rate_text)
+
+        self._progress_job = self.root.after(PROGRESS_REFRESH_MS, self._refresh_progress)
 
 
     def toggle_pause(self):
@@ -986,9 +4898,7 @@ class ImageDownloader:
             else:
                 self.log_message("Operation Resumed", "info")
                 self.btn_pause.config(text="Pause")
-                # Notifica threads esperando na condição de pausa
-                with self.pause_cond:
-                    self.pause_cond.notify_all()
+                # As threads pausadas acordam pelo evento de resume (setter de paused)
                 # Atualiza a barra de progresso para retomar a animação se estiver no modo scan
                 self.update_progress(self.download_count, self.images_found, is_scanning=self.progress_bar['mode'] == 'indeterminate')
 
@@ -999,11 +4909,10 @@ class ImageDownloader:
             self.log_message("No operation is currently running to stop.", "info")
             return
 
-        self.stop_flag = True
-        self.log_message("Stop requested. Finishing current tasks...", "warning")
-        # Garante que threads pausadas ou esperando na fila sejam notificadas para verificar stop_flag
-        with self.pause_cond:
-            self.pause_cond.notify_all()
+        self.stop_flag = True # Também acorda threads pausadas
+        # Interrompe as requisições em andamento em vez de esperar o timeout de leitura
+        interrupted = self._interrupt_connections()
+        self.log_message(f"Stop requested. Interrupted {interrupted} connection(s)...", "warning")
 
         # A thread principal run_scan_and_download vai detectar o stop_flag e chamar finish_download
 
@@ -1042,15 +4951,73 @@ class ImageDownloader:
             return
 
         # Valida e normaliza a URL inicial
-        initial_normalized_url = self.normalize_url(start_url)
+        initial_normalized_url = self.normalize_url(start_url, canonical=True)
         if not initial_normalized_url or not urlparse(initial_normalized_url).netloc:
             messagebox.showwarning("Input Error", "Invalid URL format.")
             self.log_message(f"Invalid initial URL format: {start_url}", "error", level=logging.ERROR)
             return
 
+        self._prepare_run(start_url, initial_normalized_url)
+
+        self.progress_bar['value'] = 0
+        self.lbl_progress.config(text="Starting...")
+        # Limpa o log da GUI no início
+        if hasattr(self, 'log_text') and self.log_text.winfo_exists():
+            self.log_text.config(state=tk.NORMAL)
+            self.log_text.delete(1.0, tk.END)
+            self.log_text.config(state=tk.DISABLED)
+
+
+        self.set_buttons_state(tk.DISABLED, tk.NORMAL, tk.NORMAL)
+
+
+        # Inicia a thread principal de controle/execução
+        self.is_running = True
+        self.master_thread = Thread(target=self.run_scan_and_download, daemon=True)
+        self.master_thread.start()
+        self._start_progress_refresh()
+
+
+    def run_headless(self, start_url, on_started=None):
+        """
+        Executa scan + download de forma síncrona, sem interface (scripts, benchmarks).
+        :param on_started: chamado quando o estado já foi resetado e a execução conta como em
+                           andamento (stop/pausa a partir daí valem para ela), antes do scan.
+        :return: dict com o resumo da execução.
+        """
+        if self.is_running:
+            raise RuntimeError("An operation is already running.")
+        start_url = (start_url or '').strip()
+        initial_normalized_url = self.normalize_url(start_url, canonical=True)
+        if not initial_normalized_url or not urlparse(initial_normalized_url).netloc:
+            raise ValueError(f"Invalid initial URL format: {start_url}")
+
+        self._prepare_run(start_url, initial_normalized_url)
+        self.is_running = True
+        if on_started is not None:
+            on_started()
+        self.run_scan_and_download() # finish_download é chamado no finally
+
+        return {
+            'start_url': initial_normalized_url,
+            'pages_processed': self.pages_processed,
+            'images_found': len(self.image_urls),
+            'images_targeted': len(self.download_targets),
+            'downloaded': self.download_count,
+            'failed': dict(self.failed_downloads),
+            'download_dir': self.download_dir,
+            'manifest': self.manifest_path if self.manifest_enabled else None,
+        }
+
+
+    def _prepare_run(self, start_url, initial_normalized_url):
+        """Reseta o estado e enfileira a URL inicial (comum à execução com UI e sem UI)"""
         # Obtém o domínio base para restringir o scan e nome para a pasta
         self.base_domain = urlparse(initial_normalized_url).netloc.lower()
         self.base_domain_name = self.get_safe_domain_name(start_url) # Usa URL original para extração
+        scope = self.scope = CrawlScope(initial_normalized_url, self.scope_allow_hosts, self.scope_deny_hosts)
+        origin_limit, cdn_limit = self.origin_image_connections, self.cdn_image_connections
+        self.host_slots = HostSlots(lambda host: origin_limit if scope.allows_page(host) else cdn_limit)
 
 
         # Reset state variables
@@ -1059,20 +5026,63 @@ class ImageDownloader:
         self.download_count = 0
         self.images_found = 0
         self.pages_processed = 0
+        self.bytes_downloaded = 0
+        self._rate_samples.clear()
         # Limpa as filas e sets para uma nova execução
         while not self.url_queue.empty():
             self.url_queue.get()
         self.processed_urls.clear()
         self.image_urls.clear()
-
-
-        self.progress_bar['value'] = 0
-        self.lbl_progress.config(text="Starting...")
-        # Limpa o log da GUI no início
-        if hasattr(self, 'log_text') and self.log_text.winfo_exists():
-            self.log_text.config(state=tk.NORMAL)
-            self.log_text.delete(1.0, tk.END)
-            self.log_text.config(state=tk.DISABLED)
+        self.download_targets = []
+        self.download_dir = None # Resolvida de novo no início da fase de download
+        self.metrics = RunMetrics()
+        self.trap_detector = TrapDetector(self.trap_max_per_template)
+        self._setup_tuners()
+        self.retry_queue = DeferredRetryQueue()
+        self.host_breaker = HostCircuitBreaker()
+        self.failed_downloads = {}
+        self.image_sources = {}
+        self.profiler = None
+        if self.profiling.get():
+            self._start_profiler()
+        self.manifest = None
+        if self.manifest_enabled:
+            try:
+                self.manifest = RunManifest(self.base_domain_name)
+                self.manifest_path = self.manifest.path
+            except OSError as e:
+                self.log_message(f"Could not create run manifest in {MANIFEST_FOLDER}: {e}", "warning", level=logging.WARNING)
+        if self.connection_warmer is not None:
+            self.connection_warmer.close()
+        # Sem cache de DNS ainda vale abrir a conexão antes; sem nenhum dos dois não há o que aquecer
+        # No replay não há rede: nada de DNS nem conexões
+        self.connection_warmer = ConnectionWarmer(self.session, self.dns_cache, connect=self.prewarm_connections,
+                                                  image_session=self.image_session) \
+            if (self.prewarm_connections or self.dns_cache.enabled) and self.transport_mode != 'replay' else None
+        self._apply_bandwidth_limit()
+        if self.bandwidth.active:
+            host_limits = ''.join(f", {host}: {kbps} KB/s" for host, kbps in self.host_bandwidth_limits.items() if kbps)
+            self.log_message(f"Bandwidth limit: {self._get_bandwidth_kbps() or 'unlimited'} KB/s{host_limits}", "info")
+
+        # Modo incremental: carrega o histórico do domínio (páginas e imagens já vistas)
+        self.history = None
+        cached = self.history_cache.get(self.base_domain_name) if self.history_cache is not None else None
+        if self.incremental_mode.get() and cached is not None:
+            self.history = cached
+            self.history.start_run()
+            self.log_message(f"Incremental mode: history with {len(self.history.images)} images and {len(self.history.pages)} pages kept in memory", "info")
+        elif self.incremental_mode.get():
+            self.history = RunHistory(self.base_domain_name)
+            try:
+                if self.history.load():
+                    self.log_message(f"Incremental mode: loaded history with {len(self.history.images)} images and {len(self.history.pages)} pages", "info")
+                else:
+                    self.log_message("Incremental mode: no history yet for this domain, full run", "info")
+            except (OSError, ValueError) as e:
+                self.log_message(f"Could not read run history {self.history.path}: {e}. Starting a fresh history.", "warning", level=logging.WARNING)
+                self.history = RunHistory(self.base_domain_name)
+            if self.history_cache is not None:
+                self.history_cache[self.base_domain_name] = self.history
 
 
         # Adiciona a URL inicial na fila
@@ -1080,110 +5090,227 @@ class ImageDownloader:
 
         self.log_message(f"Starting scan and download for: {initial_normalized_url}", "info")
         self.log_message(f"Scanning domain: {self.base_domain} up to depth {self.max_depth.get()}", "info")
+        if scope.allow_hosts or scope.deny_hosts:
+            self.log_message(f"Scope: {scope.site} and subdomains, also allowed: {', '.join(scope.allow_hosts) or '-'}, "
+                             f"denied: {', '.join(scope.deny_hosts) or '-'}", "info")
         self.log_message(f"Images will be saved in: {DOWNLOAD_FOLDER}/{self.base_domain_name}/", "info")
 
 
-        self.set_buttons_state(tk.DISABLED, tk.NORMAL, tk.NORMAL)
-
-
-        # Inicia a thread principal de controle/execução
-        self.is_running = True
-        self.master_thread = Thread(target=self.run_scan_and_download, daemon=True)
-        self.master_thread.start()
+    def _get_html_parser(self):
+        """Usa lxml se disponível (mais rápido); decidido uma vez, na primeira página, e não a cada página"""
+        if self._html_parser is None:
+            try:
+                import lxml
+                self._html_parser = 'lxml'
+            except ImportError:
+                self.log_message("lxml parser not found, using html.parser (slower). Install 'pip install lxml' for better performance.", "warning", level=logging.WARNING)
+                self._html_parser = 'html.parser'
+            except Exception as e:
+                self.log_message(f"Error importing lxml, falling back to html.parser: {e}", "warning", level=logging.WARNING)
+                self._html_parser = 'html.parser'
+        return self._html_parser
 
+    def _get_workers(self):
+        """Concorrência configurada (campo Workers), limitada a 1..MAX_WORKERS_LIMIT"""
+        try:
+            return min(max(int(self.workers.get()), 1), MAX_WORKERS_LIMIT)
+        except (tk.TclError, ValueError):
+            return MAX_WORKERS # Campo vazio/inválido
+
+    def _prewarm_host(self, url, image=False):
+        """Host possivelmente novo: resolve o nome e abre uma conexão em segundo plano, enquanto a URL espera na fila"""
+        warmer = self.connection_warmer
+        if warmer is not None and not self.stop_flag:
+            warmer.discover(url, image=image)
+
+    def _close_connection_warmer(self):
+        """Encerra o pré-aquecimento e loga o uso do cache de DNS"""
+        warmer, self.connection_warmer = self.connection_warmer, None
+        if warmer is not None:
+            warmer.close()
+            self.log_message(f"Pre-warmed {warmer.warmed} of {len(warmer.seen)} discovered hosts", "debug", level=logging.DEBUG)
+        cache = self.dns_cache
+        if cache.enabled and cache.lookups:
+            self.log_message(f"DNS cache: {cache.hits} hits, {cache.lookups} lookups "
+                             f"({cache.lookup_seconds / cache.lookups * 1000:.1f} ms avg)", "debug", level=logging.DEBUG)
+
+    def _get_bandwidth_kbps(self):
+        """Limite global configurado (campo KB/s); 0 = sem limite"""
+        try:
+            return max(int(self.bandwidth_kbps.get()), 0)
+        except (tk.TclError, ValueError):
+            return 0 # Campo vazio/inválido (ainda sendo digitado)
+
+    def _apply_bandwidth_limit(self):
+        """Aplica o campo KB/s e os limites por host ao BandwidthLimiter (vale para as leituras seguintes)"""
+        if not hasattr(self, 'bandwidth'):
+            return # Trace disparado pelo load_config antes do __init__ criar o limitador
+        self.bandwidth.set_limits(self._get_bandwidth_kbps() * 1024,
+                                  {host: kbps * 1024 for host, kbps in self.host_bandwidth_limits.items()})
+
+    def set_bandwidth_limit(self, kbps, host_limits_kbps=None):
+        """
+        Altera o limite de banda durante a execução (UI, scripts, API).
+        :param kbps: limite global em KB/s (0 = sem limite)
+        :param host_limits_kbps: dict padrão de host -> KB/s; None mantém os atuais
+        """
+        if host_limits_kbps is not None:
+            self.host_bandwidth_limits = {str(host): max(int(value), 0) for host, value in host_limits_kbps.items()}
+        self.bandwidth_kbps.set(max(int(kbps), 0)) # Na UI o trace aplica; sem UI aplica aqui
+        self._apply_bandwidth_limit()
+        self.log_message(f"Bandwidth limit set to {self._get_bandwidth_kbps() or 'unlimited'} KB/s", "info")
+
+    def _throttle(self, nbytes, host, priority=False):
+        """Aplica o limite de banda a um chunk lido; a espera é interrompida pelo stop"""
+        delay = self.bandwidth.consume(nbytes, host, priority)
+        if delay > 0:
+            self.metrics.observe('bandwidth_wait', delay, host)
+            event = getattr(self._task_state, 'stop_event', None) or self._stop_event
+            event.wait(delay)
+
+    def _setup_tuners(self):
+        """Cria os limites de concorrência da execução (fixos ou com autotune)"""
+        workers = self._get_workers()
+        autotune = bool(self.autotune.get())
+        learned = ConcurrencyTuner.load_learned(self.base_domain_name) if autotune else {}
+        self.download_tuner = ConcurrencyTuner('download', learned.get('download', workers),
+                                               self.min_workers, self.max_workers, enabled=autotune)
+        self.scan_tuner = ConcurrencyTuner('scan', learned.get('scan', workers // 2 or 1),
+                                           max(self.min_workers // 2, 1), self.max_workers // 2 or 1, enabled=autotune)
+        for tuner in (self.download_tuner, self.scan_tuner):
+            self.metrics.gauge_set(f"{tuner.name}_concurrency", tuner.limit)
+        if autotune:
+            source = "learned from previous runs" if learned else "initial"
+            self.log_message(f"Autotune: download concurrency {self.download_tuner.limit}, scan {self.scan_tuner.limit} ({source}), "
+                             f"bounds {self.download_tuner.minimum}-{self.download_tuner.maximum}", "info")
+
+    def _retune(self, tuner, total_units):
+        """Deixa o tuner avaliar a janela atual e registra a mudança de limite, se houver"""
+        change = tuner.update(total_units)
+        if change:
+            old, new, reason = change
+            self.metrics.gauge_set(f"{tuner.name}_concurrency", new)
+            self.log_message(f"Autotune: {tuner.name} concurrency {old} -> {new} ({reason})", "debug", level=logging.DEBUG)
 
     def run_scan_and_download(self):
         """Controla o processo de scan e download usando ThreadPoolExecutor"""
+        self._start_metrics_exporter()
         try:
             # --- Fase de Scan ---
             self.log_message("Starting scan phase to discover images and links...", "info")
+            self.phase = 'scan'
             self.update_progress(self.download_count, self.images_found, is_scanning=True) # Inicia barra no modo scan
 
             # Executor para o scan (processar páginas)
             # Usa menos threads para scan, pois é mais CPU bound (parsing) e menos I/O bound (rede, disco)
-            with ThreadPoolExecutor(max_workers=MAX_WORKERS // 2 or 1) as scan_executor:
-                scan_futures = set()
-
-                while not self.stop_flag and (not self.url_queue.empty() or scan_futures):
+            stop_event = self._stop_event # Evento de stop desta execução, herdado pelas tarefas
+            scan_tuner = self.scan_tuner
+            # O executor tem threads até o teto; quem limita a concorrência é o número de tarefas submetidas
+            scan_executor = ThreadPoolExecutor(max_workers=scan_tuner.maximum, thread_name_prefix='scan')
+            scan_futures = set()
+            try:
+                while not self.stop_flag:
+                    if self.paused:
+                        self._wait_while_paused() # Tarefas em andamento pausam sozinhas
+                        continue
 
-                    # Adiciona novas tarefas de scan enquanto houver URLs na fila e espaço no executor
-                    while not self.paused and not self.stop_flag and not self.url_queue.empty() and len(scan_futures) < (MAX_WORKERS // 2 or 1) * 2: # Limita o número de tarefas na fila para evitar excesso de memória
+                    # Adiciona novas tarefas de scan até o limite de concorrência atual
+                    while len(scan_futures) < scan_tuner.limit:
                         try:
                             depth, url = self.url_queue.get_nowait() # Tenta pegar sem bloquear
-                            # Normalizar e checar novamente para URLs da fila (segurança extra)
-                            normalized_url_from_queue = self.normalize_url(url)
-                            if not normalized_url_from_queue or normalized_url_from_queue in self.processed_urls:
-                                self.log_message(f"Skipping queued URL (processed or invalid): {url}", "debug", level=logging.DEBUG)
-                                continue # Pula este item da fila
-
-                            future = scan_executor.submit(self.process_page, normalized_url_from_queue, depth, self.base_domain)
-                            scan_futures.add(future)
-                        except Queue.Empty:
+                        except Empty:
+                            scan_tuner.note_starved()
                             break # Fila vazia no momento
-
-                    # Processa futuros de scan concluídos
-                    done_futures = set()
-                    for future in scan_futures:
-                        if future.done():
-                            try:
-                                future.result() # Captura e propaga exceções do worker
-                            except Exception as exc:
-                                # Exceções já devem ser logadas dentro de process_page
-                                # logging.error(f"Scan task generated an exception: {exc}") # Evita log duplicado se já logado dentro do worker
-                                pass # Ignora exceções que já foram logadas
-                            done_futures.add(future)
-
-                    scan_futures -= done_futures
-
-                    # Espera um pouco para evitar busy-waiting
-                    if not self.url_queue.empty() or scan_futures:
-                        time.sleep(0.05) # Curto sleep
-                    elif self.paused:
-                        with self.pause_cond:
-                            self.pause_cond.wait() # Espera na condição de pausa
-                    else:
-                        time.sleep(0.1) # Espera um pouco mais se a fila e futuros estão vazios
-            # scan_executor.shutdown(wait=True) # feito pelo 'with' statement
+                        # Normalizar e checar novamente para URLs da fila (segurança extra)
+                        normalized_url_from_queue = self.normalize_url(url, canonical=True)
+                        if not normalized_url_from_queue or normalized_url_from_queue in self.processed_urls:
+                            self.log_message(f"Skipping queued URL (processed or invalid): {url}", "debug", level=logging.DEBUG)
+                            continue # Pula este item da fila
+                        # Armadilhas de crawler (calendários, paginação infinita...) são cortadas antes do fetch
+                        trap_reason = self.trap_detector.check(normalized_url_from_queue)
+                        if trap_reason is not None:
+                            self.metrics.incr('pages', label='trap')
+                            if trap_reason:
+                                self.log_message(f"Possible crawler trap, skipping {normalized_url_from_queue}: {trap_reason}", "warning", level=logging.WARNING)
+                            continue
+                        scan_futures.add(scan_executor.submit(self._run_task, stop_event, scan_tuner, self.process_page,
+                                                              normalized_url_from_queue, depth, self.scope))
+
+                    if not scan_futures:
+                        break # Fila vazia e nenhuma página em andamento: scan concluído
+
+                    # Bloqueia até uma página terminar (ou o stop); sem sleeps de polling
+                    scan_futures = self._wait_for_tasks(scan_futures)
+                    self._retune(scan_tuner, self.pages_processed)
+            finally:
+                self._shutdown_executor(scan_executor, scan_futures)
 
 
             if self.stop_flag:
                 self.log_message("Scan phase aborted by user.", "warning")
             else:
                 self.log_message(f"Scan phase finished. Found {len(self.image_urls)} unique images across {self.pages_processed} pages.", "info")
-
+            if self.trap_detector.skipped:
+                self.log_message(f"Trap detection skipped {self.trap_detector.skipped} URLs ({len(self.trap_detector.capped_templates)} URL patterns capped)", "info")
+            capped = sorted(self.trap_detector.capped_templates.items(), key=lambda item: item[1], reverse=True)
+            if capped:
+                # Páginas reais (catálogo grande) também podem bater no limite: o usuário precisa saber o que ficou de fora
+                listed = ', '.join(f"{template} ({count} skipped)" for template, count in capped[:5])
+                self.log_message(f"URL patterns capped after {self.trap_detector.max_per_template} fetches without new images or links: {listed}"
+                                 f"{f' and {len(capped) - 5} more' if len(capped) > 5 else ''}. "
+                                 f"Raise trap_max_per_template in {CONFIG_FILE} (0 = no limit) if these are real pages.", "warning", level=logging.WARNING)
+
+
+            # Modo incremental: só baixa imagens que não foram vistas em execuções anteriores
+            if self.history:
+                self.download_targets = [u for u in self.image_urls if not self.history.is_known_image(u)]
+                self.log_message(f"Incremental mode: {len(self.download_targets)} new of {len(self.image_urls)} images ({self.history.pages_skipped} unchanged pages skipped)", "info")
+            else:
+                self.download_targets = list(self.image_urls)
 
             # Check if stopped or no images found before starting download
-            if self.stop_flag or not self.image_urls:
-                self.finish_download() # Chama finalização mesmo sem download
+            # (finish_download é chamado pelo bloco finally)
+            if self.stop_flag or not self.download_targets:
                 return
 
             # --- Fase de Download ---
-            total_images_to_download = len(self.image_urls)
+            if not self._prepare_download_dirs():
+                return
+            total_images_to_download = len(self.download_targets)
             self.log_message(f"Starting download phase for {total_images_to_download} images...", "info")
+            self.phase = 'download'
             self.update_progress(self.download_count, total_images_to_download, is_scanning=False) # Muda para modo download na barra
 
             # Executor para download
             # Pode usar mais threads para download, pois é mais I/O bound (rede, disco)
-            with ThreadPoolExecutor(max_workers=MAX_WORKERS) as download_executor:
-                # Submete todas as imagens para download
-                download_futures = {download_executor.submit(self.download_image, img_url): img_url for img_url in self.image_urls}
-
-                # Espera a conclusão das tarefas de download
-                for future in as_completed(download_futures):
-                    if self.stop_flag:
-                        # Ao parar, cancela futures restantes (melhor esforço)
-                        for remaining_future in download_futures:
-                            remaining_future.cancel()
-                        break # Sai do loop de resultados
-
-                    # img_url = download_futures[future] # Não é mais necessário, o log interno já tem a URL
-                    try:
-                        future.result() # Garante que exceções do worker sejam tratadas (já logadas dentro de download_image)
-                    except Exception:
-                        # Exceções já são logadas em download_image, apenas ignoramos aqui
-                        pass
-
-            # download_executor.shutdown(wait=True) # feito pelo 'with' statement
+            # Submissão limitada ao limite de concorrência atual (fixo ou do autotune): um stop não
+            # precisa cancelar milhares de futures e a memória não cresce com o total de imagens
+            download_tuner = self.download_tuner
+            download_executor = ThreadPoolExecutor(max_workers=download_tuner.maximum, thread_name_prefix='download')
+            download_futures = set()
+            pending_targets = iter(self.download_targets)
+            try:
+                while not self.stop_flag:
+                    if self.paused:
+                        self._wait_while_paused()
+                        continue
+
+                    while len(download_futures) < download_tuner.limit:
+                        img_url = self._next_download_target(pending_targets)
+                        if img_url is None:
+                            download_tuner.note_starved() # Cauda da fila: menos tarefas que o limite
+                            break
+                        download_futures.add(download_executor.submit(self._run_task, stop_event, download_tuner,
+                                                                      self._download_in_host_slot, img_url))
+
+                    # Dorme até uma tarefa terminar, a próxima retentativa vencer ou um stop
+                    next_retry = self.retry_queue.next_due_in()
+                    if not download_futures and next_retry is None:
+                        break # Todas as imagens processadas e nenhuma retentativa pendente
+                    download_futures = self._wait_for_tasks(download_futures, timeout=next_retry)
+                    self._retune(download_tuner, self.bytes_downloaded)
+            finally:
+                self._shutdown_executor(download_executor, download_futures)
 
         except Exception as e:
             self.log_message(f"An unexpected error occurred during scan or download process: {str(e)}", "error", level=logging.CRITICAL)
@@ -1192,9 +5319,69 @@ class ImageDownloader:
         finally:
             self.finish_download()
 
+    def _wait_for_tasks(self, futures, timeout=None):
+        """Espera ao menos uma tarefa terminar (ou um stop/timeout) e retorna as que seguem pendentes"""
+        done, pending = wait(futures | {self._stop_waiter}, timeout=timeout, return_when=FIRST_COMPLETED)
+        pending.discard(self._stop_waiter)
+        for future in done:
+            if future is self._stop_waiter:
+                continue
+            try:
+                future.result()
+            except Exception:
+                pass # Exceções já são logadas dentro de process_page/download_image
+        return pending
+
+    def _shutdown_executor(self, executor, futures):
+        """Encerra um executor; num stop, não fica preso esperando tarefas bloqueadas"""
+        if not self.stop_flag:
+            executor.shutdown(wait=True)
+            return
+        # As requisições foram interrompidas pelo stop: dá um tempo curto para as tarefas
+        # saírem e cancela as que ainda não começaram. Uma tarefa presa num connect() termina
+        # sozinha em segundo plano (o evento de stop dela continua setado).
+        wait(futures, timeout=STOP_GRACE_PERIOD)
+        executor.shutdown(wait=False, cancel_futures=True)
+
+    def _start_metrics_exporter(self):
+        """Inicia a thread que grava metrics.json/metrics.prom a cada metrics_interval segundos"""
+        self._metrics_stop.clear()
+        if not self.metrics_interval:
+            return
+
+        def export_loop():
+            while not self._metrics_stop.wait(self.metrics_interval):
+                self._export_metrics()
+
+        Thread(target=export_loop, name='metrics-exporter', daemon=True).start()
+
+    def _export_metrics(self):
+        """Amostra os gauges (fila, bytes/s) e grava os arquivos de métricas"""
+        try:
+            self.metrics.gauge_set('url_queue_depth', self.url_queue.qsize())
+            self.metrics.sample_rates()
+            self.metrics.write_files(METRICS_FILE, METRICS_PROM_FILE)
+        except OSError as e:
+            logging.error(f"Failed to write metrics files: {e}")
+
+    def _log_metrics_summary(self):
+        """Para o exportador, grava o snapshot final e loga o resumo por estágio"""
+        self._metrics_stop.set()
+        if self.metrics_interval:
+            self._export_metrics()
+        for line in self.metrics.summary_lines():
+            self.log_message(f"Stage {line}", "info")
+
     def finish_download(self):
         """Limpa e finaliza o processo"""
-        self.is_running = False
+        self.is_running = False # Também encerra o refresh periódico do progresso
+        self.phase = 'idle'
+        self._close_archive_writer() # Antes do histórico: só registra o que já está no shard
+        self._close_post_processor(cancel=self.stop_flag) # Idem: imagens inválidas saem do histórico
+        self._close_connection_warmer()
+        self._close_profiler()
+        self._close_manifest()
+        self._log_metrics_summary()
         # Reset flags
         was_stopped = self.stop_flag
         self.stop_flag = False
@@ -1202,12 +5389,13 @@ class ImageDownloader:
 
         # Garante que a barra de progresso pare e chegue a 100% (ou 0% se nada foi encontrado/parado no início)
         final_download_count = self.download_count
-        total_found = len(self.image_urls)
+        total_found = len(self.download_targets) if self.history else len(self.image_urls)
         self.update_progress(final_download_count, total_found, is_scanning=False)
-        if total_found == 0: # Se nada foi encontrado, barra fica em 0
-            self.progress_bar['value'] = 0
-        else: # Caso contrário, barra vai para 100%
-             self.progress_bar['value'] = 100
+        if self.root is not None:
+            if total_found == 0: # Se nada foi encontrado, barra fica em 0
+                self.progress_bar['value'] = 0
+            else: # Caso contrário, barra vai para 100%
+                 self.progress_bar['value'] = 100
 
 
         if was_stopped:
@@ -1220,10 +5408,49 @@ class ImageDownloader:
             final_message = f"Operation Finished. Downloaded {final_download_count}/{total_found} images to {DOWNLOAD_FOLDER}/{self.base_domain_name}/"
             self.log_message(final_message, "success")
 
-        self.lbl_progress.config(text=final_message) # Atualiza label final
+        if self.root is not None:
+            self.lbl_progress.config(text=final_message) # Atualiza label final
+
+        # Falhas finais (depois das retentativas adiadas), com o motivo de cada uma
+        if self.failed_downloads:
+            self.log_message(f"{len(self.failed_downloads)} image(s) could not be downloaded:", "warning", level=logging.WARNING)
+            for index, (img_url, reason) in enumerate(self.failed_downloads.items()):
+                if index < FAILURE_SUMMARY_LIMIT:
+                    self.log_message(f"  {img_url}: {reason}", "warning", level=logging.WARNING)
+                else:
+                    logging.warning(f"  {img_url}: {reason}") # O restante só no arquivo de log
+            if len(self.failed_downloads) > FAILURE_SUMMARY_LIMIT:
+                self.log_message(f"  ... and {len(self.failed_downloads) - FAILURE_SUMMARY_LIMIT} more (see {LOG_FILE})", "warning", level=logging.WARNING)
+        dropped_retries = self.retry_queue.drain()
+        if dropped_retries:
+            self.log_message(f"{len(dropped_retries)} pending retries dropped (operation stopped)", "warning", level=logging.WARNING)
+
+        # Persiste o histórico do modo incremental e grava o manifesto delta da execução
+        if self.history:
+            try:
+                self.history.save()
+                domain_folder = self.download_dir or self.create_domain_folder(self.base_domain_name)
+                if domain_folder:
+                    manifest_path = self.history.write_delta_manifest(domain_folder)
+                    self.log_message(f"Delta manifest written: {manifest_path} ({len(self.history.new_images)} new images)", "info")
+            except (OSError, TypeError, ValueError) as e:
+                self.log_message(f"Failed to save run history for {self.base_domain_name}: {e}", "error", level=logging.ERROR)
+                logging.exception("Detailed run history save error")
+            self.history = None
+
+        # Autotune: guarda o melhor limite observado para a próxima execução neste domínio
+        if self.autotune.get() and self.download_tuner:
+            try:
+                learned = ConcurrencyTuner.save_learned(self.base_domain_name, (self.download_tuner, self.scan_tuner))
+                if learned:
+                    self.log_message(f"Autotune: learned concurrency download={learned.get('download', '-')} "
+                                     f"scan={learned.get('scan', '-')} for {self.base_domain_name}", "info")
+            except OSError as e:
+                self.log_message(f"Failed to save learned concurrency to {TUNING_FILE}: {e}", "warning", level=logging.WARNING)
 
         # Restaura estado dos botões
-        self.set_buttons_state(tk.NORMAL, tk.DISABLED, tk.DISABLED)
+        if self.root is not None: # Sem interface não há botões (nem o Tk carregado)
+            self.set_buttons_state(tk.NORMAL, tk.DISABLED, tk.DISABLED)
 
 
     # toggle_pause já está ok com as chamadas a log_message
@@ -1252,12 +5479,546 @@ class ImageDownloader:
             self.root.destroy()
 
 
+class ServiceError(Exception):
+    """Erro de uma chamada à API do serviço; status é o código HTTP da resposta"""
+
+    def __init__(self, status, message):
+        super().__init__(message)
+        self.status = status
+
+
+class CronSchedule:
+    """
+    Expressão cron de 5 campos (minuto hora dia mês dia-da-semana, no horário local) com
+    *, listas (1,15), faixas (1-5) e passos (*/10, 8-18/2); aceita também @hourly, @daily,
+    @weekly e @monthly. Como no cron, se dia e dia-da-semana forem restritos, basta um casar.
+    """
+
+    ALIASES = {'@hourly': '0 * * * *', '@daily': '0 0 * * *', '@weekly': '0 0 * * 0', '@monthly': '0 0 1 * *'}
+    FIELDS = ((0, 59), (0, 23), (1, 31), (1, 12), (0, 7)) # Dia-da-semana: 0 e 7 = domingo
+
+    def __init__(self, expression):
+        self.expression = ' '.join(str(expression).split())
+        parts = self.ALIASES.get(self.expression, self.expression).split()
+        if len(parts) != 5:
+            raise ValueError(f"Cron expression needs 5 fields: {expression!r}")
+        self.minutes, self.hours, self.days, self.months, weekdays = (
+            self._parse_field(part, low, high) for part, (low, high) in zip(parts, self.FIELDS))
+        self.weekdays = {day % 7 for day in weekdays}
+        self.any_day, self.any_weekday = parts[2] == '*', parts[4] == '*'
+
+    @staticmethod
+    def _parse_field(field, low, high):
+        values = set()
+        for item in field.split(','):
+            spec, _, step = item.partition('/')
+            try:
+                step = int(step) if step else 1
+                if spec == '*':
+                    start, end = low, high
+                elif '-' in spec:
+                    start, end = (int(value) for value in spec.split('-', 1))
+                else:
+                    start = int(spec)
+                    end = high if step > 1 else start # "5/15" = a partir de 5, de 15 em 15
+            except ValueError:
+                raise ValueError(f"Invalid cron field: {field!r}") from None
+            if step < 1 or start < low or end > high or start > end:
+                raise ValueError(f"Cron field out of range {low}-{high}: {field!r}")
+            values.update(range(start, end + 1, step))
+        return values
+
+    def _day_matches(self, moment):
+        day_ok = moment.day in self.days
+        weekday_ok = (moment.weekday() + 1) % 7 in self.weekdays # datetime: segunda=0; cron: domingo=0
+        if self.any_day or self.any_weekday:
+            return day_ok and weekday_ok
+        return day_ok or weekday_ok
+
+    def next_after(self, moment):
+        """Primeiro minuto estritamente depois de moment (datetime local) que casa com a expressão"""
+        moment = moment.replace(second=0, microsecond=0) + timedelta(minutes=1)
+        limit = moment + timedelta(days=366 * 4) # Cobre 29/02
+        while moment < limit:
+            if moment.month not in self.months:
+                moment = (moment.replace(day=1, hour=0, minute=0) + timedelta(days=32)).replace(day=1)
+            elif not self._day_matches(moment):
+                moment = moment.replace(hour=0, minute=0) + timedelta(days=1)
+            elif moment.hour not in self.hours:
+                moment = moment.replace(minute=0) + timedelta(hours=1)
+            elif moment.minute not in self.minutes:
+                moment += timedelta(minutes=1)
+            else:
+                return moment
+        raise ValueError(f"Cron expression never matches: {self.expression!r}")
+
+
+class CrawlJob:
+    """Um pedido de crawl do serviço: URL, opções e o estado/resumo da execução"""
+
+    FINAL_STATES = ('finished', 'stopped', 'cancelled', 'failed')
+
+    def __init__(self, url, options, schedule_id=None):
+        self.id = uuid.uuid4().hex[:12]
+        self.url = url
+        self.options = options
+        self.schedule_id = schedule_id
+        self.status = 'queued' # queued -> starting -> running <-> paused -> finished/stopped/failed; queued -> cancelled
+        self.created = time.time()
+        self.started = self.finished = None
+        self.summary = None
+        self.error = None
+        self.cancel_requested = False
+
+    def to_dict(self, progress=None):
+        stamp = lambda value: datetime.fromtimestamp(value).isoformat(timespec='seconds') if value else None
+        data = {
+            'id': self.id, 'url': self.url, 'options': self.options, 'schedule_id': self.schedule_id,
+            'status': self.status, 'created': stamp(self.created), 'started': stamp(self.started),
+            'finished': stamp(self.finished), 'summary': self.summary, 'error': self.error,
+        }
+        if progress is not None:
+            data['progress'] = progress
+        return data
+
+
+class CrawlService:
+    """
+    Modo serviço: fila de jobs de crawl executados um por vez num único ImageDownloader sem
+    interface, que fica vivo entre os jobs (sessão e conexões, cache de DNS, históricos
+    incrementais em memória), e agendamentos cron que enfileiram recrawls.
+    Os agendamentos persistem em SERVICE_SCHEDULES_FILE; execuções perdidas com o serviço
+    parado não são recuperadas (o próximo horário é calculado a partir da inicialização).
+    """
+
+    JOB_OPTIONS = ('depth', 'workers', 'incremental', 'image_types', 'bandwidth_kbps', 'profile')
+
+    def __init__(self, downloader, schedules_file=SERVICE_SCHEDULES_FILE):
+        self.downloader = downloader
+        downloader.history_cache = {} # Conjuntos de páginas/imagens vistas ficam em memória entre os jobs
+        self.defaults = self._current_options() # Valores do config.json, restaurados antes de cada job
+        self.condition = Condition()
+        self.jobs = {} # id -> CrawlJob, na ordem de criação
+        self.pending = deque()
+        self.current = None
+        self.closing = False
+        self.schedules_file = schedules_file
+        self.schedules = {} # id -> {'id', 'url', 'cron', 'options', 'next_run'}
+        self.schedule_wakeup = Event()
+        self._load_schedules()
+        self.threads = [Thread(target=self._run_jobs, daemon=True, name='crawl-jobs'),
+                        Thread(target=self._run_schedules, daemon=True, name='crawl-schedules')]
+
+    def start(self):
+        for thread in self.threads:
+            thread.start()
+
+    def close(self):
+        """Para o job atual e encerra as threads do serviço"""
+        with self.condition:
+            self.closing = True
+            self.condition.notify_all()
+            current = self.current
+        self.schedule_wakeup.set()
+        if current is not None:
+            current.cancel_requested = True
+            self.downloader.stop_download()
+        for thread in self.threads:
+            if thread.is_alive():
+                thread.join(timeout=10)
+
+    # --- Jobs ---
+
+    def _current_options(self):
+        d = self.downloader
+        return {
+            'depth': d.max_depth.get(),
+            'workers': d._get_workers(),
+            'incremental': bool(d.incremental_mode.get()),
+            'image_types': [name for name, var in d.image_types.items() if var.get()],
+            'bandwidth_kbps': d._get_bandwidth_kbps(),
+            'profile': bool(d.profiling.get()),
+        }
+
+    def _validate_options(self, options):
+        options = dict(options or {})
+        unknown = set(options) - set(self.JOB_OPTIONS)
+        if unknown:
+            raise ServiceError(400, f"Unknown job options: {', '.join(sorted(unknown))}")
+        try:
+            if 'depth' in options:
+                options['depth'] = max(int(options['depth']), 0)
+            if 'workers' in options:
+                options['workers'] = min(max(int(options['workers']), 1), MAX_WORKERS_LIMIT)
+            for name in ('incremental', 'profile'):
+                if name in options:
+                    options[name] = bool(options[name])
+            if 'bandwidth_kbps' in options:
+                options['bandwidth_kbps'] = max(int(options['bandwidth_kbps']), 0)
+        except (TypeError, ValueError) as e:
+            raise ServiceError(400, f"Invalid job option: {e}") from None
+        if 'image_types' in options:
+            types = [str(name).upper() for name in options['image_types']]
+            invalid = [name for name in types if name not in self.downloader.image_types]
+            if invalid:
+                raise ServiceError(400, f"Unknown image types: {', '.join(invalid)}")
+            options['image_types'] = types
+        return options
+
+    def _validate_url(self, url):
+        normalized = self.downloader.normalize_url(str(url or '').strip(), canonical=True)
+        if not normalized or not urlparse(normalized).netloc:
+            raise ServiceError(400, f"Invalid URL: {url!r}")
+        return str(url).strip()
+
+    def submit(self, url, options=None, schedule_id=None):
+        job = CrawlJob(self._validate_url(url), self._validate_options(options), schedule_id)
+        with self.condition:
+            if self.closing:
+                raise ServiceError(503, "Service is shutting down")
+            self.jobs[job.id] = job
+            self.pending.append(job)
+            self.condition.notify_all()
+        self.downloader.log_message(f"Job {job.id} queued: {job.url}", "info")
+        return job
+
+    def _get_job(self, job_id):
+        job = self.jobs.get(job_id)
+        if job is None:
+            raise ServiceError(404, f"No such job: {job_id}")
+        return job
+
+    def _progress(self):
+        d = self.downloader
+        return {'phase': d.phase, 'pages_processed': d.pages_processed, 'images_found': d.images_found,
+                'downloaded': d.download_count, 'bytes_downloaded': d.bytes_downloaded}
+
+    def describe(self, job_id):
+        with self.condition:
+            job = self._get_job(job_id)
+            return job.to_dict(self._progress() if job is self.current else None)
+
+    def list_jobs(self):
+        with self.condition:
+            return [job.to_dict(self._progress() if job is self.current else None) for job in self.jobs.values()]
+
+    def pause(self, job_id):
+        with self.condition:
+            job = self._get_job(job_id)
+            # 'starting' também é recusado: _prepare_run ainda vai zerar a pausa
+            if job is not self.current or job.status != 'running':
+                raise ServiceError(409, f"Job {job_id} is {job.status}, only a running job can be paused")
+            self.downloader.paused = True
+            job.status = 'paused'
+        self.downloader.log_message(f"Job {job_id} paused", "warning")
+        return job.to_dict()
+
+    def resume(self, job_id):
+        with self.condition:
+            job = self._get_job(job_id)
+            if job is not self.current or job.status != 'paused':
+                raise ServiceError(409, f"Job {job_id} is {job.status}, only a paused job can be resumed")
+            self.downloader.paused = False
+            job.status = 'running'
+        self.downloader.log_message(f"Job {job_id} resumed", "info")
+        return job.to_dict()
+
+    def cancel(self, job_id):
+        """
+        Job na fila sai da fila; job em execução recebe um stop (fica 'stopped' ao terminar).
+        Job 'starting' (antes de _prepare_run terminar) só é marcado: _job_started aplica o stop.
+        """
+        with self.condition:
+            job = self._get_job(job_id)
+            if job.status in CrawlJob.FINAL_STATES:
+                raise ServiceError(409, f"Job {job_id} is already {job.status}")
+            if job.status == 'queued':
+                self.pending.remove(job)
+                job.status, job.finished = 'cancelled', time.time()
+                return job.to_dict()
+            job.cancel_requested = True
+            if job.status == 'starting':
+                return job.to_dict()
+        self.downloader.stop_download() # Fora do lock: interrompe conexões e loga
+        return job.to_dict()
+
+    def _job_started(self, job):
+        """Chamado pelo run_headless com a execução já em andamento: libera pausa/stop do job"""
+        with self.condition:
+            job.status = 'running'
+            cancelled = job.cancel_requested
+        if cancelled:
+            self.downloader.stop_download() # Cancelado enquanto iniciava
+
+    def _apply_options(self, options):
+        d = self.downloader
+        options = {**self.defaults, **options}
+        d.max_depth.set(options['depth'])
+        d.workers.set(options['workers'])
+        d.incremental_mode.set(options['incremental'])
+        for name, var in d.image_types.items():
+            var.set(name in options['image_types'])
+        d.bandwidth_kbps.set(options['bandwidth_kbps'])
+        d.profiling.set(options['profile'])
+
+    def _run_jobs(self):
+        while True:
+            with self.condition:
+                while not self.pending and not self.closing:
+                    self.condition.wait()
+                if self.closing:
+                    return
+                job = self.pending.popleft()
+                job.status, job.started = 'starting', time.time() # 'running' quando o run_headless já aceita stop/pausa
+                self.current = job
+            try:
+                self._apply_options(job.options)
+                self.downloader.log_message(f"Job {job.id} started: {job.url}", "info")
+                summary = self.downloader.run_headless(job.url, on_started=lambda job=job: self._job_started(job))
+                status, error = ('stopped' if job.cancel_requested else 'finished'), None
+            except Exception as e: # O serviço continua atendendo os próximos jobs
+                summary, status, error = None, 'failed', str(e)
+                logging.exception(f"Job {job.id} failed")
+            with self.condition:
+                job.summary, job.status, job.error, job.finished = summary, status, error, time.time()
+                self.current = None
+                self._prune_jobs()
+            self.downloader.log_message(f"Job {job.id} {status}", "error" if error else "info")
+
+    def _prune_jobs(self):
+        """Mantém só os SERVICE_JOB_HISTORY jobs terminados mais recentes"""
+        finished = [job_id for job_id, job in self.jobs.items() if job.status in CrawlJob.FINAL_STATES]
+        for job_id in finished[:max(len(finished) - SERVICE_JOB_HISTORY, 0)]:
+            del self.jobs[job_id]
+
+    # --- Agendamentos ---
+
+    def _load_schedules(self):
+        if not os.path.exists(self.schedules_file):
+            return
+        try:
+            with open(self.schedules_file, 'r', encoding='utf-8') as f:
+                entries = json.load(f)
+            for entry in entries:
+                self._add_schedule(entry['url'], entry['cron'], entry.get('options'), entry['id'])
+        except (OSError, ValueError, KeyError, TypeError, ServiceError) as e:
+            self.downloader.log_message(f"Could not load schedules from {self.schedules_file}: {e}", "warning", level=logging.WARNING)
+
+    def _save_schedules(self):
+        entries = [{key: schedule[key] for key in ('id', 'url', 'cron', 'options')} for schedule in self.schedules.values()]
+        tmp_path = self.schedules_file + '.tmp'
+        with open(tmp_path, 'w', encoding='utf-8') as f:
+            json.dump(entries, f, indent=4)
+        os.replace(tmp_path, self.schedules_file)
+
+    def _add_schedule(self, url, cron, options, schedule_id=None):
+        try:
+            schedule = CronSchedule(cron)
+            next_run = schedule.next_after(datetime.now())
+        except ValueError as e:
+            raise ServiceError(400, str(e)) from None
+        entry = {'id': schedule_id or uuid.uuid4().hex[:12], 'url': self._validate_url(url), 'cron': schedule.expression,
+                 'options': self._validate_options(options), 'schedule': schedule, 'next_run': next_run, 'last_job': None}
+        with self.condition:
+            self.schedules[entry['id']] = entry
+        return entry
+
+    def _schedule_dict(self, entry):
+        return {'id': entry['id'], 'url': entry['url'], 'cron': entry['cron'], 'options': entry['options'],
+                'next_run': entry['next_run'].isoformat(timespec='seconds'), 'last_job': entry['last_job']}
+
+    def add_schedule(self, url, cron, options=None):
+        entry = self._add_schedule(url, cron, options)
+        self._save_schedules()
+        self.schedule_wakeup.set() # Recalcula a espera do agendador
+        self.downloader.log_message(f"Schedule {entry['id']} added: '{entry['cron']}' {entry['url']}", "info")
+        return self._schedule_dict(entry)
+
+    def remove_schedule(self, schedule_id):
+        with self.condition:
+            if self.schedules.pop(schedule_id, None) is None:
+                raise ServiceError(404, f"No such schedule: {schedule_id}")
+        self._save_schedules()
+        self.schedule_wakeup.set()
+        return {'id': schedule_id, 'removed': True}
+
+    def list_schedules(self):
+        with self.condition:
+            return [self._schedule_dict(entry) for entry in self.schedules.values()]
+
+    def _run_schedules(self):
+        while not self.closing:
+            now = datetime.now()
+            with self.condition:
+                due = [entry for entry in self.schedules.values() if entry['next_run'] <= now]
+                upcoming = min((entry['next_run'] for entry in self.schedules.values()), default=None)
+            for entry in due:
+                entry['next_run'] = entry['schedule'].next_after(now)
+                last_job = self.jobs.get(entry['last_job'])
+                if last_job is not None and last_job.status not in CrawlJob.FINAL_STATES:
+                    self.downloader.log_message(f"Schedule {entry['id']}: previous job {last_job.id} still {last_job.status}, skipping this run",
+                                                "warning", level=logging.WARNING)
+                    continue
+                try:
+                    entry['last_job'] = self.submit(entry['url'], entry['options'], schedule_id=entry['id']).id
+                except ServiceError as e:
+                    self.downloader.log_message(f"Schedule {entry['id']}: {e}", "warning", level=logging.WARNING)
+            if due:
+                continue # Recalcula o próximo horário
+            timeout = 60 if upcoming is None else min(max((upcoming - datetime.now()).total_seconds(), 0.1), 60)
+            self.schedule_wakeup.wait(timeout) # Acorda antes se um agendamento for criado/removido
+            self.schedule_wakeup.clear()
+
+
+class ServiceRequestHandler(BaseHTTPRequestHandler):
+    """
+    API JSON do CrawlService:
+        GET    /jobs                      lista os jobs (com progresso do job em execução)
+        POST   /jobs                      {"url": ..., "options": {"depth": 2, ...}} -> enfileira
+        GET    /jobs/<id>                 detalhes e progresso
+        POST   /jobs/<id>/pause|resume|cancel
+        DELETE /jobs/<id>                 = cancel
+        GET    /schedules                 lista os agendamentos
+        POST   /schedules                 {"url": ..., "cron": "0 3 * * *", "options": {...}}
+        DELETE /schedules/<id>
+    """
+
+    protocol_version = 'HTTP/1.1'
+    service = None # CrawlService, definido por make_service_server
+
+    def log_message(self, format, *args):
+        logging.debug("Service API: " + format % args) # client_address é vazio em socket Unix
+
+    def _send_json(self, status, data):
+        body = json.dumps(data, indent=2).encode('utf-8')
+        self.send_response(status)
+        self.send_header('Content-Type', 'application/json')
+        self.send_header('Content-Length', str(len(body)))
+        self.end_headers()
+        self.wfile.write(body)
+
+    def _read_json(self):
+        length = int(self.headers.get('Content-Length') or 0)
+        if not length:
+            return {}
+        try:
+            data = json.loads(self.rfile.read(length))
+        except ValueError as e:
+            raise ServiceError(400, f"Invalid JSON body: {e}") from None
+        if not isinstance(data, dict):
+            raise ServiceError(400, "JSON body must be an object")
+        return data
+
+    def _dispatch(self, method):
+        parts = [part for part in urlparse(self.path).path.split('/') if part]
+        service = self.service
+        try:
+            if parts == ['jobs'] and method == 'GET':
+                return self._send_json(200, service.list_jobs())
+            if parts == ['jobs'] and method == 'POST':
+                data = self._read_json()
+                return self._send_json(201, service.submit(data.get('url'), data.get('options')).to_dict())
+            if len(parts) == 2 and parts[0] == 'jobs' and method == 'GET':
+                return self._send_json(200, service.describe(parts[1]))
+            if len(parts) == 2 and parts[0] == 'jobs' and method == 'DELETE':
+                return self._send_json(200, service.cancel(parts[1]))
+            if len(parts) == 3 and parts[0] == 'jobs' and method == 'POST' and parts[2] in ('pause', 'resume', 'cancel'):
+                return self._send_json(200, getattr(service, parts[2])(parts[1]))
+            if parts == ['schedules'] and method == 'GET':
+                return self._send_json(200, service.list_schedules())
+            if parts == ['schedules'] and method == 'POST':
+                data = self._read_json()
+                return self._send_json(201, service.add_schedule(data.get('url'), data.get('cron', ''), data.get('options')))
+            if len(parts) == 2 and parts[0] == 'schedules' and method == 'DELETE':
+                return self._send_json(200, service.remove_schedule(parts[1]))
+            raise ServiceError(404, f"No route for {method} {self.path}")
+        except ServiceError as e:
+            self._send_json(e.status, {'error': str(e)})
+
+    def do_GET(self):
+        self._dispatch('GET')
+
+    def do_POST(self):
+        self._dispatch('POST')
+
+    def do_DELETE(self):
+        self._dispatch('DELETE')
+
+
+class _UnixHTTPServer(socketserver.ThreadingMixIn, socketserver.UnixStreamServer):
+    daemon_threads = True
+
+
+def make_service_server(service, host=SERVICE_HOST, port=SERVICE_PORT, socket_path=None):
+    """Servidor HTTP da API (TCP em host:port, ou socket Unix se socket_path for informado)"""
+    handler = type('BoundServiceRequestHandler', (ServiceRequestHandler,), {'service': service})
+    if socket_path:
+        if os.path.exists(socket_path):
+            os.remove(socket_path) # Socket de uma execução anterior
+        return _UnixHTTPServer(socket_path, handler)
+    server = ThreadingHTTPServer((host, port), handler)
+    server.daemon_threads = True
+    return server
+
+
+def run_service(host=SERVICE_HOST, port=SERVICE_PORT, socket_path=None, profile=False):
+    """Roda o modo serviço até Ctrl+C/SIGTERM"""
+    downloader = ImageDownloader(None)
+    if profile:
+        downloader.set_profiling(True) # Vale para todos os jobs
+    service = CrawlService(downloader)
+    server = make_service_server(service, host, port, socket_path)
+    if not socket_path and not ipaddress.ip_address(socket.gethostbyname(host)).is_loopback:
+        downloader.log_message(f"Service API on {host} is reachable from the network and has no authentication", "warning", level=logging.WARNING)
+    signal.signal(signal.SIGTERM, signal.default_int_handler) # SIGTERM encerra como Ctrl+C
+    service.start()
+    address = socket_path or f"http://{host}:{server.server_address[1]}/"
+    downloader.log_message(f"Service listening on {address}", "info")
+    print(f"Service listening on {address}")
+    try:
+        server.serve_forever()
+    except KeyboardInterrupt:
+        pass
+    finally:
+        server.server_close()
+        service.close()
+        downloader.save_config()
+        if socket_path and os.path.exists(socket_path):
+            os.remove(socket_path)
+        downloader.log_message("Service stopped", "info")
+
+
+def parse_args(argv=None):
+    parser = argparse.ArgumentParser(description="Image downloader: Tk interface (default), one headless run or service mode.")
+    parser.add_argument('--url', help="run one crawl without interface and print the summary as JSON")
+    parser.add_argument('--depth', type=int, help="Scan Depth for --url (default: config.json)")
+    parser.add_argument('--serve', action='store_true', help="run as a service with a local HTTP job API")
+    parser.add_argument('--host', default=SERVICE_HOST, help=f"service API address (default {SERVICE_HOST})")
+    parser.add_argument('--port', type=int, default=SERVICE_PORT, help=f"service API port (default {SERVICE_PORT})")
+    parser.add_argument('--socket', help="serve the API on this Unix socket instead of TCP")
+    parser.add_argument('--profile', action='store_true', help=f"profile --url/--serve runs (reports in {PROFILE_FOLDER}/)")
+    return parser.parse_args(argv)
+
+
 if __name__ == "__main__":
+    args = parse_args()
+    if args.serve:
+        run_service(args.host, args.port, args.socket, args.profile)
+        raise SystemExit(0)
+    if args.url:
+        downloader = ImageDownloader(None)
+        if args.depth is not None:
+            downloader.max_depth.set(args.depth)
+        if args.profile:
+            downloader.set_profiling(True)
+        print(json.dumps(downloader.run_headless(args.url), indent=2))
+        raise SystemExit(0)
+
     # Check for lxml availability outside the class if desired for initial print
-    try:
-        import lxml
+    # (find_spec só procura o pacote; o import de verdade fica para a primeira página)
+    if importlib.util.find_spec('lxml') is not None:
         print("lxml parser found.") # Keep this print as requested
-    except ImportError:
+    else:
         print("lxml parser not found. Install 'pip install lxml' for better performance.")
         # The application will fall back to html.parser and log a warning via log_message
 
@@ -0,0 +1,205 @@
+"""
+Benchmark do transporte HTTP/2 (Http2Adapter) contra o HTTP/1.1 padrão.
+
+Serve o site sintético de benchmarks/sitegen.py por HTTPS com hypercorn (ALPN h2 e
+http/1.1, certificado autoassinado gerado com openssl) em outro processo, e roda o
+crawl + download completo do ImageDownloader com http2 desligado e ligado. A latência
+injetada (--latency-ms) é onde a multiplexação aparece: muitas imagens pequenas por host.
+--max-connections imita servidores/CDNs que limitam conexões simultâneas por cliente: as
+conexões além do limite esperam na fila (como o limit_conn do nginx com fila), e aí o
+HTTP/1.1 só tem N requisições em andamento enquanto o HTTP/2 multiplexa todas em uma conexão.
+Sem limite, em loopback o HTTP/2 fica preso à CPU (h2/hpack/httpx são Python puro).
+
+Requer: pip install 'httpx[http2]' hypercorn ; openssl no PATH.
+
+Uso:
+    python benchmarks/bench_http2.py --pages 100 --images-per-page 20 --image-max-kb 30 --latency-ms 20
+    python benchmarks/bench_http2.py --pages 60 --images-per-page 20 --image-max-kb 30 --latency-ms 80 --max-connections 6
+Saída: uma linha JSON por transporte.
+"""
+import argparse
+import asyncio
+import json
+import multiprocessing
+import os
+import random
+import shutil
+import socket
+import subprocess
+import sys
+import tempfile
+import time
+
+BENCH_DIR = os.path.dirname(os.path.abspath(__file__))
+sys.path.insert(0, os.path.dirname(BENCH_DIR))
+sys.path.insert(0, BENCH_DIR)
+
+import sitegen
+from run_bench import run_once
+
+
+def make_certificate(folder):
+    """Certificado autoassinado para 127.0.0.1/localhost; retorna (certfile, keyfile)"""
+    certfile, keyfile = os.path.join(folder, 'cert.pem'), os.path.join(folder, 'key.pem')
+    subprocess.run(['openssl', 'req', '-x509', '-newkey', 'rsa:2048', '-nodes', '-days', '1',
+                    '-keyout', keyfile, '-out', certfile, '-subj', '/CN=localhost',
+                    '-addext', 'subjectAltName=IP:127.0.0.1,DNS:localhost'],
+                   check=True, stdout=subprocess.DEVNULL, stderr=subprocess.DEVNULL)
+    return certfile, keyfile
+
+
+def make_app(site):
+    """App ASGI com o mesmo conteúdo/latência/erros do servidor HTTP/1.1 do sitegen"""
+    spec = site.spec
+    rng = random.Random(spec.seed + 2)
+
+    async def app(scope, receive, send):
+        if scope['type'] == 'lifespan':
+            while True:
+                message = await receive()
+                if message['type'] == 'lifespan.startup':
+                    await send({'type': 'lifespan.startup.complete'})
+                elif message['type'] == 'lifespan.shutdown':
+                    await send({'type': 'lifespan.shutdown.complete'})
+                    return
+        if spec.latency_ms or spec.latency_jitter_ms:
+            await asyncio.sleep((spec.latency_ms + rng.uniform(0, spec.latency_jitter_ms)) / 1000)
+        if spec.error_rate and rng.random() < spec.error_rate:
+            status, body, content_type, etag = 500, b'injected error', 'text/plain', None
+        else:
+            status, body, content_type, etag = site.respond(scope['path'])
+        headers = [(b'content-type', content_type.encode()), (b'content-length', str(len(body)).encode())]
+        if etag:
+            headers.append((b'etag', etag.encode()))
+        await send({'type': 'http.response.start', 'status': status, 'headers': headers})
+        await send({'type': 'http.response.body', 'body': body})
+
+    return app
+
+
+async def pipe(reader, writer):
+    try:
+        while data := await reader.read(65536):
+            writer.write(data)
+            await writer.drain()
+    except OSError:
+        pass
+
+
+async def limit_connections(port, backend_port, max_connections):
+    """
+    Repassa as conexões TCP (o TLS passa intacto) para o hypercorn, no máximo max_connections
+    ao mesmo tempo. Retorna o servidor asyncio, que já está aceitando conexões.
+    """
+    slots = asyncio.Semaphore(max_connections)
+
+    async def relay(client_reader, client_writer):
+        async with slots: # Conexões além do limite esperam aqui, já aceitas
+            try:
+                backend_reader, backend_writer = await asyncio.open_connection('127.0.0.1', backend_port)
+            except OSError:
+                client_writer.close()
+                return
+            # Um lado fechou (ex.: keep-alive ocioso expirou no hypercorn): fecha os dois e libera a vaga
+            pipes = [asyncio.ensure_future(pipe(client_reader, backend_writer)),
+                     asyncio.ensure_future(pipe(backend_reader, client_writer))]
+            await asyncio.wait(pipes, return_when=asyncio.FIRST_COMPLETED)
+            for task in pipes:
+                task.cancel()
+            client_writer.close()
+            backend_writer.close()
+
+    return await asyncio.start_server(relay, '127.0.0.1', port, backlog=1024)
+
+
+def serve_https(spec, certfile, keyfile, port, max_connections=0):
+    """Processo servidor: hypercorn com TLS (ALPN h2 + http/1.1), atrás do limitador de conexões se max_connections"""
+    from hypercorn.asyncio import serve
+    from hypercorn.config import Config
+
+    config = Config()
+    config.bind = [f"127.0.0.1:{free_port() if max_connections else port}"]
+    config.certfile, config.keyfile = certfile, keyfile
+    config.accesslog = config.errorlog = None
+
+    async def main():
+        if max_connections:
+            backend_port = int(config.bind[0].rsplit(':', 1)[1])
+            await limit_connections(port, backend_port, max_connections) # Termina junto com o loop
+        await serve(make_app(sitegen.SyntheticSite(spec)), config)
+
+    asyncio.run(main())
+
+
+def free_port():
+    with socket.socket() as sock:
+        sock.bind(('127.0.0.1', 0))
+        return sock.getsockname()[1]
+
+
+def wait_for_port(port, timeout=10):
+    deadline = time.monotonic() + timeout
+    while time.monotonic() < deadline:
+        try:
+            socket.create_connection(('127.0.0.1', port), timeout=1).close()
+            return
+        except OSError:
+            time.sleep(0.05)
+    raise RuntimeError(f"HTTPS server did not start on port {port}")
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    sitegen.add_spec_arguments(parser)
+    parser.add_argument('--depth', type=int, default=3, help='Scan Depth do crawl')
+    parser.add_argument('--workers', type=int, default=None, help='campo Workers (padrão: MAX_WORKERS)')
+    parser.add_argument('--repeat', type=int, default=1, help='execuções por transporte')
+    parser.add_argument('--max-connections', type=int, default=0,
+                        help='conexões simultâneas aceitas por vez pelo servidor (0 = sem limite)')
+    args = parser.parse_args()
+
+    spec = sitegen.spec_from_args(args)
+    bench_root = tempfile.mkdtemp(prefix='bench_http2_')
+    certfile, keyfile = make_certificate(bench_root)
+    os.chdir(bench_root)
+
+    def run_with_server(setup):
+        """Uma execução contra um servidor novo: conexões que a anterior deixou abertas não ocupam o --max-connections"""
+        port = free_port()
+        server = multiprocessing.Process(target=serve_https, args=(spec, certfile, keyfile, port, args.max_connections),
+                                         daemon=True)
+        server.start()
+        try:
+            wait_for_port(port)
+            return run_once(f"https://127.0.0.1:{port}", args.depth, bench_root, setup=setup)
+        finally:
+            server.terminate()
+            server.join()
+
+    try:
+        for http2 in (False, True):
+            def setup(downloader, http2=http2):
+                downloader.http2 = http2
+                downloader.create_sessions()
+                for session in (downloader.session, downloader.image_session):
+                    session.verify = certfile # Confia no certificado autoassinado
+                    session.trust_env = False # Senão REQUESTS_CA_BUNDLE (se definido) substitui o verify
+                if args.workers:
+                    downloader.workers.set(args.workers)
+
+            runs = [run_with_server(setup) for _ in range(args.repeat)]
+            print(json.dumps({
+                'benchmark': 'http2',
+                'transport': 'http2' if http2 else 'http1.1',
+                'site': spec.to_dict(),
+                'depth': args.depth,
+                'max_connections': args.max_connections,
+                'runs': runs,
+            }))
+    finally:
+        os.chdir(BENCH_DIR)
+        shutil.rmtree(bench_root, ignore_errors=True)
+
+
+if __name__ == '__main__':
+    main()
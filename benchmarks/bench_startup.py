@@ -0,0 +1,119 @@
+"""
+Benchmark de inicialização: quanto custa abrir o app antes da primeira requisição.
+
+Mede em processos novos (mediana de --repeat execuções):
+    import    python -c "import baixar_img" (bytecode do módulo em cache)
+    headless  import + ImageDownloader(None), o começo de toda execução sem interface
+    module    python -m baixar_img --help (usa o bytecode em cache)
+    script    python baixar_img.py --help (o script principal é recompilado a cada execução)
+e o detalhamento do -X importtime: imports diretos mais caros do baixar_img e quais módulos
+pesados (Tk, bs4, asyncio, ...) chegaram a ser carregados numa execução sem interface.
+
+Uso:
+    python benchmarks/bench_startup.py --repeat 10
+    python benchmarks/bench_startup.py --output results.jsonl   # acumula para comparar versões
+"""
+import argparse
+import json
+import os
+import platform
+import shutil
+import statistics
+import subprocess
+import sys
+import tempfile
+import time
+
+BENCH_DIR = os.path.dirname(os.path.abspath(__file__))
+REPO_DIR = os.path.dirname(BENCH_DIR)
+sys.path.insert(0, BENCH_DIR)
+
+from run_bench import git_revision
+
+# Módulos que uma execução sem interface não deveria carregar só por importar o app
+HEAVY_MODULES = ('tkinter', 'bs4', 'lxml', 'asyncio', 'multiprocessing', 'concurrent.futures.process', 'httpx', 'PIL')
+
+HEADLESS_CODE = ("import sys, json, baixar_img; baixar_img.ImageDownloader(None); "
+                 f"print(json.dumps([m for m in {HEAVY_MODULES!r} if m in sys.modules]))")
+
+COMMANDS = {
+    'import': ['-c', 'import baixar_img'],
+    'headless': ['-c', HEADLESS_CODE],
+    'module': ['-m', 'baixar_img', '--help'],
+    'script': [os.path.join(REPO_DIR, 'baixar_img.py'), '--help'],
+}
+
+
+def run_python(args, workdir, env):
+    """Executa o Python com args num processo novo; retorna (segundos, stdout, stderr)"""
+    start = time.perf_counter()
+    result = subprocess.run([sys.executable] + args, cwd=workdir, env=env, capture_output=True, text=True, check=True)
+    return time.perf_counter() - start, result.stdout, result.stderr
+
+
+def parse_importtime(stderr, module='baixar_img'):
+    """
+    Lê a saída do -X importtime: (tempo acumulado do módulo em ms, imports diretos dele
+    como [(nome, ms acumulados)]). O importtime lista os filhos antes do pai.
+    """
+    children, total = [], None
+    pending = []
+    for line in stderr.splitlines():
+        if not line.startswith('import time:') or 'cumulative' in line:
+            continue
+        _, cumulative, name = line[len('import time:'):].split('|')
+        depth = (len(name) - len(name.lstrip())) // 2
+        name = name.strip()
+        if depth == 1:
+            pending.append((name, int(cumulative) / 1000))
+        elif depth == 0:
+            if name == module:
+                total, children = int(cumulative) / 1000, pending
+            pending = []
+    return total, sorted(children, key=lambda item: item[1], reverse=True)
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument('--repeat', type=int, default=10, help='execuções de cada comando')
+    parser.add_argument('--top', type=int, default=10, help='imports diretos listados no detalhamento')
+    parser.add_argument('--output', help='arquivo JSONL onde acrescentar o resultado')
+    args = parser.parse_args()
+
+    env = dict(os.environ, PYTHONPATH=REPO_DIR + os.pathsep + os.environ.get('PYTHONPATH', ''))
+    env.pop('PYTHONDONTWRITEBYTECODE', None)
+    # config.json e image_downloader.log criados pelo ImageDownloader ficam fora do repositório
+    workdir = tempfile.mkdtemp(prefix='bench_startup_')
+    try:
+        run_python(COMMANDS['import'], workdir, env) # Gera o bytecode em cache
+        timings = {}
+        for name, command in COMMANDS.items():
+            samples = [run_python(command, workdir, env)[0] for _ in range(args.repeat)]
+            timings[name] = {'median_ms': round(statistics.median(samples) * 1000, 1),
+                             'min_ms': round(min(samples) * 1000, 1)}
+        baseline = [run_python(['-c', 'pass'], workdir, env)[0] for _ in range(args.repeat)]
+        _, stdout, stderr = run_python(['-X', 'importtime', '-c', HEADLESS_CODE], workdir, env)
+    finally:
+        shutil.rmtree(workdir, ignore_errors=True)
+
+    import_ms, children = parse_importtime(stderr)
+    result = {
+        'benchmark': 'startup',
+        'timestamp': time.strftime('%Y-%m-%dT%H:%M:%S'),
+        'git_revision': git_revision(),
+        'python': platform.python_version(),
+        'interpreter_ms': round(statistics.median(baseline) * 1000, 1), # python -c pass, para descontar
+        'runs': timings,
+        'importtime_ms': import_ms,
+        'top_imports_ms': [[name, round(ms, 1)] for name, ms in children[:args.top]],
+        'heavy_modules_loaded_headless': json.loads(stdout.strip().splitlines()[-1]),
+    }
+    line = json.dumps(result)
+    print(line)
+    if args.output:
+        with open(args.output, 'a', encoding='utf-8') as f:
+            f.write(line + '\n')
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,104 @@
+"""
+Benchmark do laço de streaming de download_image contra um servidor HTTP local.
+
+Compara o chunk fixo antigo (8 KB) com o chunk adaptativo, medindo MB/s por worker
+e tempo de CPU por GB do processo cliente. O servidor roda em outro processo para
+que a CPU dele não entre na conta.
+
+Uso:
+    python benchmarks/bench_streaming.py --size-mb 20 --files 5 --chunk-sizes 8192 0
+Saída: uma linha JSON por configuração de chunk (0 = adaptativo).
+"""
+import argparse
+import json
+import multiprocessing
+import os
+import sys
+import tempfile
+import time
+from http.server import ThreadingHTTPServer, BaseHTTPRequestHandler
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+
+def serve_blob(size, port_queue):
+    """Processo servidor: responde qualquer GET com `size` bytes de image/jpeg"""
+    payload = os.urandom(min(size, 1024 * 1024))
+
+    class BlobHandler(BaseHTTPRequestHandler):
+        def log_message(self, *args):
+            pass
+
+        def do_GET(self):
+            self.send_response(200)
+            self.send_header('Content-Type', 'image/jpeg')
+            self.send_header('Content-Length', str(size))
+            self.end_headers()
+            remaining = size
+            while remaining > 0:
+                block = payload[:remaining]
+                self.wfile.write(block)
+                remaining -= len(block)
+
+    server = ThreadingHTTPServer(('127.0.0.1', 0), BlobHandler)
+    port_queue.put(server.server_port)
+    server.serve_forever()
+
+
+def run_config(base_url, chunk_size, files):
+    """Baixa `files` imagens com um chunk_size e retorna (bytes, segundos, segundos de CPU)"""
+    from baixar_img import ImageDownloader
+
+    downloader = ImageDownloader(None)
+    downloader.chunk_size = chunk_size
+    downloader.base_domain_name = f"bench_chunk_{chunk_size}"
+    total_bytes = 0
+    wall_start, cpu_start = time.perf_counter(), time.process_time()
+    for i in range(files):
+        # URL diferente por execução para não cair no "já existe"
+        url = f"{base_url}/img_{chunk_size}_{i}_{time.time_ns()}.jpg"
+        if not downloader.download_image(url):
+            raise RuntimeError(f"download failed: {url}")
+    wall, cpu = time.perf_counter() - wall_start, time.process_time() - cpu_start
+    folder = os.path.join('donwload imgs', downloader.base_domain_name)
+    for name in os.listdir(folder):
+        path = os.path.join(folder, name)
+        if os.path.isfile(path):
+            total_bytes += os.path.getsize(path)
+            os.remove(path)
+    return total_bytes, wall, cpu
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument('--size-mb', type=float, default=20, help='tamanho de cada imagem (MB)')
+    parser.add_argument('--files', type=int, default=5, help='imagens por configuração')
+    parser.add_argument('--chunk-sizes', type=int, nargs='+', default=[8192, 0],
+                        help='chunks a comparar (0 = adaptativo)')
+    args = parser.parse_args()
+
+    size = int(args.size_mb * 1024 * 1024)
+    port_queue = multiprocessing.Queue()
+    server = multiprocessing.Process(target=serve_blob, args=(size, port_queue), daemon=True)
+    server.start()
+    base_url = f"http://127.0.0.1:{port_queue.get(timeout=10)}"
+
+    os.chdir(tempfile.mkdtemp(prefix='bench_streaming_'))
+    try:
+        for chunk_size in args.chunk_sizes:
+            total_bytes, wall, cpu = run_config(base_url, chunk_size, args.files)
+            gigabytes = total_bytes / 1024 ** 3
+            print(json.dumps({
+                'benchmark': 'streaming',
+                'chunk_size': chunk_size or 'adaptive',
+                'files': args.files,
+                'bytes': total_bytes,
+                'mb_per_s_per_worker': round(total_bytes / 1024 ** 2 / wall, 2),
+                'cpu_s_per_gb': round(cpu / gigabytes, 3) if gigabytes else None,
+            }))
+    finally:
+        server.terminate()
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,145 @@
+"""
+Benchmark de ponta a ponta: crawl + download reais do ImageDownloader contra um site sintético local.
+
+Sobe o site de benchmarks/sitegen.py em outro processo (CPU/memória do servidor ficam fora
+da medição), roda ImageDownloader(None).run_headless e imprime um JSON com:
+pages/s, images/s, MB/s, latência p50/p99 das requisições, pico de RSS e tempo de CPU.
+
+Uso:
+    python benchmarks/run_bench.py --pages 300 --fanout 6 --depth 3 --latency-ms 5
+    python benchmarks/run_bench.py --repeat 3 --output results.jsonl   # acumula para comparar versões
+"""
+import argparse
+import json
+import multiprocessing
+import os
+import platform
+import resource
+import shutil
+import subprocess
+import sys
+import tempfile
+import time
+
+BENCH_DIR = os.path.dirname(os.path.abspath(__file__))
+REPO_DIR = os.path.dirname(BENCH_DIR)
+sys.path.insert(0, REPO_DIR)
+sys.path.insert(0, BENCH_DIR)
+
+import sitegen
+
+
+def percentile(values, fraction):
+    """Percentil simples (nearest-rank) de uma lista"""
+    if not values:
+        return None
+    ordered = sorted(values)
+    index = min(len(ordered) - 1, max(0, int(round(fraction * len(ordered))) - 1))
+    return ordered[index]
+
+
+def git_revision():
+    try:
+        return subprocess.check_output(['git', 'rev-parse', '--short', 'HEAD'], cwd=REPO_DIR,
+                                       stderr=subprocess.DEVNULL, text=True).strip()
+    except (OSError, subprocess.CalledProcessError):
+        return None
+
+
+def folder_size(path):
+    total = 0
+    for dirpath, dirnames, filenames in os.walk(path):
+        total += sum(os.path.getsize(os.path.join(dirpath, name)) for name in filenames)
+    return total
+
+
+def run_once(base_url, depth, bench_root, setup=None):
+    """
+    Uma execução completa num diretório de trabalho vazio; retorna as métricas.
+    setup(downloader), se informado, ajusta o downloader antes da execução (ex.: transporte).
+    """
+    import baixar_img
+
+    workdir = tempfile.mkdtemp(prefix='run_', dir=bench_root)
+    os.chdir(workdir)
+    try:
+        downloader = baixar_img.ImageDownloader(None)
+        downloader.max_depth.set(depth)
+        if setup is not None:
+            setup(downloader)
+
+        latencies = [] # Tempo até os headers de cada resposta (response.elapsed), páginas e imagens
+        for session in (downloader.session, downloader.image_session):
+            session.hooks['response'].append(
+                lambda response, *args, **kwargs: latencies.append(response.elapsed.total_seconds()))
+
+        cpu_start, wall_start = time.process_time(), time.perf_counter()
+        summary = downloader.run_headless(base_url + '/')
+        wall, cpu = time.perf_counter() - wall_start, time.process_time() - cpu_start
+
+        downloaded_bytes = folder_size(summary['download_dir']) if summary['download_dir'] else 0
+        return {
+            'wall_s': round(wall, 3),
+            'cpu_s': round(cpu, 3),
+            'pages': summary['pages_processed'],
+            'images': summary['downloaded'],
+            'bytes': downloaded_bytes,
+            'pages_per_s': round(summary['pages_processed'] / wall, 2),
+            'images_per_s': round(summary['downloaded'] / wall, 2),
+            'mb_per_s': round(downloaded_bytes / 1024 ** 2 / wall, 2),
+            'requests': len(latencies),
+            'latency_p50_ms': round(percentile(latencies, 0.50) * 1000, 2) if latencies else None,
+            'latency_p99_ms': round(percentile(latencies, 0.99) * 1000, 2) if latencies else None,
+        }
+    finally:
+        os.chdir(bench_root)
+        shutil.rmtree(workdir, ignore_errors=True)
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    sitegen.add_spec_arguments(parser)
+    parser.add_argument('--depth', type=int, default=3, help='Scan Depth do crawl')
+    parser.add_argument('--repeat', type=int, default=1, help='execuções (cada uma num diretório limpo)')
+    parser.add_argument('--output', help='arquivo JSONL onde acrescentar o resultado')
+    args = parser.parse_args()
+    output = os.path.abspath(args.output) if args.output else None # Antes de qualquer chdir
+
+    spec = sitegen.spec_from_args(args)
+    port_queue = multiprocessing.Queue()
+    server = multiprocessing.Process(target=sitegen.serve, args=(spec,), kwargs={'port_queue': port_queue}, daemon=True)
+    server.start()
+    base_url = f"http://127.0.0.1:{port_queue.get(timeout=10)}"
+
+    # Tudo (inclusive o image_downloader.log criado pelo ImageDownloader) fica fora da árvore do repositório
+    bench_root = tempfile.mkdtemp(prefix='bench_crawl_')
+    os.chdir(bench_root)
+    try:
+        runs = [run_once(base_url, args.depth, bench_root) for _ in range(args.repeat)]
+    finally:
+        server.terminate()
+        os.chdir(REPO_DIR)
+        shutil.rmtree(bench_root, ignore_errors=True)
+
+    import baixar_img
+    result = {
+        'benchmark': 'crawl',
+        'timestamp': time.strftime('%Y-%m-%dT%H:%M:%S'),
+        'app_version': baixar_img.APP_VERSION,
+        'git_revision': git_revision(),
+        'python': platform.python_version(),
+        'site': spec.to_dict(),
+        'depth': args.depth,
+        'runs': runs,
+        # ru_maxrss é em KB no Linux e em bytes no macOS
+        'peak_rss_mb': round(resource.getrusage(resource.RUSAGE_SELF).ru_maxrss / (1024 ** 2 if sys.platform == 'darwin' else 1024), 1),
+    }
+    line = json.dumps(result)
+    print(line)
+    if output:
+        with open(output, 'a', encoding='utf-8') as f:
+            f.write(line + '\n')
+
+
+if __name__ == '__main__':
+    main()
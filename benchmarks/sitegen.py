@@ -0,0 +1,139 @@
+"""
+Gerador de site sintético servido por HTTP local, para benchmarks offline.
+
+O site é determinístico (mesma seed = mesmo site): as páginas formam uma árvore com
+`fanout` filhos por página, mais alguns links cruzados, e cada página referencia
+`images_per_page` imagens com tamanhos entre `image_min_kb` e `image_max_kb`.
+Latência e taxa de erro (respostas 500) podem ser injetadas.
+
+Uso isolado (útil para testar a UI manualmente):
+    python benchmarks/sitegen.py --pages 200 --fanout 5 --port 8000
+"""
+import argparse
+import random
+import time
+from dataclasses import dataclass, asdict
+from http.server import ThreadingHTTPServer, BaseHTTPRequestHandler
+
+
+@dataclass
+class SiteSpec:
+    """Parâmetros do site sintético"""
+    pages: int = 200
+    fanout: int = 5
+    cross_links: int = 2 # Links extras para páginas aleatórias (gera duplicados para o crawler)
+    images_per_page: int = 10
+    image_min_kb: int = 20
+    image_max_kb: int = 200
+    latency_ms: float = 0.0 # Latência injetada em cada resposta
+    latency_jitter_ms: float = 0.0
+    error_rate: float = 0.0 # Fração de respostas 500
+    seed: int = 1234
+
+    def to_dict(self):
+        return asdict(self)
+
+
+class SyntheticSite:
+    """Conteúdo do site: HTML das páginas e bytes das imagens, gerados a partir da seed"""
+
+    def __init__(self, spec):
+        self.spec = spec
+        rng = random.Random(spec.seed)
+        self.image_sizes = {}
+        self.page_links = {}
+        for page in range(spec.pages):
+            children = [page * spec.fanout + i + 1 for i in range(spec.fanout)]
+            links = [c for c in children if c < spec.pages]
+            links += [rng.randrange(spec.pages) for _ in range(spec.cross_links)]
+            self.page_links[page] = links
+            for k in range(spec.images_per_page):
+                size = rng.randint(spec.image_min_kb, spec.image_max_kb) * 1024
+                self.image_sizes[f"{page}_{k}"] = size
+        self.blob = random.Random(spec.seed + 1).randbytes(spec.image_max_kb * 1024)
+
+    def page_html(self, page):
+        links = ''.join(f'<a href="/page/{p}">page {p}</a>\n' for p in self.page_links[page])
+        images = ''.join(f'<img src="/img/{page}_{k}.jpg" alt="">\n' for k in range(self.spec.images_per_page))
+        return (f"<!DOCTYPE html><html><head><meta charset=\"utf-8\"><title>Page {page}</title></head>"
+                f"<body><h1>Page {page}</h1>\n{links}{images}</body></html>").encode('utf-8')
+
+    def image_bytes(self, key):
+        size = self.image_sizes.get(key)
+        return None if size is None else self.blob[:size]
+
+    def respond(self, path):
+        """Resposta para um path: (status, corpo, content-type, etag ou None)"""
+        path = path.split('?', 1)[0]
+        if path in ('/', '/page/0'):
+            return 200, self.page_html(0), 'text/html; charset=utf-8', None
+        if path.startswith('/page/'):
+            page = path[len('/page/'):]
+            if page.isdigit() and int(page) < self.spec.pages:
+                return 200, self.page_html(int(page)), 'text/html; charset=utf-8', None
+        elif path.startswith('/img/') and path.endswith('.jpg'):
+            body = self.image_bytes(path[len('/img/'):-len('.jpg')])
+            if body is not None:
+                return 200, body, 'image/jpeg', f'"{path}"'
+        return 404, b'not found', 'text/plain', None
+
+
+def make_handler(site):
+    """Cria a classe de handler HTTP ligada a um SyntheticSite"""
+    spec = site.spec
+    rng = random.Random(spec.seed + 2)
+
+    class SiteHandler(BaseHTTPRequestHandler):
+        protocol_version = 'HTTP/1.1' # Keep-alive, como servidores reais
+
+        def log_message(self, *args):
+            pass
+
+        def do_GET(self):
+            if spec.latency_ms or spec.latency_jitter_ms:
+                time.sleep((spec.latency_ms + rng.uniform(0, spec.latency_jitter_ms)) / 1000)
+            if spec.error_rate and rng.random() < spec.error_rate:
+                return self._send(500, b'injected error', 'text/plain')
+            self._send(*site.respond(self.path))
+
+        def _send(self, status, body, content_type, etag=None):
+            self.send_response(status)
+            self.send_header('Content-Type', content_type)
+            self.send_header('Content-Length', str(len(body)))
+            if etag:
+                self.send_header('ETag', etag)
+            self.end_headers()
+            try:
+                self.wfile.write(body)
+            except (BrokenPipeError, ConnectionResetError):
+                pass # Cliente desistiu (stop/timeout)
+
+    return SiteHandler
+
+
+def serve(spec, host='127.0.0.1', port=0, port_queue=None):
+    """Sobe o servidor do site (bloqueante). Publica a porta em port_queue, se informada."""
+    server = ThreadingHTTPServer((host, port), make_handler(SyntheticSite(spec)))
+    server.daemon_threads = True
+    if port_queue is not None:
+        port_queue.put(server.server_port)
+    server.serve_forever()
+
+
+def add_spec_arguments(parser):
+    """Adiciona os parâmetros do SiteSpec a um argparse.ArgumentParser"""
+    for name, default in SiteSpec().to_dict().items():
+        parser.add_argument(f"--{name.replace('_', '-')}", type=type(default), default=default)
+
+
+def spec_from_args(args):
+    return SiteSpec(**{name: getattr(args, name) for name in SiteSpec().to_dict()})
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    add_spec_arguments(parser)
+    parser.add_argument('--port', type=int, default=8000)
+    args = parser.parse_args()
+    print(f"Serving synthetic site on http://127.0.0.1:{args.port}/")
+    serve(spec_from_args(args), port=args.port)